@@ -0,0 +1,14 @@
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+# Async views for the read-heavy endpoints; see feed/async_views.py
+os.environ.setdefault('ASYNC_READ_VIEWS', 'True')
+
+from django.conf import settings  # noqa: E402
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler  # noqa: E402
+from django.core.asgi import get_asgi_application  # noqa: E402
+
+application = get_asgi_application()
+
+if 'whitenoise.middleware.WhiteNoiseMiddleware' not in settings.MIDDLEWARE:
+    application = ASGIStaticFilesHandler(application)
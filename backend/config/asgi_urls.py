@@ -0,0 +1,10 @@
+from django.contrib import admin
+from django.urls import path, include
+
+from feed.views import metrics_view
+
+urlpatterns = [
+    path('admin/', admin.site.urls),
+    path('metrics', metrics_view, name='metrics'),
+    path('api/', include('feed.async_urls')),
+]
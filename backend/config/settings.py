@@ -26,8 +26,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'feed.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'feed.middleware.CompressionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -37,7 +39,16 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'config.urls'
+# Set by config/asgi.py: serve the feed, post detail and leaderboard reads
+# from the async views in feed/async_views.py
+ASYNC_READ_VIEWS = os.getenv('ASYNC_READ_VIEWS', 'False') == 'True'
+
+if ASYNC_READ_VIEWS:
+    # WhiteNoise is sync-only and would push every request through a worker
+    # thread; config/asgi.py serves the (admin) static files instead
+    MIDDLEWARE.remove('whitenoise.middleware.WhiteNoiseMiddleware')
+
+ROOT_URLCONF = 'config.asgi_urls' if ASYNC_READ_VIEWS else 'config.urls'
 
 TEMPLATES = [
     {
@@ -56,6 +67,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'config.wsgi.application'
+ASGI_APPLICATION = 'config.asgi.application'
 
 DATABASE_URL = os.getenv('DATABASE_URL', '')
 if DATABASE_URL:
@@ -70,6 +82,23 @@ else:
         }
     }
 
+# Comma-separated read replica URLs. Safe-method viewset reads go to a replica
+# and a client is pinned to the primary for REPLICA_PIN_SECONDS after each
+# write (see feed/routers.py).
+REPLICA_DATABASE_URLS = [url for url in os.getenv('REPLICA_DATABASE_URLS', '').split(',') if url]
+REPLICA_DATABASES = []
+for index, url in enumerate(REPLICA_DATABASE_URLS, 1):
+    alias = f'replica{index}'
+    DATABASES[alias] = dj_database_url.parse(url)
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    REPLICA_DATABASES.append(alias)
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '5'))
+DATABASE_ROUTERS = ['feed.routers.ReplicaRouter']
+
+# Adds the test-only `lagging_replica` database the routing tests read from,
+# and moves the SQLite test database to disk for threaded tests
+TEST_RUNNER = 'config.test_runner.TestRunner'
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -109,7 +138,93 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
     ],
+    # orjson-backed when it is installed, DRF's stdlib JSON otherwise (see feed/renderers.py)
+    'DEFAULT_RENDERER_CLASSES': [
+        'feed.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'feed.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
+# gzip for JSON responses of at least COMPRESSION_MIN_SIZE bytes (see
+# feed/middleware.py). Compressed bodies of responses with an ETag are reused
+# from the COMPRESSION_CACHE cache for COMPRESSION_CACHE_TIMEOUT seconds.
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '6'))
+COMPRESSION_CACHE = os.getenv('COMPRESSION_CACHE', 'default')
+COMPRESSION_CACHE_TIMEOUT = int(os.getenv('COMPRESSION_CACHE_TIMEOUT', '300'))
+
+# Posts per page on the feed; clients can ask for fewer/more with ?page_size=
+FEED_PAGE_SIZE = int(os.getenv('FEED_PAGE_SIZE', '20'))
+
+# Post detail returns a bounded window of the comment tree (see feed/threads.py);
+# clients can adjust each bound per request with ?roots= / ?depth= / ?replies= /
+# ?nodes=. The per-level bounds multiply; COMMENT_TREE_NODES caps the total.
+COMMENT_TREE_ROOTS = int(os.getenv('COMMENT_TREE_ROOTS', '50'))
+COMMENT_TREE_DEPTH = int(os.getenv('COMMENT_TREE_DEPTH', '6'))
+COMMENT_TREE_REPLIES = int(os.getenv('COMMENT_TREE_REPLIES', '20'))
+COMMENT_TREE_NODES = int(os.getenv('COMMENT_TREE_NODES', '200'))
+
+# Rendered comment tree windows are cached per post (see feed/tree_cache.py)
+# in the COMMENT_TREE_CACHE cache. A write invalidates them by bumping the
+# post's version in that cache, which every web worker must see, so caching
+# is off until COMMENT_TREE_CACHE_BACKEND / COMMENT_TREE_CACHE_LOCATION point
+# at a cache the workers share (e.g. Redis, Memcached or the database).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'comment_trees': {
+        'BACKEND': os.getenv('COMMENT_TREE_CACHE_BACKEND', 'django.core.cache.backends.dummy.DummyCache'),
+        'LOCATION': os.getenv('COMMENT_TREE_CACHE_LOCATION', 'comment-trees'),
+    },
 }
+COMMENT_TREE_CACHE = os.getenv('COMMENT_TREE_CACHE', 'comment_trees')
+COMMENT_TREE_CACHE_TIMEOUT = int(os.getenv('COMMENT_TREE_CACHE_TIMEOUT', '300'))
+
+# Half-life of a post's likes and comments in the hot feed (?sort=hot, see
+# feed/hot.py). Run `manage.py refresh_hot_scores` after changing it.
+HOT_HALF_LIFE_HOURS = float(os.getenv('HOT_HALF_LIFE_HOURS', '24'))
+
+# Karma from likes is queued in an outbox (see feed/outbox.py). OUTBOX_SYNC
+# applies the events inside the request instead of queueing them; set it to
+# False only where `manage.py outbox_worker` runs next to the web processes,
+# or the karma is never written.
+OUTBOX_SYNC = os.getenv('OUTBOX_SYNC', 'True') == 'True'
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+OUTBOX_RETENTION_HOURS = int(os.getenv('OUTBOX_RETENTION_HOURS', '24'))
+
+# `manage.py compact_karma` folds KarmaTransaction rows older than this many
+# days into daily per-user totals (minimum 2, to keep the leaderboard window)
+KARMA_LEDGER_RETENTION_DAYS = int(os.getenv('KARMA_LEDGER_RETENTION_DAYS', '7'))
+
+# Where the 24h leaderboard is served from (see feed/leaderboard.py).
+# MemoryLeaderboard keeps a per-process index and resyncs it from the karma
+# rollups every LEADERBOARD_INDEX_MAX_AGE seconds to pick up other workers'
+# writes. Keep it below the 5-minute bucket size so expiry stays exact.
+LEADERBOARD_BACKEND = os.getenv('LEADERBOARD_BACKEND', 'feed.leaderboard.MemoryLeaderboard')
+LEADERBOARD_INDEX_MAX_AGE = int(os.getenv('LEADERBOARD_INDEX_MAX_AGE', '30'))
+
+# Request metrics at /metrics (see feed/metrics.py). Under gunicorn, point
+# METRICS_DIR at a directory shared by the workers so any of them reports
+# the totals; METRICS_TOKEN lets a scraper in with a bearer token.
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '1'))
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Live updates over server-sent events (see feed/live.py and feed/pubsub.py).
+# The default broker only reaches streams served by the same process.
+PUBSUB_BACKEND = os.getenv('PUBSUB_BACKEND', 'feed.pubsub.MemoryBroker')
+PUBSUB_HISTORY = int(os.getenv('PUBSUB_HISTORY', '100'))
+PUBSUB_MAX_CHANNELS = int(os.getenv('PUBSUB_MAX_CHANNELS', '10000'))
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', '15'))
+SSE_MAX_PENDING = int(os.getenv('SSE_MAX_PENDING', '200'))
+SSE_MAX_AGE_SECONDS = float(os.getenv('SSE_MAX_AGE_SECONDS', '300'))
 
 # Session settings for cross-origin
 SESSION_COOKIE_SAMESITE = 'Lax' if DEBUG else 'None'
@@ -0,0 +1,51 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.db import connections
+from django.test.runner import DiscoverRunner
+from django.test.utils import iter_test_cases
+
+# A second SQLite database that never receives writes: a replica that lags
+# behind for good, for the replica routing tests to opt in to
+LAGGING_REPLICA = 'lagging_replica'
+
+# Tag for tests that send requests from several threads at once
+THREADS_TAG = 'threads'
+
+
+class TestRunner(DiscoverRunner):
+    """
+    The default runner, plus the test-only LAGGING_REPLICA database.
+
+    When the run includes tests tagged THREADS_TAG, an in-memory SQLite test
+    database moves to a temporary file: in shared-cache memory a second
+    connection fails at once with "table is locked" instead of waiting for
+    the lock as it would in production.
+    """
+
+    threads = False
+
+    def setup_test_environment(self, **kwargs):
+        # connections reads the DATABASES dict itself, so it sees the new
+        # alias once the defaults are filled in
+        settings.DATABASES[LAGGING_REPLICA] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': settings.BASE_DIR / 'lagging_replica.sqlite3',
+        }
+        connections.configure_settings(settings.DATABASES)
+        super().setup_test_environment(**kwargs)
+
+    def build_suite(self, *args, **kwargs):
+        suite = super().build_suite(*args, **kwargs)
+        # A parallel suite keeps its tests in subsuites
+        tests = iter_test_cases(getattr(suite, 'subsuites', suite))
+        self.threads = any(THREADS_TAG in getattr(test, 'tags', ()) for test in tests)
+        return suite
+
+    def setup_databases(self, **kwargs):
+        default = connections['default']
+        test_settings = default.settings_dict['TEST']
+        if self.threads and default.vendor == 'sqlite' and not test_settings['NAME']:
+            test_settings['NAME'] = os.path.join(tempfile.gettempdir(), 'playto_test_db.sqlite3')
+        return super().setup_databases(**kwargs)
@@ -1,17 +1,35 @@
 from django.contrib import admin
-from .models import Post, Comment, PostLike, CommentLike, KarmaTransaction
+from django.db.models import Q
+from . import search
+from .models import Post, Comment, PostLike, CommentLike, KarmaTransaction, OutboxEvent
+
+
+class FullTextSearchMixin:
+    """
+    Admin search through the full-text index (see feed/search.py) instead of
+    icontains scans: content matching every word, or an exact username.
+    """
+    # Shows the search box; get_search_results does the searching
+    search_fields = ['content', 'author__username']
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        matches = Q(author__username=search_term)
+        if search.terms(search_term):
+            matches |= Q(search.match(queryset.model, search_term))
+        return queryset.filter(matches), False
 
 @admin.register(Post)
-class PostAdmin(admin.ModelAdmin):
-    list_display = ['id', 'author', 'content', 'created_at']
+class PostAdmin(FullTextSearchMixin, admin.ModelAdmin):
+    list_display = ['id', 'author', 'content', 'like_count', 'comment_count', 'created_at']
     list_filter = ['created_at']
-    search_fields = ['content', 'author__username']
 
 @admin.register(Comment)
-class CommentAdmin(admin.ModelAdmin):
-    list_display = ['id', 'author', 'post', 'parent', 'content', 'created_at']
+class CommentAdmin(FullTextSearchMixin, admin.ModelAdmin):
+    list_display = ['id', 'author', 'post', 'parent', 'content', 'like_count', 'created_at']
     list_filter = ['created_at']
-    search_fields = ['content', 'author__username']
 
 @admin.register(PostLike)
 class PostLikeAdmin(admin.ModelAdmin):
@@ -25,3 +43,9 @@ class CommentLikeAdmin(admin.ModelAdmin):
 class KarmaTransactionAdmin(admin.ModelAdmin):
     list_display = ['id', 'user', 'karma_type', 'points', 'created_at']
     list_filter = ['karma_type', 'created_at']
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'kind', 'key', 'attempts', 'created_at', 'processed_at', 'failed_at']
+    list_filter = ['kind']
+    search_fields = ['key']
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class FeedConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'feed'
+
+    def ready(self):
+        # Connects the leaderboard index to karma_changed, the comment tree
+        # cache to comment / comment like changes, live updates to both, and
+        # the request metrics to new database connections
+        from . import leaderboard, live, metrics, tree_cache  # noqa: F401
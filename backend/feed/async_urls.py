@@ -0,0 +1,18 @@
+"""
+URLs for the ASGI entry point: feed.urls with the feed, post detail and
+leaderboard reads and the live event streams served by the async views in
+async_views.py.
+"""
+from django.urls import path
+
+from . import async_views, urls
+
+urlpatterns = [
+    path('posts/', async_views.post_list, name='post-list'),
+    path('posts/<int:pk>/', async_views.post_detail, name='post-detail'),
+    path('leaderboard/', async_views.leaderboard, name='leaderboard'),
+    path('leaderboard/stream/', async_views.leaderboard_stream, name='leaderboard-stream'),
+    path('posts/<int:pk>/stream/', async_views.post_stream, name='post-stream'),
+    # Everything else, including the format-suffixed and non-GET routes
+    *urls.urlpatterns,
+]
@@ -0,0 +1,155 @@
+"""
+Async versions of the read-heavy endpoints, served by the ASGI entry point
+(config/asgi.py) through config/asgi_urls.py.
+
+GET /posts/, GET /posts/{id}/ and GET /leaderboard/ answer exactly like
+their sync counterparts in views.py - same JSON, same ETags and 304s, same
+replica routing - but wait on the database with the async ORM, so one
+worker keeps serving other connections in the meantime. Every other method
+on those URLs is handed to the sync viewset.
+
+Two steps still run in a worker thread: loading a comment tree window on a
+cache miss (several dependent queries, see threads.py) and building the
+leaderboard from the database (see leaderboard.py). Both are off the hot
+path: tree windows are cached and the leaderboard is normally served from
+the in-memory index.
+
+The live event streams (see live.py) are here too: each open stream is a
+task waiting on the event loop rather than a blocked worker thread.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.request import Request
+
+from . import etags, likes, live, pubsub, routers, threads, tree_cache, leaderboard as leaderboard_index
+from .models import Post
+from .pagination import FEED_SORTS
+from .renderers import FastJSONRenderer
+from .serializers import PostSerializer, PostDetailSerializer
+from .views import PostViewSet
+
+renderer = FastJSONRenderer()
+
+
+def json_response(data, status=200):
+    return HttpResponse(renderer.render(data), content_type=renderer.media_type, status=status)
+
+
+async def resolve_user(request):
+    """Load request.user (a lazy session lookup) off the event loop."""
+    await sync_to_async(lambda: request.user.is_authenticated)()
+    return request.user
+
+
+def reads_async(sync_view):
+    """
+    Turn an async GET handler into a view for a URL whose other methods are
+    served by `sync_view`.
+    """
+    def decorator(handler):
+        async def view(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return await sync_to_async(sync_view)(request, *args, **kwargs)
+            return await handler(request, *args, **kwargs)
+        # The viewsets do their own (session) authentication checks.
+        # csrf_exempt() only learns to wrap coroutines in Django 5.0.
+        view.csrf_exempt = True
+        return view
+    return decorator
+
+
+@reads_async(PostViewSet.as_view({'get': 'list', 'post': 'create'}))
+async def post_list(request):
+    user = await resolve_user(request)
+    drf_request = Request(request)
+    sort = drf_request.query_params.get('sort', 'new')
+    if sort not in FEED_SORTS:
+        return json_response({'error': f'sort must be one of: {", ".join(FEED_SORTS)}'}, status=400)
+    paginator = FEED_SORTS[sort]()
+    queryset = Post.objects.select_related('author')
+    stamp_fields = ('id', 'updated_at', 'hot_score') if sort == 'hot' else ('id', 'updated_at')
+
+    with routers.replica_reads(request):
+        if etags.is_conditional(request):
+            etag = etags.make_etag(request, await paginator.apage_stamp(queryset, drf_request, stamp_fields))
+            response = etags.not_modified(request, etag)
+            if response is not None:
+                return response
+
+        posts = await paginator.apaginate_queryset(queryset, drf_request)
+        liked = await likes.aliked_ids(user, Post, [post.pk for post in posts])
+
+    data = PostSerializer(posts, many=True, context={
+        'request': drf_request, likes.context_key(Post): liked,
+    }).data
+    response = json_response(paginator.get_paginated_data(data))
+    etag = etags.make_etag(request, paginator.loaded_stamp(stamp_fields))
+    return etags.tag(response, etag)
+
+
+@reads_async(PostViewSet.as_view({
+    'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy',
+}))
+async def post_detail(request, pk):
+    user = await resolve_user(request)
+    drf_request = Request(request)
+
+    with routers.replica_reads(request):
+        stamp = await etags.apost_stamp(pk)
+        etag = etags.make_etag(request, stamp) if stamp is not None else None
+        if etag is not None:
+            response = etags.not_modified(request, etag)
+            if response is not None:
+                return response
+
+        try:
+            post = await Post.objects.select_related('author').aget(pk=pk)
+        except Post.DoesNotExist:
+            # Same body as DRF's NotFound from the sync view
+            return json_response({'detail': 'Not found.'}, status=404)
+
+        post.rendered_comments, post.more_comments = await sync_to_async(tree_cache.load_window)(
+            post, user, **threads.window_params(request.GET)
+        )
+        liked = await likes.aliked_ids(user, Post, [post.pk])
+
+    data = PostDetailSerializer(post, context={
+        'request': drf_request, likes.context_key(Post): liked,
+    }).data
+    response = json_response(data)
+    return etags.tag(response, etag) if etag is not None else response
+
+
+async def leaderboard(request):
+    """Top 5 users by karma earned in the last 24 hours; see views.leaderboard."""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponse(status=405, headers={'Allow': 'GET, HEAD'})
+    etag = etags.make_etag(request, await leaderboard_index.astamp(limit=5), viewer=False)
+    response = etags.not_modified(request, etag)
+    if response is not None:
+        return response
+    return etags.tag(json_response(await leaderboard_index.atop_users(limit=5)), etag)
+
+
+async def post_stream(request, pk):
+    """Server-sent events for one post; see views.post_stream."""
+    if request.method != 'GET':
+        return HttpResponse(status=405, headers={'Allow': 'GET'})
+    if not await Post.objects.filter(pk=pk).aexists():
+        return json_response({'detail': 'Not found.'}, status=404)
+    subscription = pubsub.subscribe(live.post_channel(pk), live.last_event_id(request))
+    return live.stream_response(live.aevents(subscription))
+
+
+async def leaderboard_stream(request):
+    """Server-sent events with the new top 5; see views.leaderboard_stream."""
+    if request.method != 'GET':
+        return HttpResponse(status=405, headers={'Allow': 'GET'})
+    subscription = pubsub.subscribe(live.LEADERBOARD, live.last_event_id(request))
+    refresh = sync_to_async(live.refresh_leaderboard)
+    await refresh()
+    return live.stream_response(live.aevents(
+        subscription,
+        on_idle=lambda: refresh(min_interval=settings.SSE_HEARTBEAT_SECONDS),
+    ))
@@ -0,0 +1,92 @@
+"""
+Conditional GETs for the endpoints clients poll.
+
+The feed, post detail and leaderboard answer `If-None-Match` with a 304
+before loading or serializing anything. Their ETags hash a cheap stamp of
+the data rather than the response body:
+
+- feed page: (id, updated_at) of the rows on the page, read with the page's
+  own index range scan but nothing else (pagination.page_stamp), and taken
+  from the loaded rows when the page is served in full;
+- post detail: the post's updated_at and the latest updated_at among its
+  comments (one row plus one index seek on comment_changed_idx);
+- leaderboard: leaderboard.stamp(), free for the in-memory index and one
+  ledger range scan for the database backend.
+
+Post.updated_at and Comment.updated_at move forward on edits and on every
+like, comment and recount update, so each stamp changes whenever the data
+behind the response does. is_liked depends on the viewer, so those ETags
+include the viewer's id; the viewer's own likes bump updated_at like
+anyone else's. Because the post detail stamp takes a MAX over comments it
+assumes the app servers' clocks agree to within the time between two
+changes to the same thread.
+
+The request path is part of every ETag, so page cursors, page sizes and
+comment window bounds each get their own.
+"""
+import hashlib
+
+from django.db.models import OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control
+
+from .models import Post, Comment
+
+
+def make_etag(request, stamp, viewer=True):
+    # The async views (feed/async_views.py) only ever render JSON
+    renderer = getattr(request, 'accepted_renderer', None)
+    parts = [request.get_full_path(), renderer.format if renderer else 'json', stamp]
+    if viewer:
+        parts.append(request.user.id if request.user.is_authenticated else None)
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+
+def is_conditional(request):
+    return 'HTTP_IF_NONE_MATCH' in request.META
+
+
+def not_modified(request, etag):
+    """A 304 response if the client's If-None-Match matches `etag`, else None."""
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def tag(response, etag):
+    """Send `etag` with a full response; clients must revalidate before reuse."""
+    response['ETag'] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def post_stamp(post_id):
+    """(updated_at, latest comment updated_at) of the post, or None if it does not exist."""
+    query = _post_stamp_query(post_id)
+    return query.first() if query is not None else None
+
+
+async def apost_stamp(post_id):
+    query = _post_stamp_query(post_id)
+    return await query.afirst() if query is not None else None
+
+
+def _post_stamp_query(post_id):
+    latest_comment = (
+        Comment.objects
+        .filter(post_id=OuterRef('pk'))
+        .order_by('-updated_at')
+        .values('updated_at')[:1]
+    )
+    try:
+        post = Post.objects.filter(pk=post_id)
+    except (TypeError, ValueError):
+        # Not a valid id; let the view answer 404 as usual
+        return None
+    return (
+        post.order_by('pk')
+        .annotate(comments_changed=Subquery(latest_comment))
+        .values_list('updated_at', 'comments_changed')
+    )
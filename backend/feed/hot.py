@@ -0,0 +1,64 @@
+"""
+The hot feed (`GET /api/posts/?sort=hot`): posts by likes and comments,
+decayed by age.
+
+A post's points are 1 + LIKE_WEIGHT * likes + COMMENT_WEIGHT * comments,
+and its hotness right now is
+
+    points * 2 ** (-age / HOT_HALF_LIFE_HOURS)
+
+`now` is the same for every post, so comparing hotness is comparing
+
+    log2(points) + (created_at - EPOCH) / half-life
+
+which does not change as time passes. That is Post.hot_score, indexed with
+id, so the hot feed is an index range scan paged like the newest-first one
+(HotCursorPagination), and decay never rewrites rows: every post loses
+hotness at the same rate, and a newer post starts higher in proportion.
+
+The score follows the counters incrementally: like, unlike, comment create
+and delete move it by log2(new points / old points) in the same UPDATE that
+moves the counters (see rescored()), and new posts get theirs in
+Post.save(). `manage.py refresh_hot_scores` recomputes every score from the
+counters and created_at; run it periodically to fold in rounding drift,
+and after changing HOT_HALF_LIFE_HOURS, which rescales every score.
+`manage.py recount` runs it when it had counters to fix.
+"""
+import math
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import ExpressionWrapper, F, FloatField, Value
+from django.db.models.functions import Greatest, Log
+
+EPOCH = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+
+LIKE_WEIGHT = 1
+COMMENT_WEIGHT = 2
+
+
+def points(like_count, comment_count):
+    """A post's points; also works on expressions (F() and friends)."""
+    return 1 + LIKE_WEIGHT * like_count + COMMENT_WEIGHT * comment_count
+
+
+def score(created_at, like_count, comment_count):
+    """The hot_score of a post with these counters."""
+    age = (created_at - EPOCH).total_seconds() / (settings.HOT_HALF_LIFE_HOURS * 3600)
+    # Counters that have drifted below zero count as none at all
+    return math.log2(max(points(like_count, comment_count), 1)) + age
+
+
+def rescored(like_count=F('like_count'), comment_count=F('comment_count')):
+    """
+    An update() value for hot_score when a post's counters change to
+    `like_count` / `comment_count` (expressions over the current row) in
+    the same UPDATE. A column on the right of SET reads the old value, so
+    this is the old score moved by log2(new points / old points).
+    """
+    old = Greatest(points(F('like_count'), F('comment_count')), 1)
+    new = Greatest(points(like_count, comment_count), 1)
+    return ExpressionWrapper(
+        F('hot_score') + Log(Value(2.0), new) - Log(Value(2.0), old),
+        output_field=FloatField(),
+    )
@@ -0,0 +1,398 @@
+"""
+Karma bookkeeping.
+
+Every karma-earning event is written to the KarmaTransaction ledger, and the
+same points are added to a per-user 5-minute KarmaBucket in the same
+transaction. The leaderboard reads the buckets and only falls back to the raw
+ledger for the partial bucket at the edge of the 24h window, so its result
+is exactly what summing the ledger would give.
+
+Each change is also announced through the `karma_changed` signal so that
+derived views (like the in-memory leaderboard index) can follow along.
+
+Ledger rows older than KARMA_LEDGER_RETENTION_DAYS are compacted into
+per-user daily totals (KarmaDaily) by `manage.py compact_karma`, so the
+ledger only holds recent history; all_time_totals() adds both together.
+
+Likes and unlikes do not touch the ledger themselves: they queue a
+`karma.credit` / `karma.revoke` outbox event in their transaction
+(credit_like / revoke_like) and the outbox worker applies it (see
+feed/outbox.py). Credits keep the time of the like, so a slow worker
+never moves karma to a later window.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Count, Exists, F, Max, OuterRef, Q, Sum, Value, When
+from django.dispatch import Signal
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import outbox
+from .models import PostLike, CommentLike, KarmaTransaction, KarmaBucket, KarmaDaily
+
+LEADERBOARD_WINDOW = timedelta(hours=24)
+BUCKET_SIZE = timedelta(minutes=KarmaBucket.BUCKET_MINUTES)
+
+# Sent with user_id, username (may be None), points and at (the ledger
+# timestamp the points belong to). Debits carry negative points and the
+# timestamp of the original credit.
+karma_changed = Signal()
+
+# Compaction never touches ledger rows younger than this. It marks the likes
+# whose rows it folds into KarmaDaily with `karma_compacted`.
+MIN_RETENTION_DAYS = 2
+
+# karma_type -> the like model it comes from (also the KarmaTransaction field)
+LIKE_SOURCES = {
+    'post_like': PostLike,
+    'comment_like': CommentLike,
+}
+
+
+def bucket_start(at):
+    """Round a timestamp down to the start of its rollup bucket."""
+    return at.replace(second=0, microsecond=0) - timedelta(
+        minutes=at.minute % KarmaBucket.BUCKET_MINUTES
+    )
+
+
+def credit(user_id, points, at):
+    """
+    Add `points` (negative to debit) to the user's bucket covering `at`.
+
+    Tries a plain UPDATE first since the bucket usually exists already. If two
+    requests race to create the same bucket, the loser's INSERT hits the unique
+    constraint and it retries as an UPDATE.
+    """
+    start = bucket_start(at)
+    bucket = KarmaBucket.objects.filter(user_id=user_id, bucket_start=start)
+    if bucket.update(points=F('points') + points):
+        return
+    try:
+        with transaction.atomic():
+            KarmaBucket.objects.create(user_id=user_id, bucket_start=start, points=points)
+    except IntegrityError:
+        bucket.update(points=F('points') + points)
+
+
+def add_to_rollup(model, period, deltas):
+    """
+    Add {(user_id, period value): points} to a per-user rollup table
+    (KarmaBucket by bucket_start, KarmaDaily by day) with a fixed number of
+    queries: make sure every row exists, then add all the deltas in one UPDATE.
+    """
+    deltas = {key: points for key, points in deltas.items() if points}
+    if not deltas:
+        return
+    model.objects.bulk_create(
+        [model(user_id=user_id, points=0, **{period: value}) for user_id, value in deltas],
+        ignore_conflicts=True,
+    )
+    matches = Q()
+    whens = []
+    for (user_id, value), points in deltas.items():
+        matches |= Q(user_id=user_id, **{period: value})
+        whens.append(When(user_id=user_id, then=Value(points), **{period: value}))
+    model.objects.filter(matches).update(
+        points=F('points') + Case(*whens, default=Value(0))
+    )
+
+
+def credit_many(entries):
+    """Apply many (user_id, points, at) credits to their buckets at once."""
+    deltas = defaultdict(int)
+    for user_id, points, at in entries:
+        deltas[(user_id, bucket_start(at))] += points
+    deltas = {key: points for key, points in deltas.items() if points}
+    if len(deltas) == 1:
+        ((user_id, start), points), = deltas.items()
+        credit(user_id, points, start)
+    else:
+        add_to_rollup(KarmaBucket, 'bucket_start', deltas)
+
+
+def record(user, karma_type, points, at=None, **source):
+    """
+    Write a ledger row and roll it into its bucket. `source` names the like
+    that earned it (post_like= / comment_like=, or their _id). Call inside a
+    transaction.
+    """
+    karma = KarmaTransaction.objects.create(
+        user=user,
+        karma_type=karma_type,
+        points=points,
+        created_at=at or timezone.now(),
+        **source
+    )
+    credit(user.id, points, karma.created_at)
+    karma_changed.send(
+        sender=KarmaTransaction,
+        user_id=user.id,
+        username=user.username,
+        points=points,
+        at=karma.created_at,
+    )
+    return karma
+
+
+def revoke(transactions):
+    """
+    Delete the given ledger rows and take their points back out of the
+    buckets they were originally counted in. Call inside a transaction.
+    """
+    # Locked so compaction cannot fold them into KarmaDaily at the same time
+    rows = list(transactions.select_for_update().values_list('id', 'user_id', 'points', 'created_at'))
+    if not rows:
+        return 0
+
+    KarmaTransaction.objects.filter(id__in=[row[0] for row in rows]).delete()
+
+    credit_many([(user_id, -points, created_at) for _, user_id, points, created_at in rows])
+
+    for _, user_id, points, created_at in rows:
+        karma_changed.send(
+            sender=KarmaTransaction,
+            user_id=user_id,
+            username=None,
+            points=-points,
+            at=created_at,
+        )
+    return len(rows)
+
+
+def window_totals(now=None):
+    """
+    Karma per user over the last 24 hours, as {user_id: points}.
+
+    Whole buckets inside the window come from KarmaBucket; the bucket that
+    straddles the cutoff is replaced by the exact ledger rows on the inside
+    of the cutoff.
+    """
+    now = now or timezone.now()
+    cutoff = now - LEADERBOARD_WINDOW
+    edge_end = bucket_start(cutoff)
+    if edge_end < cutoff:
+        edge_end += BUCKET_SIZE
+
+    totals = defaultdict(int)
+    bucket_sums = (
+        KarmaBucket.objects
+        .filter(bucket_start__gte=edge_end)
+        .values('user_id')
+        .annotate(total=Sum('points'))
+        .values_list('user_id', 'total')
+    )
+    for user_id, total in bucket_sums:
+        totals[user_id] += total
+
+    if edge_end > cutoff:
+        edge_sums = (
+            KarmaTransaction.objects
+            .filter(created_at__gte=cutoff, created_at__lt=edge_end)
+            .values('user_id')
+            .annotate(total=Sum('points'))
+            .values_list('user_id', 'total')
+        )
+        for user_id, total in edge_sums:
+            totals[user_id] += total
+
+    return {user_id: total for user_id, total in totals.items() if total}
+
+
+def top_users(limit=5, now=None):
+    """Leaderboard rows for the top `limit` users by 24h karma."""
+    totals = window_totals(now)
+    ranked = sorted(totals.items(), key=lambda entry: (-entry[1], entry[0]))[:limit]
+    usernames = dict(
+        User.objects.filter(id__in=[user_id for user_id, _ in ranked])
+        .values_list('id', 'username')
+    )
+    return [
+        {
+            'id': user_id,
+            'username': usernames.get(user_id),
+            'karma_24h': total,
+            'rank': idx + 1
+        }
+        for idx, (user_id, total) in enumerate(ranked)
+    ]
+
+
+def window_stamp(now=None):
+    """
+    (row count, highest id) of the ledger rows inside the leaderboard window.
+    Changes whenever window_totals() can: a credit raises the highest id, a
+    revoke or a row leaving the window lowers the count. One index range
+    scan, no grouping.
+    """
+    stamp = _window_stamp_query(now).aggregate(rows=Count('id'), last=Max('id'))
+    return stamp['rows'], stamp['last']
+
+
+async def awindow_stamp(now=None):
+    stamp = await _window_stamp_query(now).aaggregate(rows=Count('id'), last=Max('id'))
+    return stamp['rows'], stamp['last']
+
+
+def _window_stamp_query(now):
+    now = now or timezone.now()
+    return KarmaTransaction.objects.filter(created_at__gte=now - LEADERBOARD_WINDOW).order_by()
+
+
+def credit_event(like, recipient_id, username, karma_type, points):
+    """The (key, payload) of the outbox event crediting `recipient_id` for `like`."""
+    return f'{karma_type}:{like.id}:credit', {
+        'karma_type': karma_type,
+        'like_id': like.id,
+        'user_id': recipient_id,
+        'username': username,
+        'points': points,
+        'at': like.created_at.isoformat(),
+    }
+
+
+def revoke_event(like, recipient_id, karma_type, points):
+    """The (key, payload) of the outbox event taking back the karma of a deleted like."""
+    return f'{karma_type}:{like.id}:revoke', {
+        'karma_type': karma_type,
+        'like_id': like.id,
+        # Enough to find the karma again if its ledger row was compacted
+        'user_id': recipient_id,
+        'points': points,
+        'at': like.created_at.isoformat(),
+        'compacted': like.karma_compacted,
+    }
+
+
+def credit_like(like, recipient, karma_type, points):
+    """Queue karma for `recipient` earned by a new like. Call inside a transaction."""
+    outbox.enqueue('karma.credit', *credit_event(like, recipient.id, recipient.username, karma_type, points))
+
+
+def revoke_like(like, recipient, karma_type, points):
+    """Queue taking back the karma of a deleted like. Call inside a transaction."""
+    outbox.enqueue('karma.revoke', *revoke_event(like, recipient.id, karma_type, points))
+
+
+@outbox.handler('karma.credit')
+def apply_credit(payload):
+    like_model = LIKE_SOURCES[payload['karma_type']]
+    # Lock the like so an unlike cannot delete it halfway through; if it is
+    # already gone, its revoke event has nothing to take back either.
+    if not like_model.objects.select_for_update().filter(pk=payload['like_id']).exists():
+        return
+    record(
+        User(id=payload['user_id'], username=payload['username']),
+        payload['karma_type'],
+        payload['points'],
+        at=parse_datetime(payload['at']),
+        **{f"{payload['karma_type']}_id": payload['like_id']},
+    )
+
+
+@outbox.handler('karma.revoke')
+def apply_revoke(payload):
+    revoked = revoke(KarmaTransaction.objects.filter(**{f"{payload['karma_type']}_id": payload['like_id']}))
+    if not revoked and payload.get('compacted'):
+        # The like's ledger row has been compacted into its daily total. A
+        # like whose credit never got applied (still queued, or parked) has
+        # neither, and nothing to take back.
+        revoke_compacted([(payload['user_id'], payload['points'], parse_datetime(payload['at']))])
+
+
+def utc_day(at):
+    return at.astimezone(dt_timezone.utc).date()
+
+
+def compaction_cutoff(now=None, days=None):
+    """
+    Ledger rows created before this are compacted: the start of the UTC day
+    `days` (default KARMA_LEDGER_RETENTION_DAYS) days ago. Never less than
+    MIN_RETENTION_DAYS, so the leaderboard window always stays in the ledger.
+    """
+    now = now or timezone.now()
+    if days is None:
+        days = settings.KARMA_LEDGER_RETENTION_DAYS
+    days = max(days, MIN_RETENTION_DAYS)
+    return datetime.combine(utc_day(now - timedelta(days=days)), time.min, tzinfo=dt_timezone.utc)
+
+
+def compact(cutoff, batch_size):
+    """
+    Fold up to `batch_size` ledger rows created before `cutoff` into
+    KarmaDaily and delete them. Returns the number of rows compacted.
+    Call inside a transaction; keep batches small to keep locks short.
+    """
+    rows = list(
+        KarmaTransaction.objects
+        .filter(created_at__lt=cutoff)
+        # Rows of deleted likes are left for their revoke event to delete
+        .filter(
+            Q(post_like__isnull=True) | Exists(PostLike.objects.filter(pk=OuterRef('post_like_id'))),
+            Q(comment_like__isnull=True) | Exists(CommentLike.objects.filter(pk=OuterRef('comment_like_id'))),
+        )
+        .order_by()
+        .select_for_update(skip_locked=True)
+        .values_list('id', 'user_id', 'points', 'created_at', 'post_like_id', 'comment_like_id')[:batch_size]
+    )
+    if not rows:
+        return 0
+
+    # Mark the likes, so unliking takes their karma back out of KarmaDaily.
+    # Locking them first means an unlike either deletes a like before this
+    # (and its row is skipped) or sees the mark.
+    kept = set()
+    for like_model, position in ((PostLike, 4), (CommentLike, 5)):
+        like_ids = [row[position] for row in rows if row[position] is not None]
+        if like_ids:
+            locked = list(like_model.objects.select_for_update().filter(id__in=like_ids).values_list('id', flat=True))
+            like_model.objects.filter(id__in=locked).update(karma_compacted=True)
+            kept.update((position, like_id) for like_id in locked)
+    rows = [
+        row for row in rows
+        if (row[4] is None or (4, row[4]) in kept) and (row[5] is None or (5, row[5]) in kept)
+    ]
+
+    deltas = defaultdict(int)
+    for _, user_id, points, created_at, _, _ in rows:
+        deltas[(user_id, utc_day(created_at))] += points
+    add_to_rollup(KarmaDaily, 'day', deltas)
+    KarmaTransaction.objects.filter(id__in=[row[0] for row in rows]).delete()
+    return len(rows)
+
+
+def revoke_compacted(entries):
+    """Take (user_id, points, at) karma back out of the daily totals."""
+    deltas = defaultdict(int)
+    for user_id, points, at in entries:
+        deltas[(user_id, utc_day(at))] -= points
+    add_to_rollup(KarmaDaily, 'day', deltas)
+
+
+def revoke_compacted_likes(likes, recipient, points):
+    """
+    Take back the karma of the likes in `likes` (a PostLike / CommentLike
+    queryset) whose ledger rows were already compacted. `recipient` is the
+    lookup of the credited user, e.g. 'post__author_id'. Call after
+    revoke() has deleted the ledger rows of the rest: it waits for a
+    compaction holding them, which has then marked their likes.
+    """
+    rows = likes.filter(karma_compacted=True).values_list(recipient, 'created_at')
+    revoke_compacted([(user_id, points, at) for user_id, at in rows])
+
+
+def all_time_totals(user_ids=None):
+    """Karma per user over all time, as {user_id: points}: daily totals plus the ledger."""
+    totals = defaultdict(int)
+    for model in (KarmaDaily, KarmaTransaction):
+        rows = model.objects.all()
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        sums = rows.order_by().values('user_id').annotate(total=Sum('points')).values_list('user_id', 'total')
+        for user_id, total in sums:
+            totals[user_id] += total
+    return {user_id: total for user_id, total in totals.items() if total}
@@ -0,0 +1,334 @@
+"""
+Leaderboard backends.
+
+The leaderboard is read far more often than karma changes, so by default it
+is served from an in-process index instead of the database:
+
+- `MemoryLeaderboard` keeps every karma event of the last 24 hours in a
+  min-heap by timestamp (so events can be expired exactly as they leave the
+  window) and a list of (-karma, user_id) kept sorted with bisect, so top-N
+  is a slice. It follows `karma.karma_changed` after each commit and is
+  rebuilt on first use and every LEADERBOARD_INDEX_MAX_AGE seconds from the
+  KarmaBucket rollups, with ledger rows only at the old edge of the window
+  (see MemoryLeaderboard.load). The rebuild also picks up writes made by
+  other processes - including the outbox worker, which writes the karma
+  for likes - that this process never sees directly. A stale index is
+  rebuilt by one request while the others keep serving it; the new index
+  is built aside and swapped in.
+
+- `DatabaseLeaderboard` always asks the database (karma.top_users).
+
+Both offer `stamp(limit)`, a cheap value that changes whenever `top(limit)`
+would, for the leaderboard's ETag, and `atop` / `astamp` for async views.
+
+Pick one with the LEADERBOARD_BACKEND setting.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import karma
+from .models import KarmaTransaction, KarmaBucket
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseLeaderboard:
+    """Compute the leaderboard from the karma rollups on every request."""
+
+    def top(self, limit, now=None):
+        return karma.top_users(limit=limit, now=now)
+
+    def stamp(self, limit, now=None):
+        return karma.window_stamp(now)
+
+    async def atop(self, limit):
+        # Several grouped queries; not worth duplicating for the async ORM
+        return await sync_to_async(self.top)(limit)
+
+    async def astamp(self, limit):
+        return await karma.awindow_stamp()
+
+    def apply(self, user_id, username, points, at):
+        pass
+
+
+class _Index:
+    """The state of a MemoryLeaderboard; rebuilt aside and swapped in whole."""
+
+    def __init__(self):
+        self.events = []        # heap of (at, seq, user_id, points)
+        self.seq = itertools.count()
+        self.totals = {}        # user_id -> karma in window
+        self.ranking = []       # sorted (-karma, user_id)
+        self.usernames = {}
+
+    def adjust(self, user_id, delta):
+        old = self.totals.get(user_id, 0)
+        if old:
+            del self.ranking[bisect_left(self.ranking, (-old, user_id))]
+        new = old + delta
+        if new:
+            self.totals[user_id] = new
+            insort(self.ranking, (-new, user_id))
+        else:
+            self.totals.pop(user_id, None)
+
+    def push(self, user_id, points, at):
+        heapq.heappush(self.events, (at, next(self.seq), user_id, points))
+        self.adjust(user_id, points)
+
+    def expire(self, cutoff):
+        while self.events and self.events[0][0] < cutoff:
+            _, _, user_id, points = heapq.heappop(self.events)
+            self.adjust(user_id, -points)
+
+
+class MemoryLeaderboard:
+    """Per-process rolling-window karma index, updated incrementally."""
+
+    def __init__(self, window=karma.LEADERBOARD_WINDOW, max_age=None):
+        self.window = window
+        if max_age is None:
+            max_age = settings.LEADERBOARD_INDEX_MAX_AGE
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        # Held across a whole rebuild (load and swap), so rebuilds and
+        # resets never interleave; readers only need _lock
+        self._rebuild_lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._rebuild_lock, self._lock:
+            self._index = _Index()
+            self._pending = None
+            self.built_at = None
+
+    def expire(self, now=None):
+        cutoff = (now or timezone.now()) - self.window
+        with self._lock:
+            self._index.expire(cutoff)
+
+    def apply(self, user_id, username, points, at):
+        """
+        Apply one committed karma change. Debits come in with the original
+        credit's timestamp, so they leave the window together with it; a
+        debit for a credit that already expired is simply dropped.
+        """
+        with self._lock:
+            if self.built_at is None and self._pending is None:
+                # Cold index: the next rebuild reads this change from the ledger
+                return
+            if at < timezone.now() - self.window:
+                return
+            if self._pending is not None:
+                # A rebuild is loading; replay this on the index it builds
+                self._pending.append((user_id, username, points, at))
+            if self.built_at is not None:
+                if username:
+                    self._index.usernames[user_id] = username
+                self._index.push(user_id, points, at)
+
+    def load(self, now=None):
+        """
+        Read the window's karma for a rebuild, as (user_id, username,
+        points, at) rows: the KarmaBucket rollups, except at the old end of
+        the window, where the partial bucket the cutoff falls in and the
+        one after it come from the ledger. A bucket is indexed at its start
+        and leaves the index as the cutoff passes that, so the index stays
+        exact as long as it is rebuilt within one bucket of loading.
+        """
+        now = now or timezone.now()
+        cutoff = now - self.window
+        raw_end = karma.bucket_start(cutoff) + 2 * karma.BUCKET_SIZE
+        raw = (
+            KarmaTransaction.objects
+            .filter(created_at__gte=cutoff, created_at__lt=raw_end)
+            .order_by()
+            .values_list('user_id', 'user__username', 'points', 'created_at')
+        )
+        buckets = (
+            KarmaBucket.objects
+            .filter(bucket_start__gte=raw_end)
+            .exclude(points=0)
+            .order_by()
+            .values_list('user_id', 'user__username', 'points', 'bucket_start')
+        )
+        return list(raw.iterator(chunk_size=2000)) + list(buckets.iterator(chunk_size=2000))
+
+    def rebuild(self, now=None):
+        with self._rebuild_lock:
+            with self._lock:
+                self._pending = []
+            try:
+                rows = self.load(now)
+                index = _Index()
+                for user_id, username, points, at in rows:
+                    index.usernames[user_id] = username
+                    index.push(user_id, points, at)
+                with self._lock:
+                    previous, self._index = self._index, index
+                    pending = self._pending
+                    for user_id, username, points, at in pending:
+                        if username:
+                            index.usernames[user_id] = username
+                        index.push(user_id, points, at)
+                    resync = self.built_at is not None
+                    self.built_at = time.monotonic()
+            finally:
+                with self._lock:
+                    self._pending = None
+        if resync and settings.OUTBOX_SYNC:
+            # Periodic resync: report how far the old index had drifted. With
+            # an outbox worker the karma for likes is written by that
+            # process, so the index is expected to trail until the resync
+            self._report_drift(previous, rows + pending, now)
+
+    def is_stale(self):
+        if self.built_at is None:
+            return True
+        return time.monotonic() - self.built_at > self.max_age
+
+    def refresh(self, now=None):
+        """
+        Rebuild the index if it is stale. A cold index is built before
+        anything is served; a warm but stale one is rebuilt by one caller
+        while the others keep serving it as it is.
+        """
+        if self.built_at is None:
+            with self._rebuild_lock:
+                if self.built_at is None:
+                    self.rebuild(now)
+        elif self.is_stale() and self._rebuild_lock.acquire(blocking=False):
+            try:
+                if self.is_stale():
+                    self.rebuild(now)
+            finally:
+                self._rebuild_lock.release()
+
+    def needs_refresh(self):
+        """Whether refresh() would rebuild now (for async callers)."""
+        return self.built_at is None or (self.is_stale() and self._pending is None)
+
+    def totals(self, now=None):
+        self.refresh(now)
+        self.expire(now)
+        with self._lock:
+            return dict(self._index.totals)
+
+    def top(self, limit, now=None):
+        self.refresh(now)
+        return self._serve(limit, now)
+
+    def _serve(self, limit, now=None):
+        """The top `limit` users in the index as it is, without refreshing it."""
+        self.expire(now)
+        with self._lock:
+            index = self._index
+            return [
+                {
+                    'id': user_id,
+                    'username': index.usernames.get(user_id),
+                    'karma_24h': -negative_karma,
+                    'rank': idx + 1
+                }
+                for idx, (negative_karma, user_id) in enumerate(index.ranking[:limit])
+            ]
+
+    def stamp(self, limit, now=None):
+        # The ranking itself costs nothing to read here, and unlike the
+        # ledger it is exactly what top() will serve
+        return [tuple(row.values()) for row in self.top(limit, now)]
+
+    async def atop(self, limit):
+        # Only a rebuild touches the database, so it runs in a thread and
+        # the index is then read straight from the event loop
+        if self.needs_refresh():
+            await sync_to_async(self.refresh)()
+        return self._serve(limit)
+
+    async def astamp(self, limit):
+        return [tuple(row.values()) for row in await self.atop(limit)]
+
+    def check(self, now=None, rows=None):
+        """
+        Compare the index with the database and log any drift. Returns
+        {user_id: (indexed, actual)} for mismatched users.
+        """
+        now = now or timezone.now()
+        if rows is None:
+            rows = self.load(now)
+        self.expire(now)
+        return self._report_drift(self._index, rows, now)
+
+    def _report_drift(self, index, rows, now):
+        cutoff = (now or timezone.now()) - self.window
+        actual = {}
+        for user_id, _, points, _ in rows:
+            actual[user_id] = actual.get(user_id, 0) + points
+        actual = {user_id: total for user_id, total in actual.items() if total}
+
+        with self._lock:
+            index.expire(cutoff)
+            indexed = dict(index.totals)
+        mismatches = {
+            user_id: (indexed.get(user_id, 0), actual.get(user_id, 0))
+            for user_id in indexed.keys() | actual.keys()
+            if indexed.get(user_id, 0) != actual.get(user_id, 0)
+        }
+        if mismatches:
+            logger.warning('Leaderboard index drifted for %d user(s)', len(mismatches))
+        return mismatches
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = import_string(settings.LEADERBOARD_BACKEND)()
+    return _backend
+
+
+def top_users(limit=5):
+    return get_backend().top(limit)
+
+
+def stamp(limit=5):
+    return get_backend().stamp(limit)
+
+
+async def atop_users(limit=5):
+    return await get_backend().atop(limit)
+
+
+async def astamp(limit=5):
+    return await get_backend().astamp(limit)
+
+
+def reset():
+    """Drop the index (and forget the configured backend), e.g. between tests."""
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+@receiver(karma.karma_changed)
+def follow_karma(sender, user_id, username, points, at, **kwargs):
+    backend = get_backend()
+    # Only apply what actually commits; a rolled-back like never happened.
+    transaction.on_commit(lambda: backend.apply(user_id, username, points, at))
@@ -0,0 +1,321 @@
+"""
+Likes on posts and comments.
+
+like() / unlike() are the one way a single like is added or removed. They
+are idempotent and never lean on a failing INSERT: adding is a single
+
+    INSERT ... ON CONFLICT (user_id, post_id) DO NOTHING RETURNING id
+
+(INSERT OR IGNORE on SQLite builds without RETURNING), removing a single
+DELETE ... RETURNING, so a storm of duplicate taps costs neither an
+exception nor a savepoint rollback. Run them inside a transaction.
+
+Which objects the viewer has liked: instead of annotating every row with an
+Exists(...) subquery, views fetch the viewer's liked ids among the objects
+they are about to serialize in one query and hand the set to the
+serializers through the context, under `liked_post_ids` /
+`liked_comment_ids`.
+
+Liking and unliking many objects at once (like_many / unlike_many) takes a
+fixed number of queries however many ids are given. Run them inside a
+transaction.
+"""
+from datetime import timezone as dt_timezone
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import hot, karma, live, outbox, tree_cache
+from .models import Post, Comment, PostLike, CommentLike, KarmaTransaction
+
+# model -> (like model, foreign key column, serializer context key)
+LIKE_TARGETS = {
+    Post: (PostLike, 'post_id', 'liked_post_ids'),
+    Comment: (CommentLike, 'comment_id', 'liked_comment_ids'),
+}
+
+# model -> (karma type, points, KarmaTransaction foreign key)
+LIKE_KARMA = {
+    Post: ('post_like', KarmaTransaction.KARMA_POST_LIKE, 'post_like'),
+    Comment: ('comment_like', KarmaTransaction.KARMA_COMMENT_LIKE, 'comment_like'),
+}
+
+# Largest number of ids accepted by like_many / unlike_many
+MAX_BATCH = 100
+
+
+def context_key(model):
+    return LIKE_TARGETS[model][2]
+
+
+def liked_ids(user, model, ids):
+    """
+    The subset of `ids` (primary keys of `model`) that `user` has liked.
+    One indexed lookup on the (user, target) unique constraint; no query
+    at all for anonymous users or an empty `ids`.
+    """
+    query = _liked_query(user, model, ids)
+    return set(query) if query is not None else set()
+
+
+async def aliked_ids(user, model, ids):
+    """liked_ids() for async views."""
+    query = _liked_query(user, model, ids)
+    return {target_id async for target_id in query} if query is not None else set()
+
+
+def _liked_query(user, model, ids):
+    if user is None or not user.is_authenticated:
+        return None
+    ids = list(ids)
+    if not ids:
+        return None
+    like_model, column, _ = LIKE_TARGETS[model]
+    return (
+        like_model.objects
+        .filter(user=user, **{f'{column}__in': ids})
+        .values_list(column, flat=True)
+    )
+
+
+def _can_return():
+    # Postgres, and SQLite from 3.35
+    return connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_rows_from_bulk_insert
+
+
+def _insert_like(like_model, column, user_id, target_id):
+    """Insert the like unless it exists. Returns the new like, or None."""
+    now = timezone.now()
+    meta = like_model._meta
+    table = connection.ops.quote_name(meta.db_table)
+    user_column = meta.get_field('user').column
+    params = [user_id, target_id, meta.get_field('created_at').get_db_prep_value(now, connection), False]
+    columns = f'{user_column}, {column}, created_at, karma_compacted'
+
+    if _can_return():
+        sql = (
+            f'INSERT INTO {table} ({columns}) VALUES (%s, %s, %s, %s) '
+            f'ON CONFLICT ({user_column}, {column}) DO NOTHING RETURNING id'
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        like_id = row[0] if row else None
+    elif connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(f'INSERT OR IGNORE INTO {table} ({columns}) VALUES (%s, %s, %s, %s)', params)
+            like_id = cursor.lastrowid if cursor.rowcount == 1 else None
+    else:
+        try:
+            with transaction.atomic():
+                like_id = like_model.objects.create(user_id=user_id, **{column: target_id}).id
+        except IntegrityError:
+            like_id = None
+
+    if like_id is None:
+        return None
+    return like_model(id=like_id, user_id=user_id, created_at=now, **{column: target_id})
+
+
+def _delete_like(like_model, column, user_id, target_id):
+    """Delete the like if it exists. Returns the deleted like, or None."""
+    if not _can_return():
+        like = like_model.objects.filter(user_id=user_id, **{column: target_id}).first()
+        if like is not None:
+            like_model.objects.filter(pk=like.pk).delete()
+        return like
+
+    meta = like_model._meta
+    table = connection.ops.quote_name(meta.db_table)
+    user_column = meta.get_field('user').column
+    sql = (
+        f'DELETE FROM {table} WHERE {user_column} = %s AND {column} = %s '
+        f'RETURNING id, created_at, karma_compacted'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [user_id, target_id])
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    like_id, created_at, karma_compacted = row
+    if isinstance(created_at, str):
+        created_at = parse_datetime(created_at)
+    if timezone.is_naive(created_at):
+        created_at = timezone.make_aware(created_at, dt_timezone.utc)
+    return like_model(
+        id=like_id, user_id=user_id, created_at=created_at, karma_compacted=bool(karma_compacted),
+        **{column: target_id}
+    )
+
+
+def like(user, target):
+    """
+    Like `target` (a Post or Comment, with its author loaded) as `user` and
+    queue the author's karma. Returns False if the like already existed.
+    """
+    model = type(target)
+    like_model, column, _ = LIKE_TARGETS[model]
+    karma_type, points, _ = LIKE_KARMA[model]
+
+    new_like = _insert_like(like_model, column, user.id, target.id)
+    if new_like is None:
+        return False
+    _set_like_count(model, model.objects.filter(pk=target.pk), F('like_count') + 1)
+    karma.credit_like(new_like, target.author, karma_type, points)
+    if model is Comment:
+        # Raw SQL skips the tree cache's model signals
+        tree_cache.invalidate(target.post_id)
+    live.likes_changed(model, {target.id: target.post_id if model is Comment else target.id})
+    return True
+
+
+def unlike(user, target):
+    """
+    Remove `user`'s like from `target` and queue taking the author's karma
+    back. Returns False if there was no like.
+    """
+    model = type(target)
+    like_model, column, _ = LIKE_TARGETS[model]
+    karma_type, points, _ = LIKE_KARMA[model]
+
+    # The DELETE locks the like, so the outbox worker cannot be crediting it
+    old_like = _delete_like(like_model, column, user.id, target.id)
+    if old_like is None:
+        return False
+    _set_like_count(model, model.objects.filter(pk=target.pk), F('like_count') - 1)
+    karma.revoke_like(old_like, target.author, karma_type, points)
+    if model is Comment:
+        tree_cache.invalidate(target.post_id)
+    live.likes_changed(model, {target.id: target.post_id if model is Comment else target.id})
+    return True
+
+
+
+def _targets(model, ids):
+    fields = ['id', 'author_id', 'author__username']
+    if model is Comment:
+        fields.append('post_id')
+    rows = model.objects.filter(id__in=ids).order_by().values(*fields)
+    return {row['id']: row for row in rows}
+
+
+def _set_like_count(model, queryset, like_count):
+    """Set like_count of `queryset` to the expression `like_count`, with a post's hot score."""
+    changes = {'like_count': like_count, 'updated_at': timezone.now()}
+    if model is Post:
+        changes['hot_score'] = hot.rescored(like_count=like_count)
+    queryset.update(**changes)
+
+
+def _recount(model, target_ids):
+    """Set like_count of the given objects from their like rows, in one UPDATE."""
+    like_model, column, _ = LIKE_TARGETS[model]
+    _set_like_count(model, model.objects.filter(id__in=target_ids), Coalesce(
+        Subquery(
+            like_model.objects.filter(**{column: OuterRef('pk')})
+            .order_by()
+            .values(column)
+            .annotate(n=Count('id'))
+            .values('n')
+        ),
+        0,
+    ))
+
+
+def _post_id_of(model, row):
+    return row['post_id'] if model is Comment else row['id']
+
+
+def _invalidate_trees(model, targets):
+    # bulk_create and queryset deletes skip the tree cache's model signals
+    if model is Comment:
+        for post_id in {row['post_id'] for row in targets}:
+            tree_cache.invalidate(post_id)
+
+
+def like_many(user, model, ids):
+    """
+    Like every `model` object in `ids` as `user`, queueing karma for the
+    authors. Returns {id: 'liked' | 'already_liked' | 'not_found'}.
+    """
+    like_model, column, _ = LIKE_TARGETS[model]
+    karma_type, points, _ = LIKE_KARMA[model]
+    ids = list(dict.fromkeys(ids))
+
+    targets = _targets(model, ids)
+    mine = like_model.objects.filter(user=user, **{f'{column}__in': list(targets)})
+    before = set(mine.values_list(column, flat=True))
+    like_model.objects.bulk_create(
+        [like_model(user=user, **{column: target_id}) for target_id in targets if target_id not in before],
+        ignore_conflicts=True,
+    )
+    # ignore_conflicts leaves us without the new rows' ids, so diff against
+    # what was there before. A like slipped in by a concurrent request could
+    # be taken for ours; its karma event has the same idempotency key and
+    # the counters are recounted, so that only affects the reported status.
+    created = [like for like in mine.only('id', column, 'created_at') if getattr(like, column) not in before]
+
+    liked = {getattr(like, column) for like in created}
+    if liked:
+        outbox.enqueue_many('karma.credit', [
+            karma.credit_event(
+                like,
+                targets[getattr(like, column)]['author_id'],
+                targets[getattr(like, column)]['author__username'],
+                karma_type,
+                points,
+            )
+            for like in created
+        ])
+        _recount(model, liked)
+        _invalidate_trees(model, [targets[target_id] for target_id in liked])
+        live.likes_changed(model, {target_id: _post_id_of(model, targets[target_id]) for target_id in liked})
+
+    return {
+        target_id: (
+            'not_found' if target_id not in targets
+            else 'liked' if target_id in liked
+            else 'already_liked'
+        )
+        for target_id in ids
+    }
+
+
+def unlike_many(user, model, ids):
+    """
+    Remove `user`'s likes from every `model` object in `ids`, queueing the
+    karma to be taken back. Returns {id: 'unliked' | 'not_liked' | 'not_found'}.
+    """
+    like_model, column, _ = LIKE_TARGETS[model]
+    karma_type, points, _ = LIKE_KARMA[model]
+    ids = list(dict.fromkeys(ids))
+
+    targets = _targets(model, ids)
+    found = list(
+        like_model.objects
+        .select_for_update()
+        .filter(user=user, **{f'{column}__in': list(targets)})
+        .only('id', column, 'created_at', 'karma_compacted')
+    )
+    unliked = {getattr(like, column) for like in found}
+    if found:
+        outbox.enqueue_many('karma.revoke', [
+            karma.revoke_event(like, targets[getattr(like, column)]['author_id'], karma_type, points)
+            for like in found
+        ])
+        like_model.objects.filter(id__in=[like.id for like in found]).delete()
+        _recount(model, unliked)
+        _invalidate_trees(model, [targets[target_id] for target_id in unliked])
+        live.likes_changed(model, {target_id: _post_id_of(model, targets[target_id]) for target_id in unliked})
+
+    return {
+        target_id: (
+            'not_found' if target_id not in targets
+            else 'unliked' if target_id in unliked
+            else 'not_liked'
+        )
+        for target_id in ids
+    }
@@ -0,0 +1,213 @@
+"""
+Live updates over server-sent events.
+
+GET /posts/{id}/stream/ and GET /leaderboard/stream/ hold the connection
+open and push compact deltas, so open tabs no longer have to poll:
+
+- `comment` (post stream): a new comment, rendered like the comments of
+  post detail, with its `parent`;
+- `like` (post stream): {'post': id} or {'comment': id} with the new
+  `like_count`;
+- `rank` (leaderboard stream): the new top 5, whenever it changes;
+- `reset`: events were missed and cannot be replayed; refetch.
+
+Events carry ids, which browsers send back as Last-Event-ID when they
+reconnect, and the stream resumes after that event (see pubsub.py). A
+comment line goes out every SSE_HEARTBEAT_SECONDS of silence so proxies
+keep idle streams open and dead ones are noticed; a stream that falls
+SSE_MAX_PENDING events behind is closed, and every stream ends after
+SSE_MAX_AGE_SECONDS. Either way the browser reconnects and resumes.
+
+Events are published once the transaction commits, and only for channels
+someone is (or was recently) watching, so unwatched posts cost nothing. A
+like event reads the counter back after the commit rather than trusting
+a delta.
+
+With the default in-process broker only changes made by this process are
+streamed. The leaderboard stream also rechecks the board on each
+heartbeat, which picks up karma applied by the outbox worker once the
+leaderboard index resyncs.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.http import StreamingHttpResponse
+
+from . import karma, pubsub, leaderboard as leaderboard_index
+from .models import Comment
+from .renderers import FastJSONRenderer
+from .serializers import render_comment_tree
+
+LEADERBOARD = 'leaderboard'
+
+OPEN = b': open\n\n'
+HEARTBEAT = b': ping\n\n'
+
+renderer = FastJSONRenderer()
+
+_last_top = None
+_last_checked = 0.0
+_last_top_lock = threading.Lock()
+
+
+def post_channel(post_id):
+    return f'post:{post_id}'
+
+
+def encode(event):
+    lines = []
+    if event.id is not None:
+        lines.append(f'id: {event.id}\n'.encode())
+    lines.append(f'event: {event.type}\n'.encode())
+    lines.append(b'data: ' + renderer.render(event.data) + b'\n\n')
+    return b''.join(lines)
+
+
+def last_event_id(request):
+    # EventSource sends the header when it reconnects; the query parameter
+    # lets a freshly opened page resume too
+    return request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('last_event_id')
+
+
+def events(subscription, on_idle=None):
+    """The SSE byte stream of `subscription`, for a WSGI worker thread."""
+    heartbeat = settings.SSE_HEARTBEAT_SECONDS
+    deadline = time.monotonic() + settings.SSE_MAX_AGE_SECONDS
+    try:
+        yield OPEN
+        while time.monotonic() < deadline:
+            try:
+                batch = subscription.get(min(heartbeat, max(0, deadline - time.monotonic())))
+            except pubsub.Overflow:
+                return
+            if batch:
+                yield b''.join(encode(event) for event in batch)
+            else:
+                if on_idle is not None:
+                    on_idle()
+                yield HEARTBEAT
+    finally:
+        subscription.close()
+
+
+async def aevents(subscription, on_idle=None):
+    """events() for the event loop; `on_idle` is a coroutine function."""
+    heartbeat = settings.SSE_HEARTBEAT_SECONDS
+    deadline = time.monotonic() + settings.SSE_MAX_AGE_SECONDS
+    try:
+        yield OPEN
+        while time.monotonic() < deadline:
+            try:
+                batch = await subscription.aget(min(heartbeat, max(0, deadline - time.monotonic())))
+            except pubsub.Overflow:
+                return
+            if batch:
+                yield b''.join(encode(event) for event in batch)
+            else:
+                if on_idle is not None:
+                    await on_idle()
+                yield HEARTBEAT
+    finally:
+        subscription.close()
+
+
+def stream_response(stream):
+    response = StreamingHttpResponse(stream, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def refresh_leaderboard(min_interval=0):
+    """
+    Publish the top 5 if anyone watches the leaderboard and it changed.
+    Does nothing if the board was checked less than `min_interval` seconds
+    ago, so idle streams share one check per heartbeat.
+    """
+    global _last_top, _last_checked
+    if not pubsub.is_watched(LEADERBOARD):
+        return
+    with _last_top_lock:
+        if time.monotonic() - _last_checked < min_interval:
+            return
+        _last_checked = time.monotonic()
+    top = leaderboard_index.top_users(limit=5)
+    with _last_top_lock:
+        if top == _last_top:
+            return
+        _last_top = top
+    pubsub.publish(LEADERBOARD, 'rank', {'top': top})
+
+
+def likes_changed(model, post_ids):
+    """
+    Announce new like counts once the transaction commits. `post_ids` maps
+    each liked or unliked `model` id to the post it belongs to.
+    """
+    if not post_ids:
+        return
+    post_ids = dict(post_ids)
+    transaction.on_commit(lambda: _publish_likes(model, post_ids))
+
+
+def _publish_likes(model, post_ids):
+    watched = {
+        target_id: post_id for target_id, post_id in post_ids.items()
+        if pubsub.is_watched(post_channel(post_id))
+    }
+    if not watched:
+        return
+    counts = model.objects.filter(pk__in=list(watched)).order_by().values_list('id', 'like_count')
+    key = 'comment' if model is Comment else 'post'
+    for target_id, like_count in counts:
+        pubsub.publish(post_channel(watched[target_id]), 'like', {key: target_id, 'like_count': like_count})
+
+
+@receiver(post_save, sender=Comment)
+def comment_created(sender, instance, created, raw=False, **kwargs):
+    if not created or raw:
+        return
+    channel = post_channel(instance.post_id)
+    if Comment.author.is_cached(instance):
+        username = instance.author.username
+    else:
+        username = None
+    transaction.on_commit(lambda: _publish_comment(channel, instance, username))
+
+
+def _publish_comment(channel, comment, username):
+    if not pubsub.is_watched(channel):
+        return
+    if username is None:
+        username = Comment.objects.filter(pk=comment.pk).values_list('author__username', flat=True).first()
+    node, = render_comment_tree([{
+        'id': comment.id,
+        'author_id': comment.author_id,
+        'author__username': username,
+        'content': comment.content,
+        'created_at': comment.created_at,
+        'parent_id': comment.parent_id,
+        'like_count': comment.like_count,
+        'descendant_count': comment.descendant_count,
+    }])
+    pubsub.publish(channel, 'comment', node)
+
+
+@receiver(karma.karma_changed)
+def follow_karma(sender, **kwargs):
+    # Runs after the leaderboard index has applied the change, since its
+    # receiver was connected (and so queues its on_commit callback) first
+    transaction.on_commit(refresh_leaderboard)
+
+
+def reset():
+    """Forget the last published leaderboard, e.g. between tests."""
+    global _last_top, _last_checked
+    with _last_top_lock:
+        _last_top = None
+        _last_checked = 0.0
@@ -0,0 +1,69 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from feed.karma import bucket_start
+from feed.models import KarmaTransaction, KarmaBucket
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the 5-minute KarmaBucket rollups from the KarmaTransaction '
+        'ledger. Only the leaderboard window is needed, so by default the last '
+        '24 hours are rebuilt and older buckets are pruned.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours',
+            type=int,
+            default=24,
+            help='How far back to rebuild buckets (default: 24).',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=2000,
+            help='Rows per bulk_create batch (default: 2000).',
+        )
+        parser.add_argument(
+            '--keep-old',
+            action='store_true',
+            help='Do not delete buckets older than the rebuilt range.',
+        )
+
+    def handle(self, *args, **options):
+        since = bucket_start(timezone.now() - timedelta(hours=options['hours']))
+
+        with transaction.atomic():
+            ledger = (
+                KarmaTransaction.objects
+                .filter(created_at__gte=since)
+                .order_by()
+                .values_list('user_id', 'created_at', 'points')
+            )
+            totals = defaultdict(int)
+            for user_id, created_at, points in ledger.iterator(chunk_size=options['batch_size']):
+                totals[(user_id, bucket_start(created_at))] += points
+
+            stale = KarmaBucket.objects.all()
+            if options['keep_old']:
+                stale = stale.filter(bucket_start__gte=since)
+            pruned, _ = stale.delete()
+
+            KarmaBucket.objects.bulk_create(
+                (
+                    KarmaBucket(user_id=user_id, bucket_start=start, points=points)
+                    for (user_id, start), points in totals.items()
+                    if points
+                ),
+                batch_size=options['batch_size'],
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {len(totals)} bucket(s) since {since:%Y-%m-%d %H:%M} '
+            f'(replaced {pruned}).'
+        ))
@@ -0,0 +1,142 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from feed.models import Comment
+from feed.serializers import CommentSerializer, render_comment_tree
+from feed.views import build_comment_tree
+
+
+def make_thread(size, depth, seed):
+    """
+    A synthetic thread of `size` comments, as both unsaved Comment instances
+    and the equivalent values() rows. Nothing touches the database.
+    """
+    rng = random.Random(seed)
+    authors = [User(id=i, username=f'user{i}') for i in range(1, 51)]
+    start = timezone.now() - timedelta(days=1)
+
+    rows = []
+    open_parents = []   # ids of comments that may still get replies
+    depths = {}
+    for comment_id in range(1, size + 1):
+        parent_id = None
+        if open_parents and rng.random() > 0.1:
+            parent_id = rng.choice(open_parents)
+        depths[comment_id] = depths[parent_id] + 1 if parent_id else 0
+        if depths[comment_id] < depth - 1:
+            open_parents.append(comment_id)
+        author = rng.choice(authors)
+        rows.append({
+            'id': comment_id,
+            'author_id': author.id,
+            'author__username': author.username,
+            'content': f'comment {comment_id} ' * rng.randint(1, 8),
+            'created_at': start + timedelta(milliseconds=comment_id * 37),
+            'parent_id': parent_id,
+            'like_count': rng.randint(0, 500),
+            'descendant_count': 0,
+            'more_replies': None,
+        })
+
+    # Parents come before their replies, so counting from the end adds up
+    # each subtree before its root is reached
+    by_row = {row['id']: row for row in rows}
+    for row in reversed(rows):
+        if row['parent_id']:
+            by_row[row['parent_id']]['descendant_count'] += row['descendant_count'] + 1
+
+    by_id = {author.id: author for author in authors}
+    comments = []
+    for row in rows:
+        comment = Comment(
+            id=row['id'],
+            author=by_id[row['author_id']],
+            content=row['content'],
+            created_at=row['created_at'],
+            parent_id=row['parent_id'],
+            like_count=row['like_count'],
+            descendant_count=row['descendant_count'],
+        )
+        comment.more_replies = None
+        comments.append(comment)
+    return comments, rows
+
+
+def best_of(func, repeat):
+    """(fastest time in seconds, result) over `repeat` calls of func()."""
+    best, result = None, None
+    for _ in range(max(1, repeat)):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the recursive CommentSerializer with render_comment_tree on '
+        'synthetic comment trees, and check that both produce the same JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='1000,10000,50000',
+            help='Comma-separated tree sizes (default: 1000,10000,50000).',
+        )
+        parser.add_argument(
+            '--depth',
+            type=int,
+            default=6,
+            help='Maximum nesting depth of the generated trees (default: 6).',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Runs per size; the best time is reported (default: 3).',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of integers')
+
+        request = APIRequestFactory().get('/')
+        request.user = AnonymousUser()
+        context = {'request': request}
+        renderer = JSONRenderer()
+
+        self.stdout.write(f'{"nodes":>8} {"serializer":>12} {"renderer":>12} {"speedup":>8}')
+        for size in sizes:
+            comments, rows = make_thread(size, options['depth'], options['seed'])
+
+            def serialize():
+                return CommentSerializer(build_comment_tree(comments), many=True, context=context).data
+
+            def render():
+                return render_comment_tree(rows, context)
+
+            old_time, old = best_of(serialize, options['repeat'])
+            new_time, new = best_of(render, options['repeat'])
+
+            if renderer.render(old) != renderer.render(new):
+                raise CommandError(f'Output differs for the {size}-node tree')
+
+            self.stdout.write(
+                f'{size:>8} {old_time * 1000:>10.1f}ms {new_time * 1000:>10.1f}ms '
+                f'{old_time / new_time:>7.1f}x'
+            )
+
+        self.stdout.write(self.style.SUCCESS('Outputs are byte-identical.'))
@@ -0,0 +1,89 @@
+import io
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from feed import middleware
+from feed.parsers import FastJSONParser
+from feed.renderers import FastJSONRenderer, orjson
+from feed.serializers import render_comment_tree
+
+from .bench_comment_tree import best_of, make_thread
+
+
+class Command(BaseCommand):
+    help = (
+        'Time JSON rendering, parsing and gzip of synthetic rendered comment '
+        'trees: DRF JSONRenderer/JSONParser against FastJSONRenderer/'
+        'FastJSONParser, and compressing against reusing cached gzip bytes. '
+        'Fails if the renderers disagree on any byte.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes',
+            default='1000,10000,50000',
+            help='Comma-separated tree sizes (default: 1000,10000,50000).',
+        )
+        parser.add_argument(
+            '--depth',
+            type=int,
+            default=6,
+            help='Maximum nesting depth of the generated trees (default: 6).',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=3,
+            help='Runs per size; the best time is reported (default: 3).',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be a comma-separated list of integers')
+        if orjson is None:
+            self.stdout.write(self.style.WARNING(
+                'orjson is not installed: the fast renderer and parser fall back to the stdlib.'
+            ))
+
+        repeat = options['repeat']
+        cache = caches[settings.COMPRESSION_CACHE]
+
+        self.stdout.write(
+            f'{"nodes":>8} {"KiB":>8} {"render":>10} {"fast":>10} {"parse":>10} {"fast":>10} '
+            f'{"gzip":>10} {"cached":>10}'
+        )
+        for size in sizes:
+            _, rows = make_thread(size, options['depth'], options['seed'])
+            tree = render_comment_tree(rows)
+
+            slow_render, slow = best_of(lambda: JSONRenderer().render(tree), repeat)
+            fast_render, fast = best_of(lambda: FastJSONRenderer().render(tree), repeat)
+            if slow != fast:
+                raise CommandError(f'Rendered JSON differs for the {size}-node tree')
+
+            slow_parse, _ = best_of(lambda: JSONParser().parse(io.BytesIO(fast)), repeat)
+            fast_parse, parsed = best_of(lambda: FastJSONParser().parse(io.BytesIO(fast)), repeat)
+            if parsed != tree:
+                raise CommandError(f'Parsed JSON differs for the {size}-node tree')
+
+            gzip_time, _ = best_of(lambda: middleware.compress(fast), repeat)
+            cache.clear()
+            middleware.cached_compress(fast)
+            cached_time, _ = best_of(lambda: middleware.cached_compress(fast), repeat)
+
+            self.stdout.write(
+                f'{size:>8} {len(fast) / 1024:>8.0f} '
+                + ' '.join(
+                    f'{seconds * 1000:>8.1f}ms'
+                    for seconds in (slow_render, fast_render, slow_parse, fast_parse, gzip_time, cached_time)
+                )
+            )
+
+        self.stdout.write(self.style.SUCCESS('Rendered outputs are byte-identical.'))
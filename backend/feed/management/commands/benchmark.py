@@ -0,0 +1,368 @@
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+from datetime import timedelta
+from io import StringIO
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment,
+)
+from django.utils import timezone
+
+from feed import hot, leaderboard, pubsub, tree_cache
+from feed.models import Post, Comment, PostLike, CommentLike, KarmaTransaction
+
+
+def seed_dataset(users=200, posts=500, comments=10, thread_size=2000, thread_depth=12,
+                 likes=5000, karma_days=7, seed=0, batch_size=2000):
+    """
+    Insert a synthetic dataset with bulk_create and return what was made:
+
+    - `users` users and `posts` posts, each post with up to `comments`
+      comments in random threads;
+    - one viral post (the newest) with a `thread_size` comment tree up to
+      `thread_depth` levels deep, liked by every user (a like storm);
+    - `likes` more likes on random posts and comments, and their karma;
+    - `karma_days` days of older karma history for every user.
+
+    Counters, comment paths and karma buckets are filled in consistently, so
+    the API serves the data exactly as if it had been created through it.
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    first_user = (User.objects.aggregate(n=Max('id'))['n'] or 0) + 1
+    first_post = (Post.objects.aggregate(n=Max('id'))['n'] or 0) + 1
+    next_comment = (Comment.objects.aggregate(n=Max('id'))['n'] or 0) + 1
+
+    password = make_password(None)
+    user_ids = list(range(first_user, first_user + users))
+    post_ids = list(range(first_post, first_post + posts))
+    viral_id = post_ids[-1]
+    authors = {post_id: rng.choice(user_ids) for post_id in post_ids}
+
+    # Comment trees: rows of (id, post, parent, author, depth, path)
+    comment_rows = []
+    for post_id in post_ids:
+        size, depth = (thread_size, thread_depth) if post_id == viral_id else (rng.randint(0, comments), 4)
+        open_parents = []
+        for _ in range(size):
+            parent = rng.choice(open_parents) if open_parents and rng.random() > 0.2 else None
+            comment_id = next_comment
+            next_comment += 1
+            level = parent[4] + 1 if parent else 0
+            path = (parent[5] if parent else '') + Comment.path_segment(comment_id)
+            row = (comment_id, post_id, parent[0] if parent else None, rng.choice(user_ids), level, path)
+            comment_rows.append(row)
+            if level < depth - 1:
+                open_parents.append(row)
+    comment_authors = {row[0]: row[3] for row in comment_rows}
+
+    # Likes: the storm on the viral post, then random ones
+    post_likes = {(user_id, viral_id) for user_id in user_ids}
+    comment_likes = set()
+    comment_ids = list(comment_authors)
+    for _ in range(likes):
+        user_id = rng.choice(user_ids)
+        if comment_ids and rng.random() < 0.5:
+            comment_likes.add((user_id, rng.choice(comment_ids)))
+        else:
+            post_likes.add((user_id, rng.choice(post_ids)))
+    post_like_counts = Counter(post_id for _, post_id in post_likes)
+    comment_like_counts = Counter(comment_id for _, comment_id in comment_likes)
+    comment_counts = Counter(row[1] for row in comment_rows)
+    width = Comment.PATH_SEGMENT_WIDTH
+    descendant_counts = Counter(
+        int(row[5][i:i + width]) for row in comment_rows for i in range(0, len(row[5]) - width, width)
+    )
+
+    with transaction.atomic():
+        User.objects.bulk_create(
+            (User(id=user_id, username=f'bench{user_id}', password=password) for user_id in user_ids),
+            batch_size=batch_size,
+        )
+        Post.objects.bulk_create(
+            (
+                Post(
+                    id=post_id,
+                    author_id=authors[post_id],
+                    content=f'Benchmark post {post_id} ' * rng.randint(1, 12),
+                    like_count=post_like_counts[post_id],
+                    comment_count=comment_counts[post_id],
+                    hot_score=hot.score(now, post_like_counts[post_id], comment_counts[post_id]),
+                )
+                for post_id in post_ids
+            ),
+            batch_size=batch_size,
+        )
+        # Rows are in creation order, so parents always come first
+        Comment.objects.bulk_create(
+            (
+                Comment(
+                    id=comment_id, post_id=post_id, parent_id=parent_id, author_id=author_id,
+                    depth=level, path=path, content=f'Benchmark comment {comment_id}',
+                    like_count=comment_like_counts[comment_id],
+                    descendant_count=descendant_counts[comment_id],
+                )
+                for comment_id, post_id, parent_id, author_id, level, path in comment_rows
+            ),
+            batch_size=batch_size,
+        )
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, Post, Comment]):
+                cursor.execute(sql)
+
+        created_post_likes = PostLike.objects.bulk_create(
+            (PostLike(user_id=user_id, post_id=post_id) for user_id, post_id in post_likes),
+            batch_size=batch_size,
+        )
+        created_comment_likes = CommentLike.objects.bulk_create(
+            (CommentLike(user_id=user_id, comment_id=comment_id) for user_id, comment_id in comment_likes),
+            batch_size=batch_size,
+        )
+
+        # Karma for the likes (linked to them where the backend returns the
+        # new ids) plus older history spread over `karma_days` days
+        ledger = [
+            KarmaTransaction(
+                user_id=authors[like.post_id], karma_type='post_like',
+                points=KarmaTransaction.KARMA_POST_LIKE, created_at=now, post_like_id=like.pk,
+            )
+            for like in created_post_likes
+        ] + [
+            KarmaTransaction(
+                user_id=comment_authors[like.comment_id], karma_type='comment_like',
+                points=KarmaTransaction.KARMA_COMMENT_LIKE, created_at=now, comment_like_id=like.pk,
+            )
+            for like in created_comment_likes
+        ]
+        for user_id in user_ids:
+            for _ in range(karma_days):
+                ledger.append(KarmaTransaction(
+                    user_id=user_id, karma_type='post_like',
+                    points=KarmaTransaction.KARMA_POST_LIKE,
+                    created_at=now - timedelta(seconds=rng.randint(60, karma_days * 86400)),
+                ))
+        KarmaTransaction.objects.bulk_create(ledger, batch_size=batch_size)
+        call_command('backfill_karma_buckets', stdout=StringIO())
+
+    return {
+        'user_ids': user_ids,
+        'post_ids': post_ids,
+        'viral_post_id': viral_id,
+        'counts': {
+            'users': len(user_ids),
+            'posts': len(post_ids),
+            'comments': len(comment_rows),
+            'viral_thread_comments': comment_counts[viral_id],
+            'post_likes': len(post_likes),
+            'comment_likes': len(comment_likes),
+            'karma_transactions': len(ledger),
+        },
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def measure(client, requests, iterations, warmup=0):
+    """
+    Send `requests(i)` -> (method, path) through `client` and report latency
+    percentiles (ms), SQL statements and response sizes (bytes).
+    """
+    for i in range(warmup):
+        method, path = requests(i)
+        getattr(client, method)(path)
+
+    latencies, query_counts, sizes, statuses = [], [], [], Counter()
+    for i in range(warmup, warmup + iterations):
+        method, path = requests(i)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, method)(path)
+            latencies.append((time.perf_counter() - started) * 1000)
+        query_counts.append(len(queries))
+        sizes.append(len(response.content))
+        statuses[response.status_code] += 1
+
+    return {
+        'requests': iterations,
+        'status': {str(code): count for code, count in sorted(statuses.items())},
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies), 3),
+            'p50': round(percentile(latencies, 0.50), 3),
+            'p90': round(percentile(latencies, 0.90), 3),
+            'p99': round(percentile(latencies, 0.99), 3),
+            'max': round(max(latencies), 3),
+        },
+        'queries': {
+            'min': min(query_counts),
+            'max': max(query_counts),
+            'mean': round(statistics.fmean(query_counts), 2),
+        },
+        'bytes': {
+            'mean': round(statistics.fmean(sizes)),
+            'max': max(sizes),
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a synthetic dataset into a throwaway test database and measure '
+        'latency percentiles, SQL statements and response sizes of the feed, '
+        'post detail, like/unlike and leaderboard endpoints. Writes JSON, so '
+        'runs can be compared across commits.'
+    )
+
+    def add_arguments(self, parser):
+        dataset = parser.add_argument_group('dataset')
+        dataset.add_argument('--users', type=int, default=200, help='Users (default: 200).')
+        dataset.add_argument('--posts', type=int, default=500, help='Posts (default: 500).')
+        dataset.add_argument(
+            '--comments', type=int, default=10,
+            help='Up to this many comments per ordinary post (default: 10).',
+        )
+        dataset.add_argument(
+            '--thread-size', type=int, default=2000,
+            help='Comments on the viral post (default: 2000).',
+        )
+        dataset.add_argument(
+            '--thread-depth', type=int, default=12,
+            help='Maximum depth of the viral thread (default: 12).',
+        )
+        dataset.add_argument(
+            '--likes', type=int, default=5000,
+            help='Random likes on top of the like storm on the viral post (default: 5000).',
+        )
+        dataset.add_argument(
+            '--karma-days', type=int, default=7,
+            help='Days of older karma history per user (default: 7).',
+        )
+        dataset.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--iterations', type=int, default=100,
+            help='Measured requests per endpoint (default: 100).',
+        )
+        parser.add_argument(
+            '--warmup', type=int, default=5,
+            help='Unmeasured requests per endpoint first (default: 5).',
+        )
+        parser.add_argument(
+            '--output', default='-',
+            help='File to write the JSON results to (default: stdout).',
+        )
+
+    def handle(self, *args, **options):
+        if min(options['users'], options['posts'], options['iterations']) < 1:
+            raise CommandError('--users, --posts and --iterations must be positive')
+        dataset_options = {
+            name: options[name]
+            for name in ('users', 'posts', 'comments', 'thread_size', 'thread_depth', 'likes', 'karma_days', 'seed')
+        }
+
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            # Everything on the throwaway database, nothing left from before
+            with override_settings(REPLICA_DATABASES=[]):
+                tree_cache.get_cache().clear()
+                leaderboard.reset()
+                pubsub.reset()
+                started = time.perf_counter()
+                dataset = seed_dataset(**dataset_options)
+                seed_seconds = time.perf_counter() - started
+                endpoints = self.run_endpoints(dataset, options['iterations'], options['warmup'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        results = {
+            'meta': {
+                'git_commit': git_commit(),
+                'created_at': timezone.now().isoformat(),
+                'python': sys.version.split()[0],
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'options': {**dataset_options, 'iterations': options['iterations'], 'warmup': options['warmup']},
+                'seed_seconds': round(seed_seconds, 3),
+            },
+            'dataset': dataset['counts'],
+            'endpoints': endpoints,
+        }
+        output = json.dumps(results, indent=2)
+        if options['output'] == '-':
+            self.stdout.write(output)
+            return
+        with open(options['output'], 'w') as fh:
+            fh.write(output + '\n')
+        self.stdout.write(f'{"endpoint":<20} {"p50":>9} {"p99":>9} {"queries":>8} {"bytes":>9}')
+        for name, result in endpoints.items():
+            self.stdout.write(
+                f'{name:<20} {result["latency_ms"]["p50"]:>7.2f}ms {result["latency_ms"]["p99"]:>7.2f}ms '
+                f'{result["queries"]["max"]:>8} {result["bytes"]["mean"]:>9}'
+            )
+        self.stdout.write(self.style.SUCCESS(f'Wrote {options["output"]}.'))
+
+    def run_endpoints(self, dataset, iterations, warmup):
+        viewer = User.objects.get(pk=dataset['user_ids'][0])
+        client = Client()
+        client.force_login(viewer)
+        post_ids = dataset['post_ids']
+        viral_id = dataset['viral_post_id']
+
+        # A page deep in the feed, reached by following `next` links
+        path = '/api/posts/'
+        for _ in range(min(10, len(post_ids) // settings.FEED_PAGE_SIZE)):
+            path = client.get(path).json()['next'] or path
+        deep_page = path.replace('http://testserver', '')
+
+        # Posts the viewer has not liked, other than the viral one
+        liked = set(PostLike.objects.filter(user=viewer).values_list('post_id', flat=True))
+        targets = [post_id for post_id in post_ids if post_id not in liked and post_id != viral_id] or [viral_id]
+
+        results = {}
+        results['feed'] = measure(client, lambda i: ('get', '/api/posts/'), iterations, warmup)
+        results['feed_deep_page'] = measure(client, lambda i: ('get', deep_page), iterations, warmup)
+        results['detail'] = measure(
+            client, lambda i: ('get', f'/api/posts/{post_ids[i % len(post_ids)]}/'), iterations, warmup
+        )
+        results['detail_viral'] = measure(client, lambda i: ('get', f'/api/posts/{viral_id}/'), iterations, warmup)
+        # PUT then DELETE the same like, so every request changes something
+        results['like'] = measure(
+            client, lambda i: ('put', f'/api/posts/{targets[i % len(targets)]}/like/'), iterations, warmup
+        )
+        results['unlike'] = measure(
+            client, lambda i: ('delete', f'/api/posts/{targets[i % len(targets)]}/like/'), iterations, warmup
+        )
+        results['leaderboard'] = measure(client, lambda i: ('get', '/api/leaderboard/'), iterations, warmup)
+        return results
@@ -0,0 +1,78 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from feed import karma
+from feed.models import KarmaBucket
+
+
+class Command(BaseCommand):
+    help = (
+        'Fold KarmaTransaction rows older than KARMA_LEDGER_RETENTION_DAYS into '
+        'daily per-user totals and delete them, and prune KarmaBucket rollups '
+        'that have left the leaderboard window. Works in small batches, one '
+        'short transaction each.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=None,
+            help=(
+                'Keep this many days of ledger rows (default: '
+                f'KARMA_LEDGER_RETENTION_DAYS = {settings.KARMA_LEDGER_RETENTION_DAYS}).'
+            ),
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows per transaction (default: 1000).',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to sleep between batches, to go easy on a busy database.',
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        cutoff = karma.compaction_cutoff(now, options['days'])
+
+        compacted = 0
+        while True:
+            with transaction.atomic():
+                done = karma.compact(cutoff, options['batch_size'])
+            compacted += done
+            if done < options['batch_size']:
+                break
+            time.sleep(options['pause'])
+
+        # Buckets are only read inside the leaderboard window
+        bucket_cutoff = karma.bucket_start(now - karma.LEADERBOARD_WINDOW) - karma.BUCKET_SIZE
+        pruned = 0
+        while True:
+            with transaction.atomic():
+                ids = list(
+                    KarmaBucket.objects
+                    .filter(bucket_start__lt=bucket_cutoff)
+                    .order_by()
+                    .values_list('id', flat=True)[:options['batch_size']]
+                )
+                if ids:
+                    KarmaBucket.objects.filter(id__in=ids).delete()
+            pruned += len(ids)
+            if len(ids) < options['batch_size']:
+                break
+            time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Compacted {compacted} ledger row(s) before {cutoff:%Y-%m-%d} and '
+            f'pruned {pruned} old bucket(s).'
+        ))
+
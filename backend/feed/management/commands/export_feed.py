@@ -0,0 +1,102 @@
+import datetime
+import gzip
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from feed.models import Post, Comment, PostLike, CommentLike, KarmaTransaction, KarmaDaily
+
+FORMAT = 'playto-feed'
+VERSION = 1
+
+# (record type, model, exported columns, order) in the order they are
+# written, which is also the order import_feed has to insert them in:
+# every row comes after the rows it points at. Comments go by (post, path),
+# so a reply always follows its parent. Ids are only used to link records
+# up; import_feed gives every row a new one.
+SECTIONS = [
+    ('user', User, [
+        'id', 'username', 'password', 'email', 'first_name', 'last_name',
+        'is_active', 'is_staff', 'is_superuser', 'date_joined', 'last_login',
+    ], ['id']),
+    ('post', Post, [
+        'id', 'author_id', 'content', 'created_at', 'updated_at', 'like_count', 'comment_count',
+    ], ['id']),
+    ('comment', Comment, [
+        'id', 'post_id', 'parent_id', 'author_id', 'content', 'created_at', 'updated_at',
+        'like_count', 'descendant_count', 'path', 'depth',
+    ], ['post_id', 'path']),
+    ('post_like', PostLike, ['id', 'user_id', 'post_id', 'created_at', 'karma_compacted'], ['id']),
+    ('comment_like', CommentLike, ['id', 'user_id', 'comment_id', 'created_at', 'karma_compacted'], ['id']),
+    ('karma', KarmaTransaction, [
+        'user_id', 'karma_type', 'points', 'created_at', 'post_like_id', 'comment_like_id',
+    ], ['id']),
+    ('karma_daily', KarmaDaily, ['user_id', 'day', 'points'], ['id']),
+]
+
+
+def encode(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f'Cannot export {type(value).__name__}')
+
+
+def open_stream(path, mode, default):
+    """`path` as a text stream; '-' is `default`, and *.gz is (de)compressed."""
+    if path == '-':
+        return default
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class Command(BaseCommand):
+    help = (
+        'Write users, posts, comment trees, likes and karma as NDJSON (one '
+        'record per line) for import_feed. Rows are streamed from the '
+        'database in chunks, so memory use does not depend on the data size.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', default='-',
+            help='File to write, gzipped if it ends in .gz (default: stdout).',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Rows fetched from the database at a time (default: 2000).',
+        )
+
+    def handle(self, *args, **options):
+        counts = {}
+        stream = open_stream(options['output'], 'w', self.stdout)
+        try:
+            # One snapshot for every section, so that no like refers to a
+            # post created after the posts were written
+            with transaction.atomic():
+                if connection.vendor == 'postgresql':
+                    with connection.cursor() as cursor:
+                        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY')
+                self.write(stream, {
+                    'type': 'meta', 'format': FORMAT, 'version': VERSION,
+                    'exported_at': timezone.now().isoformat(),
+                })
+                for kind, model, columns, order in SECTIONS:
+                    counts[kind] = 0
+                    rows = model.objects.order_by(*order).values_list(*columns)
+                    for row in rows.iterator(chunk_size=options['chunk_size']):
+                        self.write(stream, {'type': kind, **dict(zip(columns, row))})
+                        counts[kind] += 1
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+
+        if options['output'] != '-':
+            summary = ', '.join(f'{count} {kind}' for kind, count in counts.items())
+            self.stdout.write(self.style.SUCCESS(f'Exported {summary} to {options["output"]}.'))
+
+    def write(self, stream, record):
+        stream.write(json.dumps(record, default=encode, ensure_ascii=False, separators=(',', ':')) + '\n')
@@ -0,0 +1,194 @@
+import json
+import sys
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from feed import hot, karma
+from feed.models import Post, Comment, PostLike, CommentLike, KarmaBucket
+
+from .export_feed import FORMAT, SECTIONS, VERSION, open_stream
+
+ORDER = {kind: position for position, (kind, _, _, _) in enumerate(SECTIONS)}
+MODELS = {kind: model for kind, model, _, _ in SECTIONS}
+COLUMNS = {kind: columns for kind, _, columns, _ in SECTIONS}
+
+# Id columns of each record type, by the table whose ids they hold. Every
+# imported row gets the id it had in the export plus the table's largest id
+# before the import, so references are remapped by arithmetic instead of a
+# lookup table that would grow with the data.
+REFERENCES = {
+    'user': {'id': User},
+    'post': {'id': Post, 'author_id': User},
+    'comment': {'id': Comment, 'post_id': Post, 'parent_id': Comment, 'author_id': User},
+    'post_like': {'id': PostLike, 'user_id': User, 'post_id': Post},
+    'comment_like': {'id': CommentLike, 'user_id': User, 'comment_id': Comment},
+    'karma': {'user_id': User, 'post_like_id': PostLike, 'comment_like_id': CommentLike},
+    'karma_daily': {'user_id': User},
+}
+RENUMBERED = [User, Post, Comment, PostLike, CommentLike]
+
+# Buckets touched by one UPDATE, see karma.add_to_rollup
+ROLLUP_BATCH = 200
+
+
+def remap_path(path, offset):
+    """A comment path with every id in it moved up by `offset`."""
+    width = Comment.PATH_SEGMENT_WIDTH
+    return ''.join(
+        Comment.path_segment(int(path[i:i + width]) + offset) for i in range(0, len(path), width)
+    )
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """Keep the created_at / updated_at values given, instead of now."""
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = (
+        'Load NDJSON written by export_feed. Records are read one line at a '
+        'time and inserted with bulk_create in batches, parents before '
+        'children, under new ids, so memory use does not depend on the data '
+        'size and the data can be loaded next to existing rows. Runs in one '
+        'transaction: on any error nothing is imported.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'input',
+            help='File to read, gunzipped if it ends in .gz; - for stdin.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='Rows per bulk_create batch (default: 2000).',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        self.batch_size = options['batch_size']
+        # Karma in the leaderboard window also goes into the rollup buckets
+        self.window_start = karma.bucket_start(timezone.now() - karma.LEADERBOARD_WINDOW)
+
+        stream = open_stream(options['input'], 'r', sys.stdin)
+        try:
+            with transaction.atomic(), explicit_timestamps(*RENUMBERED):
+                self.offsets = {
+                    model: model.objects.aggregate(n=Max('id'))['n'] or 0 for model in RENUMBERED
+                }
+                counts = self.load(stream)
+                # Like loaddata: foreign keys are only checked at commit, so
+                # check them now to report a record pointing nowhere
+                connection.check_constraints(table_names=[model._meta.db_table for model in MODELS.values()])
+                with connection.cursor() as cursor:
+                    for sql in connection.ops.sequence_reset_sql(no_style(), RENUMBERED):
+                        cursor.execute(sql)
+        except IntegrityError as e:
+            raise CommandError(f'The data does not fit together: {e}')
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        summary = ', '.join(f'{count} {kind}' for kind, count in counts.items()) or 'nothing'
+        self.stdout.write(self.style.SUCCESS(f'Imported {summary}.'))
+
+    def load(self, stream):
+        counts = Counter()
+        kind, batch = None, []
+        seen_meta = False
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                record_kind = record.pop('type')
+            except (ValueError, AttributeError, KeyError, TypeError):
+                raise CommandError(f'Line {number}: not an export_feed record')
+
+            if not seen_meta:
+                if record_kind != 'meta' or record.get('format') != FORMAT:
+                    raise CommandError(f'Line {number}: not an export_feed file')
+                if record.get('version') != VERSION:
+                    raise CommandError(f'Line {number}: unsupported version {record.get("version")}')
+                seen_meta = True
+                continue
+            if record_kind not in ORDER:
+                raise CommandError(f'Line {number}: unknown record type {record_kind!r}')
+
+            if record_kind != kind:
+                if kind is not None and ORDER[record_kind] < ORDER[kind]:
+                    raise CommandError(
+                        f'Line {number}: {record_kind} records have to come before {kind} records'
+                    )
+                self.flush(kind, batch)
+                kind, batch = record_kind, []
+            try:
+                batch.append(self.build(kind, record))
+            except (KeyError, TypeError, ValueError, ValidationError) as e:
+                raise CommandError(f'Line {number}: invalid {kind} record ({e!r})')
+            counts[kind] += 1
+            if len(batch) >= self.batch_size:
+                self.flush(kind, batch)
+                batch = []
+        self.flush(kind, batch)
+        return counts
+
+    def build(self, kind, record):
+        model = MODELS[kind]
+        references = REFERENCES[kind]
+        values = {}
+        for column in COLUMNS[kind]:
+            value = record[column]
+            if value is not None:
+                if column in references:
+                    value = int(value) + self.offsets[references[column]]
+                else:
+                    value = model._meta.get_field(column).to_python(value)
+            values[column] = value
+        if kind == 'comment':
+            values['path'] = remap_path(values['path'], self.offsets[Comment])
+        if kind == 'post':
+            values['hot_score'] = hot.score(values['created_at'], values['like_count'], values['comment_count'])
+        return model(**values)
+
+    def flush(self, kind, batch):
+        if not batch:
+            return
+        if kind == 'user':
+            taken = list(
+                User.objects.filter(username__in=[user.username for user in batch])
+                .order_by('username').values_list('username', flat=True)[:5]
+            )
+            if taken:
+                raise CommandError(f'Usernames already taken: {", ".join(taken)}')
+        MODELS[kind].objects.bulk_create(batch)
+
+        if kind == 'karma':
+            deltas = defaultdict(int)
+            for entry in batch:
+                if entry.created_at >= self.window_start:
+                    deltas[(entry.user_id, karma.bucket_start(entry.created_at))] += entry.points
+            deltas = iter(deltas.items())
+            while chunk := dict(islice(deltas, ROLLUP_BATCH)):
+                karma.add_to_rollup(KarmaBucket, 'bucket_start', chunk)
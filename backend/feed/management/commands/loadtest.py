@@ -0,0 +1,215 @@
+import asyncio
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+
+from feed.models import Post
+
+ENDPOINTS = {
+    'feed': lambda post_id: '/api/posts/',
+    'detail': lambda post_id: f'/api/posts/{post_id}/',
+    'leaderboard': lambda post_id: '/api/leaderboard/',
+}
+
+
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    if len(latencies) > 1:
+        cuts = statistics.quantiles(latencies, n=100)
+        p50, p95 = cuts[49], cuts[94]
+    else:
+        p50 = p95 = latencies[0] if latencies else 0.0
+    return len(latencies) / elapsed if elapsed else 0.0, p50, p95
+
+
+def run_threads(path, requests, concurrency):
+    """WSGI: `concurrency` threads, each with its own Client and connection."""
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(count):
+        client = Client()
+        mine = []
+        try:
+            for _ in range(count):
+                started = time.perf_counter()
+                response = client.get(path)
+                mine.append(time.perf_counter() - started)
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+        finally:
+            connection.close()
+        with lock:
+            latencies.extend(mine)
+
+    threads = [
+        threading.Thread(target=worker, args=(share,))
+        for share in shares(requests, concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+async def run_tasks(path, requests, concurrency):
+    """ASGI: `concurrency` tasks on one event loop."""
+    latencies = []
+    errors = []
+
+    async def worker(count):
+        client = AsyncClient()
+        for _ in range(count):
+            started = time.perf_counter()
+            response = await client.get(path)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(share) for share in shares(requests, concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+async def run_http(url, requests, concurrency):
+    """A running server: `concurrency` keep-alive HTTP/1.1 connections."""
+    parts = urlsplit(url)
+    if parts.scheme != 'http' or not parts.hostname:
+        raise CommandError(f'Only plain http:// URLs are supported: {url}')
+    target = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+    host = parts.netloc
+    request = (
+        f'GET {target} HTTP/1.1\r\nHost: {host}\r\n'
+        'Accept: application/json\r\nConnection: keep-alive\r\n\r\n'
+    ).encode()
+    latencies = []
+    errors = []
+
+    async def worker(count):
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+        try:
+            for _ in range(count):
+                started = time.perf_counter()
+                writer.write(request)
+                status_line = await reader.readline()
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    if name.strip().lower() == 'content-length':
+                        length = int(value)
+                await reader.readexactly(length)
+                latencies.append(time.perf_counter() - started)
+                status = int(status_line.split()[1]) if status_line else 0
+                if status != 200:
+                    errors.append(status)
+        finally:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(share) for share in shares(requests, concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def shares(requests, concurrency):
+    base, extra = divmod(requests, concurrency)
+    return [base + (1 if i < extra else 0) for i in range(concurrency) if base or i < extra]
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare read throughput of the sync (WSGI) and async (ASGI) request '
+        'paths under concurrent connections. By default both run in this '
+        'process: threads against the WSGI handler, tasks on one event loop '
+        'against the ASGI handler. With --url, load running servers instead '
+        '(e.g. gunicorn config.wsgi and gunicorn -k uvicorn.workers.UvicornWorker '
+        'config.asgi) over keep-alive connections.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--endpoint',
+            choices=sorted(ENDPOINTS),
+            default='feed',
+            help='Endpoint to load in-process (default: feed).',
+        )
+        parser.add_argument(
+            '--url',
+            action='append',
+            default=[],
+            help='Full URL of a running server to load instead; repeat to compare several.',
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=1000,
+            help='Requests per run (default: 1000).',
+        )
+        parser.add_argument(
+            '--concurrency',
+            default='1,10,50',
+            help='Comma-separated numbers of concurrent connections (default: 1,10,50).',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('--concurrency must be a comma-separated list of integers')
+        if any(level < 1 for level in levels) or options['requests'] < 1:
+            raise CommandError('--requests and --concurrency must be positive')
+
+        if options['url']:
+            runs = [
+                (url, lambda level, url=url: asyncio.run(run_http(url, options['requests'], level)))
+                for url in options['url']
+            ]
+        else:
+            post_id = Post.objects.order_by('-id').values_list('id', flat=True).first()
+            if post_id is None and options['endpoint'] == 'detail':
+                raise CommandError('There are no posts to load.')
+            path = ENDPOINTS[options['endpoint']](post_id)
+            runs = [
+                ('wsgi ' + path, lambda level: run_threads(path, options['requests'], level)),
+                ('asgi ' + path, lambda level: self.run_asgi(path, options['requests'], level)),
+            ]
+
+        self.stdout.write(f'{"target":<40} {"conns":>6} {"req/s":>10} {"p50":>10} {"p95":>10}')
+        failed = False
+        for name, run in runs:
+            for level in levels:
+                latencies, errors, elapsed = run(level=level)
+                rate, p50, p95 = summarize(latencies, elapsed)
+                self.stdout.write(
+                    f'{name:<40} {level:>6} {rate:>10.1f} '
+                    f'{p50 * 1000:>8.1f}ms {p95 * 1000:>8.1f}ms'
+                )
+                if errors:
+                    failed = True
+                    self.stdout.write(self.style.WARNING(
+                        f'  {len(errors)} non-200 response(s), e.g. {errors[0]}'
+                    ))
+        if failed:
+            raise CommandError('Some requests failed.')
+
+    def run_asgi(self, path, requests, level):
+        # What config/asgi.py sets up
+        with override_settings(
+            ASYNC_READ_VIEWS=True,
+            ROOT_URLCONF='config.asgi_urls',
+            MIDDLEWARE=[name for name in settings.MIDDLEWARE if not name.startswith('whitenoise.')],
+        ):
+            return asyncio.run(run_tasks(path, requests, level))
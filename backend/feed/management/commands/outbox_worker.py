@@ -0,0 +1,68 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from feed import outbox
+
+
+class Command(BaseCommand):
+    help = (
+        'Apply queued outbox events (karma for likes and unlikes) in batches. '
+        'Runs until interrupted unless --once is given.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain everything that is due, report the lag and exit.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=settings.OUTBOX_BATCH_SIZE,
+            help=f'Events per transaction (default: {settings.OUTBOX_BATCH_SIZE}).',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Seconds to sleep when the queue is empty (default: 1).',
+        )
+        parser.add_argument(
+            '--report-every',
+            type=float,
+            default=60.0,
+            help='Seconds between lag reports (default: 60).',
+        )
+
+    def handle(self, *args, **options):
+        last_report = 0.0
+        applied_since_report = 0
+        while True:
+            applied = 0
+            while True:
+                claimed, done = outbox.drain(options['batch_size'])
+                applied += done
+                if claimed < options['batch_size']:
+                    break
+            applied_since_report += applied
+
+            if options['once'] or time.monotonic() - last_report >= options['report_every']:
+                outbox.purge()
+                self.report(applied_since_report)
+                last_report = time.monotonic()
+                applied_since_report = 0
+
+            if options['once']:
+                return
+            if not applied:
+                time.sleep(options['interval'])
+
+    def report(self, applied):
+        lag = outbox.lag()
+        self.stdout.write(
+            f"Applied {applied} event(s); {lag['pending']} pending, "
+            f"{lag['failed']} failed, lag {lag['lag_seconds']:.1f}s."
+        )
@@ -0,0 +1,100 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from feed.models import Post, Comment, PostLike, CommentLike
+
+
+def count_of(model, fk):
+    """Correlated COUNT(*) of `model` rows pointing at the outer row via `fk`."""
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{fk: OuterRef('pk')})
+            .order_by()
+            .values(fk)
+            .annotate(n=Count('id'))
+            .values('n')
+        ),
+        0,
+    )
+
+
+def descendants_count():
+    """Correlated COUNT(*) of the replies, at any depth, under the outer comment."""
+    return Coalesce(
+        Subquery(
+            Comment.objects.filter(
+                post_id=OuterRef('post_id'),
+                path__startswith=OuterRef('path'),
+                depth__gt=OuterRef('depth'),
+            )
+            .order_by()
+            .values('post_id')
+            .annotate(n=Count('id'))
+            .values('n')
+        ),
+        0,
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuild the denormalized like_count / comment_count columns on posts '
+        'and the like_count / descendant_count columns on comments from the '
+        'underlying like and comment rows.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many rows have drifted, do not fix them.',
+        )
+
+    def handle(self, *args, **options):
+        post_counts = {
+            'actual_likes': count_of(PostLike, 'post'),
+            'actual_comments': count_of(Comment, 'post'),
+        }
+        comment_counts = {
+            'actual_likes': count_of(CommentLike, 'comment'),
+            'actual_descendants': descendants_count(),
+        }
+
+        with transaction.atomic():
+            drifted_posts = (
+                Post.objects.annotate(**post_counts)
+                .exclude(like_count=F('actual_likes'), comment_count=F('actual_comments'))
+                .count()
+            )
+            drifted_comments = (
+                Comment.objects.annotate(**comment_counts)
+                .exclude(like_count=F('actual_likes'), descendant_count=F('actual_descendants'))
+                .count()
+            )
+
+            if not options['dry_run']:
+                if drifted_posts:
+                    Post.objects.update(
+                        like_count=post_counts['actual_likes'],
+                        comment_count=post_counts['actual_comments'],
+                        updated_at=timezone.now(),
+                    )
+                if drifted_comments:
+                    Comment.objects.update(
+                        like_count=comment_counts['actual_likes'],
+                        descendant_count=comment_counts['actual_descendants'],
+                        updated_at=timezone.now(),
+                    )
+
+        if drifted_posts and not options['dry_run']:
+            # The hot scores were moved along with the wrong counts
+            call_command('refresh_hot_scores', stdout=self.stdout)
+
+        verb = 'Found' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {drifted_posts} drifted post(s) and {drifted_comments} drifted comment(s).'
+        ))
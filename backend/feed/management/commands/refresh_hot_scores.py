@@ -0,0 +1,67 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from feed import hot
+from feed.models import Post
+
+# Scores closer than this to the recomputed one are left alone
+TOLERANCE = 1e-9
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute every post\'s hot_score from its like and comment counts and '
+        'its age (see feed/hot.py), correcting drift from the incremental '
+        'updates and picking up a changed HOT_HALF_LIFE_HOURS. Works through '
+        'the posts by id in small batches, one short transaction each, and '
+        'only writes the scores that changed. Meant to run periodically.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Posts per transaction (default: 1000).',
+        )
+        parser.add_argument(
+            '--pause',
+            type=float,
+            default=0.0,
+            help='Seconds to sleep between batches, to go easy on a busy database.',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        last_id, checked, updated = 0, 0, 0
+        while True:
+            with transaction.atomic():
+                # Locked, so a like cannot move the counters under us
+                posts = list(
+                    Post.objects.select_for_update()
+                    .filter(id__gt=last_id)
+                    .order_by('id')
+                    .only('id', 'created_at', 'like_count', 'comment_count', 'hot_score')
+                    [:options['batch_size']]
+                )
+                changed = []
+                for post in posts:
+                    score = hot.score(post.created_at, post.like_count, post.comment_count)
+                    if abs(score - post.hot_score) > TOLERANCE:
+                        post.hot_score = score
+                        changed.append(post)
+                Post.objects.bulk_update(changed, ['hot_score'])
+            checked += len(posts)
+            updated += len(changed)
+            if len(posts) < options['batch_size']:
+                break
+            last_id = posts[-1].id
+            time.sleep(options['pause'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} post(s), updated {updated} hot score(s).'
+        ))
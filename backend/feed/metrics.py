@@ -0,0 +1,326 @@
+"""
+Per-endpoint request metrics in Prometheus text format.
+
+MetricsMiddleware records, per route (URL name) and method:
+
+- a latency histogram and a histogram of SQL statements per request;
+- requests by status code;
+- SQL statements and time spent in the database, counted by a wrapper
+  installed on every connection (connection.execute_wrapper) that only
+  does work while a request is being recorded;
+- time spent rendering response bodies (see renderers.py);
+- response bytes, as sent (after compression).
+
+GET /metrics serves them along with the comment tree and compression cache
+counters and the outbox lag. Recording a request is a handful of dict
+updates under a lock; there is no I/O on the request path.
+
+Every gunicorn worker keeps its own numbers. With METRICS_DIR set, each
+process also writes a snapshot to METRICS_DIR/metrics-<pid>.json at most
+every METRICS_FLUSH_SECONDS (from a background thread), and /metrics adds
+up the snapshots of all processes, so whichever worker answers the scrape
+reports the totals. Snapshots of exited workers stay, which keeps every
+counter monotonic; clear the directory when (re)starting the server.
+
+With METRICS_TOKEN set, /metrics requires `Authorization: Bearer <token>`;
+otherwise only staff users can read it.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+# The sample of the request being handled in this context, if any
+_current = ContextVar('metrics_sample', default=None)
+
+
+class Sample:
+    __slots__ = ('queries', 'db_seconds', 'render_seconds')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.render_seconds = 0.0
+
+
+def _new_histogram(buckets):
+    # Per-bucket counts (not cumulative), then sum and count
+    return [0] * (len(buckets) + 1) + [0.0, 0]
+
+
+class Registry:
+    """This process's metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = defaultdict(int)        # (route, method, status) -> count
+            self.latency = {}                       # (route, method) -> histogram
+            self.queries = {}                       # (route, method) -> histogram
+            self.sums = defaultdict(float)          # (name, route, method) -> total
+            self.dirty = False
+
+    def observe(self, route, method, status, seconds, sample, size):
+        key = (route, method)
+        with self._lock:
+            self.requests[(route, method, status)] += 1
+            latency = self.latency.get(key)
+            if latency is None:
+                latency = self.latency[key] = _new_histogram(LATENCY_BUCKETS)
+                self.queries[key] = _new_histogram(QUERY_BUCKETS)
+            queries = self.queries[key]
+            latency[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            latency[-2] += seconds
+            latency[-1] += 1
+            queries[bisect_left(QUERY_BUCKETS, sample.queries)] += 1
+            queries[-2] += sample.queries
+            queries[-1] += 1
+            self.sums[('db_seconds', route, method)] += sample.db_seconds
+            self.sums[('render_seconds', route, method)] += sample.render_seconds
+            self.sums[('response_bytes', route, method)] += size
+            self.dirty = True
+
+    def snapshot(self):
+        """A JSON-serializable copy, with the process's cache counters."""
+        from . import middleware, tree_cache
+
+        with self._lock:
+            return {
+                'requests': [[*key, count] for key, count in self.requests.items()],
+                'latency': [[*key, list(values)] for key, values in self.latency.items()],
+                'queries': [[*key, list(values)] for key, values in self.queries.items()],
+                'sums': [[*key, total] for key, total in self.sums.items()],
+                'caches': {'comment_tree': tree_cache.stats(), 'compression': middleware.stats()},
+            }
+
+
+registry = Registry()
+
+_flusher = None
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+
+def snapshot_path(pid=None):
+    return os.path.join(settings.METRICS_DIR, f'metrics-{pid or os.getpid()}.json')
+
+
+def flush():
+    """Write this process's snapshot to METRICS_DIR (atomically)."""
+    if not settings.METRICS_DIR:
+        return
+    registry.dirty = False
+    data = registry.snapshot()
+    fd, tmp = tempfile.mkstemp(dir=settings.METRICS_DIR, prefix='.metrics-')
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(data, fh)
+    os.replace(tmp, snapshot_path())
+
+
+def _flush_forever():
+    while True:
+        time.sleep(settings.METRICS_FLUSH_SECONDS)
+        if registry.dirty:
+            try:
+                flush()
+            except OSError:
+                pass
+
+
+def _ensure_flusher():
+    global _flusher, _flusher_pid
+    # A thread started before a fork does not exist in the child
+    if _flusher_pid == os.getpid():
+        return
+    with _flusher_lock:
+        if _flusher_pid != os.getpid():
+            _flusher = threading.Thread(target=_flush_forever, name='metrics-flush', daemon=True)
+            _flusher.start()
+            _flusher_pid = os.getpid()
+
+
+def _db_wrapper(execute, sql, params, many, context):
+    sample = _current.get()
+    if sample is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        sample.db_seconds += time.perf_counter() - started
+        sample.queries += 1
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if _db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_db_wrapper)
+
+
+def record_render(seconds):
+    """Add time spent rendering a response body to the current request."""
+    sample = _current.get()
+    if sample is not None:
+        sample.render_seconds += seconds
+
+
+class MetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        sample = Sample()
+        token = _current.set(sample)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.observe(request, response, time.perf_counter() - started, sample)
+        return response
+
+    async def __acall__(self, request):
+        sample = Sample()
+        token = _current.set(sample)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.observe(request, response, time.perf_counter() - started, sample)
+        return response
+
+    def observe(self, request, response, seconds, sample):
+        match = request.resolver_match
+        route = match.view_name if match is not None else 'unmatched'
+        size = 0 if response.streaming else len(response.content)
+        registry.observe(route, request.method, response.status_code, seconds, sample, size)
+        if settings.METRICS_DIR:
+            _ensure_flusher()
+
+
+def collect():
+    """This process's snapshot merged with the other processes' in METRICS_DIR."""
+    snapshots = [registry.snapshot()]
+    if settings.METRICS_DIR:
+        own = snapshot_path()
+        try:
+            names = os.listdir(settings.METRICS_DIR)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            path = os.path.join(settings.METRICS_DIR, name)
+            if not (name.startswith('metrics-') and name.endswith('.json')) or path == own:
+                continue
+            try:
+                with open(path) as fh:
+                    snapshots.append(json.load(fh))
+            except (OSError, ValueError):
+                # Removed or being replaced; it is counted on the next scrape
+                continue
+
+    requests = defaultdict(int)
+    histograms = {'latency': {}, 'queries': {}}
+    sums = defaultdict(float)
+    caches = defaultdict(lambda: defaultdict(int))
+    for snapshot in snapshots:
+        for route, method, status, count in snapshot['requests']:
+            requests[(route, method, status)] += count
+        for name in histograms:
+            for route, method, values in snapshot[name]:
+                merged = histograms[name].setdefault((route, method), [0] * len(values))
+                for i, value in enumerate(values):
+                    merged[i] += value
+        for name, route, method, total in snapshot['sums']:
+            sums[(name, route, method)] += total
+        for cache, counters in snapshot['caches'].items():
+            for outcome, count in counters.items():
+                caches[cache][outcome] += count
+    return requests, histograms, sums, caches
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _histogram(lines, name, help_text, buckets, data):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for (route, method), values in sorted(data.items()):
+        cumulative = 0
+        for bound, count in zip((*buckets, '+Inf'), values):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(route=route, method=method, le=bound)} {cumulative}')
+        lines.append(f'{name}_sum{_labels(route=route, method=method)} {values[-2]}')
+        lines.append(f'{name}_count{_labels(route=route, method=method)} {values[-1]}')
+
+
+def render(lag=None):
+    """The Prometheus text exposition of every process's metrics."""
+    requests, histograms, sums, caches = collect()
+    lines = [
+        '# HELP playto_http_requests_total Requests by route, method and status.',
+        '# TYPE playto_http_requests_total counter',
+    ]
+    for (route, method, status), count in sorted(requests.items()):
+        lines.append(f'playto_http_requests_total{_labels(route=route, method=method, status=status)} {count}')
+
+    _histogram(lines, 'playto_http_request_duration_seconds', 'Request latency.',
+               LATENCY_BUCKETS, histograms['latency'])
+    _histogram(lines, 'playto_http_db_queries', 'SQL statements per request.',
+               QUERY_BUCKETS, histograms['queries'])
+
+    for name, help_text in (
+        ('db_seconds', 'Time spent in SQL statements.'),
+        ('render_seconds', 'Time spent rendering response bodies.'),
+        ('response_bytes', 'Response body bytes sent.'),
+    ):
+        metric = f'playto_http_{name}_total'
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for (sum_name, route, method), total in sorted(sums.items()):
+            if sum_name == name:
+                lines.append(f'{metric}{_labels(route=route, method=method)} {total}')
+
+    lines.append('# HELP playto_cache_lookups_total Cache hits and misses of every process.')
+    lines.append('# TYPE playto_cache_lookups_total counter')
+    for cache, counters in sorted(caches.items()):
+        for outcome, count in sorted(counters.items()):
+            lines.append(f'playto_cache_lookups_total{_labels(cache=cache, outcome=outcome)} {count}')
+
+    if lag is not None:
+        for name, help_text, value in (
+            ('playto_outbox_pending', 'Outbox events waiting to be applied.', lag['pending']),
+            ('playto_outbox_failed', 'Outbox events parked after too many failures.', lag['failed']),
+            ('playto_outbox_lag_seconds', 'Age of the oldest unapplied outbox event.', lag['lag_seconds']),
+        ):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
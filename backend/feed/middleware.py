@@ -0,0 +1,116 @@
+"""
+Response compression.
+
+Like Django's GZipMiddleware, but:
+
+- only JSON responses are compressed (HTML pages carrying CSRF tokens are
+  left alone, which keeps BREACH off the table), and only from
+  COMPRESSION_MIN_SIZE bytes up;
+- the compressed bytes of cacheable payloads - responses with an ETag, see
+  feed/etags.py - are kept in the COMPRESSION_CACHE cache under a digest of
+  the uncompressed body, so a popular post detail or leaderboard is
+  gzipped once rather than on every request. Hashing the body is an order
+  of magnitude cheaper than compressing it.
+
+The middleware works under both WSGI and ASGI, so it does not force async
+requests through a worker thread.
+"""
+import gzip
+import hashlib
+import re
+import threading
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.cache import patch_vary_headers
+
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def stats():
+    """Compressed-body cache hits/misses of this process."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        for outcome in _stats:
+            _stats[outcome] = 0
+
+
+def compress(content):
+    # mtime=0 keeps the output deterministic, so cached and fresh bytes agree
+    return gzip.compress(content, compresslevel=settings.COMPRESSION_LEVEL, mtime=0)
+
+
+def cached_compress(content):
+    cache = caches[settings.COMPRESSION_CACHE]
+    digest = hashlib.blake2b(content, digest_size=20).hexdigest()
+    key = f'gzip:{settings.COMPRESSION_LEVEL}:{len(content)}:{digest}'
+    compressed = cache.get(key)
+    if compressed is not None:
+        _count('hits')
+        return compressed
+    _count('misses')
+    compressed = compress(content)
+    cache.set(key, compressed, settings.COMPRESSION_CACHE_TIMEOUT)
+    return compressed
+
+
+class CompressionMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process_response(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process_response(request, await self.get_response(request))
+
+    def process_response(self, request, response):
+        if (
+            response.streaming
+            or response.status_code != 200
+            or response.has_header('Content-Encoding')
+            or not response.get('Content-Type', '').startswith('application/json')
+        ):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+        if not ACCEPTS_GZIP.search(request.META.get('HTTP_ACCEPT_ENCODING', '')):
+            return response
+
+        etag = response.get('ETag')
+        if etag is not None:
+            compressed = cached_compress(response.content)
+        else:
+            compressed = compress(response.content)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = 'gzip'
+        if etag is not None and etag.startswith('"'):
+            # A different byte sequence than the identity response
+            response['ETag'] = 'W/' + etag
+        return response
@@ -0,0 +1,57 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:15
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _count_of(model, fk):
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{fk: OuterRef('pk')})
+            .order_by()
+            .values(fk)
+            .annotate(n=Count('id'))
+            .values('n')
+        ),
+        0,
+    )
+
+
+def backfill_counters(apps, schema_editor):
+    Post = apps.get_model('feed', 'Post')
+    Comment = apps.get_model('feed', 'Comment')
+    PostLike = apps.get_model('feed', 'PostLike')
+    CommentLike = apps.get_model('feed', 'CommentLike')
+
+    Post.objects.update(
+        like_count=_count_of(PostLike, 'post'),
+        comment_count=_count_of(Comment, 'post'),
+    )
+    Comment.objects.update(like_count=_count_of(CommentLike, 'comment'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0002_post_feed_order_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='like_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='comment_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='like_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
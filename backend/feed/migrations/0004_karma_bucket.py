@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('feed', '0003_denormalized_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KarmaBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket_start', models.DateTimeField()),
+                ('points', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='karma_buckets', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['bucket_start', 'user'], name='karma_bucket_window_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='karmabucket',
+            constraint=models.UniqueConstraint(fields=('user', 'bucket_start'), name='unique_karma_bucket'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0004_karma_bucket'),
+    ]
+
+    operations = [
+        # Build the composite indexes before dropping the FK indexes they replace
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'created_at'], name='comment_thread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['parent', 'created_at'], name='comment_replies_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='commentlike',
+            index=models.Index(fields=['comment', 'user'], name='comment_like_lookup_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='karmatransaction',
+            index=models.Index(fields=['created_at', 'user'], name='karma_txn_window_idx'),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='parent',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='replies', to='feed.comment'),
+        ),
+        migrations.AlterField(
+            model_name='comment',
+            name='post',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='comments', to='feed.post'),
+        ),
+        migrations.AlterField(
+            model_name='commentlike',
+            name='comment',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='likes', to='feed.comment'),
+        ),
+    ]
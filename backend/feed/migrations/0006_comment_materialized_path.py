@@ -0,0 +1,54 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:27
+
+from django.db import migrations, models
+
+PATH_SEGMENT_WIDTH = 10
+
+
+def backfill_paths(apps, schema_editor):
+    """
+    Fill in path/depth for existing comments, one post at a time so memory
+    is bounded by the largest thread. A reply always has a larger id than
+    its parent, so walking a post's comments by id sees parents first.
+    """
+    Post = apps.get_model('feed', 'Post')
+    Comment = apps.get_model('feed', 'Comment')
+
+    for post_id in Post.objects.order_by().values_list('id', flat=True).iterator():
+        paths = {}
+        updates = []
+        rows = Comment.objects.filter(post_id=post_id).order_by('id').values_list('id', 'parent_id')
+        for comment_id, parent_id in rows:
+            path = paths.get(parent_id, '') + str(comment_id).zfill(PATH_SEGMENT_WIDTH)
+            paths[comment_id] = path
+            updates.append(Comment(
+                id=comment_id,
+                path=path,
+                depth=len(path) // PATH_SEGMENT_WIDTH - 1,
+            ))
+        Comment.objects.bulk_update(updates, ['path', 'depth'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0005_access_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['post', 'path'], name='comment_path_idx'),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
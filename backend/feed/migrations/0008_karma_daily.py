@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-17 04:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('feed', '0007_outbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KarmaDaily',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('points', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='karma_days', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='karmadaily',
+            constraint=models.UniqueConstraint(fields=('user', 'day'), name='unique_karma_day'),
+        ),
+    ]
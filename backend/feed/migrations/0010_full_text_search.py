@@ -0,0 +1,77 @@
+from django.db import migrations
+
+# The index as feed/search.py first set it up, written out here so the
+# migration keeps doing the same whatever that module becomes
+TABLES = ['feed_post', 'feed_comment']
+
+
+def install_sql(vendor, table):
+    if vendor == 'sqlite':
+        fts = f'{table}_fts'
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"content, content='{table}', content_rowid='id', tokenize='porter unicode61')",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF content ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content); "
+            f"INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content); END",
+            f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]
+    if vendor == 'postgresql':
+        return [
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+            f"GENERATED ALWAYS AS (to_tsvector('english', content)) STORED",
+            f"CREATE INDEX IF NOT EXISTS {table}_search_idx ON {table} USING GIN (search_vector)",
+        ]
+    return []
+
+
+def uninstall_sql(vendor, table):
+    if vendor == 'sqlite':
+        fts = f'{table}_fts'
+        return [
+            f'DROP TRIGGER IF EXISTS {fts}_insert',
+            f'DROP TRIGGER IF EXISTS {fts}_delete',
+            f'DROP TRIGGER IF EXISTS {fts}_update',
+            f'DROP TABLE IF EXISTS {fts}',
+        ]
+    if vendor == 'postgresql':
+        return [
+            f'DROP INDEX IF EXISTS {table}_search_idx',
+            f'ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector',
+        ]
+    return []
+
+
+def run(schema_editor, statements):
+    with schema_editor.connection.cursor() as cursor:
+        for table in TABLES:
+            for sql in statements(schema_editor.connection.vendor, table):
+                cursor.execute(sql)
+
+
+def install(apps, schema_editor):
+    run(schema_editor, install_sql)
+
+
+def uninstall(apps, schema_editor):
+    run(schema_editor, uninstall_sql)
+
+
+class Migration(migrations.Migration):
+    """
+    Full-text index on post and comment contents, maintained by the
+    database (see feed/search.py): FTS5 tables and triggers on SQLite, a
+    generated tsvector column with a GIN index on Postgres.
+    """
+
+    dependencies = [
+        ('feed', '0009_comment_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.2.7 on 2026-10-17 05:55
+
+import math
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import migrations, models
+
+# The hot score as feed/hot.py first defined it, written out here so the
+# migration keeps doing the same whatever that module becomes:
+# log2(1 + likes + 2 * comments) + (created_at - EPOCH) / half-life
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# The full-text triggers on feed_post as of 0010_full_text_search
+SQLITE_POST_SEARCH_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS feed_post_fts_insert AFTER INSERT ON feed_post BEGIN "
+    "INSERT INTO feed_post_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS feed_post_fts_delete AFTER DELETE ON feed_post BEGIN "
+    "INSERT INTO feed_post_fts(feed_post_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS feed_post_fts_update AFTER UPDATE OF content ON feed_post BEGIN "
+    "INSERT INTO feed_post_fts(feed_post_fts, rowid, content) VALUES ('delete', old.id, old.content); "
+    "INSERT INTO feed_post_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+
+def hot_score(created_at, like_count, comment_count, half_life_hours):
+    age = (created_at - EPOCH).total_seconds() / (half_life_hours * 3600)
+    return math.log2(max(1 + like_count + 2 * comment_count, 1)) + age
+
+
+def backfill_hot_scores(apps, schema_editor):
+    Post = apps.get_model('feed', 'Post')
+    half_life_hours = getattr(settings, 'HOT_HALF_LIFE_HOURS', 24)
+
+    posts = list(Post.objects.only('id', 'created_at', 'like_count', 'comment_count'))
+    for post in posts:
+        post.hot_score = hot_score(post.created_at, post.like_count, post.comment_count, half_life_hours)
+    Post.objects.bulk_update(posts, ['hot_score'], batch_size=1000)
+
+
+def reinstall_search(apps, schema_editor):
+    # SQLite rebuilds feed_post to add the column, which drops the full-text
+    # triggers on it (see 0010_full_text_search)
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for sql in SQLITE_POST_SEARCH_TRIGGERS:
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0010_full_text_search'),
+    ]
+
+    operations = [
+        # Unapplying rebuilds the table again, after this runs backwards
+        migrations.RunPython(migrations.RunPython.noop, reinstall_search),
+        migrations.AddField(
+            model_name='post',
+            name='hot_score',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-hot_score', '-id'], name='post_hot_order_idx'),
+        ),
+        migrations.RunPython(backfill_hot_scores, migrations.RunPython.noop),
+        migrations.RunPython(reinstall_search, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.7 on 2026-10-17 06:20
+
+from collections import Counter
+
+from django.db import migrations, models
+
+PATH_SEGMENT_WIDTH = 10
+
+# The full-text triggers on feed_comment as of 0010_full_text_search, kept
+# here so the migration does not depend on the current feed/search.py
+SQLITE_SEARCH_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS feed_comment_fts_insert AFTER INSERT ON feed_comment BEGIN "
+    "INSERT INTO feed_comment_fts(rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS feed_comment_fts_delete AFTER DELETE ON feed_comment BEGIN "
+    "INSERT INTO feed_comment_fts(feed_comment_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); END",
+    "CREATE TRIGGER IF NOT EXISTS feed_comment_fts_update AFTER UPDATE OF content ON feed_comment BEGIN "
+    "INSERT INTO feed_comment_fts(feed_comment_fts, rowid, content) "
+    "VALUES ('delete', old.id, old.content); "
+    "INSERT INTO feed_comment_fts(rowid, content) VALUES (new.id, new.content); END",
+]
+
+
+def backfill_descendant_counts(apps, schema_editor):
+    Comment = apps.get_model('feed', 'Comment')
+
+    counts = Counter()
+    for path in Comment.objects.values_list('path', flat=True).iterator():
+        for start in range(0, len(path) - PATH_SEGMENT_WIDTH, PATH_SEGMENT_WIDTH):
+            counts[int(path[start:start + PATH_SEGMENT_WIDTH])] += 1
+    comments = [Comment(id=comment_id, descendant_count=count) for comment_id, count in counts.items()]
+    Comment.objects.bulk_update(comments, ['descendant_count'], batch_size=1000)
+
+
+def reinstall_search_triggers(apps, schema_editor):
+    # SQLite rebuilds feed_comment to add the column, which drops its
+    # full-text triggers
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for sql in SQLITE_SEARCH_TRIGGERS:
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0011_hot_score'),
+    ]
+
+    operations = [
+        # Unapplying rebuilds the table again, after this runs backwards
+        migrations.RunPython(migrations.RunPython.noop, reinstall_search_triggers),
+        migrations.AddField(
+            model_name='comment',
+            name='descendant_count',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_descendant_counts, migrations.RunPython.noop),
+        migrations.RunPython(reinstall_search_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.7 on 2026-10-17 06:34
+
+from datetime import datetime, time, timedelta, timezone
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+
+# Compaction has never folded ledger rows younger than the start of the UTC
+# day this many days ago (karma.MIN_RETENTION_DAYS)
+MIN_RETENTION_DAYS = 2
+
+
+def mark_compacted_likes(apps, schema_editor):
+    """
+    Mark the likes whose ledger row has already been compacted: old enough,
+    without a ledger row, and with no credit event still queued or parked.
+    """
+    KarmaTransaction = apps.get_model('feed', 'KarmaTransaction')
+    OutboxEvent = apps.get_model('feed', 'OutboxEvent')
+
+    day = (datetime.now(timezone.utc) - timedelta(days=MIN_RETENTION_DAYS)).date()
+    cutoff = datetime.combine(day, time.min, tzinfo=timezone.utc)
+    unapplied = set(
+        OutboxEvent.objects
+        .filter(kind='karma.credit', processed_at__isnull=True)
+        .values_list('key', flat=True)
+    )
+    for karma_type, model_name in (('post_like', 'PostLike'), ('comment_like', 'CommentLike')):
+        Like = apps.get_model('feed', model_name)
+        candidates = (
+            Like.objects
+            .filter(created_at__lt=cutoff)
+            .exclude(Exists(KarmaTransaction.objects.filter(**{f'{karma_type}_id': OuterRef('pk')})))
+            .values_list('id', flat=True)
+        )
+        ids = [like_id for like_id in candidates.iterator() if f'{karma_type}:{like_id}:credit' not in unapplied]
+        for start in range(0, len(ids), 1000):
+            Like.objects.filter(id__in=ids[start:start + 1000]).update(karma_compacted=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feed', '0012_comment_descendant_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commentlike',
+            name='karma_compacted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='postlike',
+            name='karma_compacted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_compacted_likes, migrations.RunPython.noop),
+    ]
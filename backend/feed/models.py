@@ -1,45 +1,220 @@
-from django.db import models
+from collections import Counter
+
+from django.db import connections, models
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.utils import timezone
 
+from . import hot
+
 
 class Post(models.Model):
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='posts')
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Also moved forward by the counter updates below, so it changes whenever
+    # the post's feed entry does (see feed/etags.py)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Denormalized counters, kept in step with F() updates in the views.
+    # `manage.py recount` rebuilds them from the like/comment tables.
+    like_count = models.IntegerField(default=0)
+    comment_count = models.IntegerField(default=0)
+    # Order of the hot feed, moved along with the counters (see feed/hot.py)
+    hot_score = models.FloatField(default=0.0)
+
     class Meta:
-        ordering = ['-created_at']
+        # id breaks ties between posts created in the same instant, so the
+        # feed order is total and can be paged by keyset (see pagination.py).
+        ordering = ['-created_at', '-id']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='post_feed_order_idx'),
+            models.Index(fields=['-hot_score', '-id'], name='post_hot_order_idx'),
+        ]
 
     def __str__(self):
         return f"{self.author.username}: {self.content[:50]}"
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and not self.hot_score:
+            # created_at is set to now as the row is inserted
+            self.hot_score = hot.score(timezone.now(), self.like_count, self.comment_count)
+        super().save(*args, **kwargs)
+
+
+class CommentQuerySet(models.QuerySet):
+    def thread(self, post):
+        """Every comment of a post in display (depth-first) order."""
+        return self.filter(post=post).order_by('path')
+
+    def subtree(self, comment, max_depth=None):
+        """
+        `comment` and its descendants in display order, as one range scan
+        on (post, path). `max_depth` counts levels below `comment`.
+        """
+        queryset = self.filter(
+            post_id=comment.post_id,
+            path__gte=comment.path,
+            path__lt=Comment.path_upper_bound(comment.path),
+        )
+        if max_depth is not None:
+            queryset = queryset.filter(depth__lte=comment.depth + max_depth)
+        return queryset.order_by('path')
+
+    def with_stray_replies(self):
+        """
+        These comments plus every reply under them that is not among them
+        yet, found through `parent`. Comment paths are kept valid, but rows
+        written before that (replies moved to another parent, or to a
+        parent on another post) can sit outside their parent's path range.
+        One query when there are none.
+        """
+        strays = Comment.objects.filter(parent_id__in=self.values('id')).exclude(id__in=self.values('id'))
+        if not strays.exists():
+            return self
+        ids = set(self.values_list('id', flat=True))
+        found = set(strays.values_list('id', flat=True))
+        while found:
+            ids |= found
+            found = set(
+                Comment.objects.filter(parent_id__in=found).exclude(id__in=ids).values_list('id', flat=True)
+            )
+        return Comment.objects.filter(id__in=ids)
+
+    def removal_counts(self):
+        """
+        What deleting these comments takes off the counters of what stays,
+        from one read of their paths: ({post_id: comments removed},
+        {comment id: descendants removed}) for the comments above them
+        that are not deleted too. Pass the comments through
+        with_stray_replies() first, so replies on other posts are counted
+        against those posts.
+        """
+        rows = list(self.order_by().values_list('id', 'post_id', 'path'))
+        removed = {comment_id for comment_id, _, _ in rows}
+        per_post, per_ancestor = Counter(), Counter()
+        for _, post_id, path in rows:
+            per_post[post_id] += 1
+            per_ancestor.update(
+                ancestor_id for ancestor_id in Comment.path_ancestor_ids(path) if ancestor_id not in removed
+            )
+        return per_post, per_ancestor
+
+    def delete_with_likes(self):
+        """
+        Delete these comments and their likes with one statement per table
+        and return how many comments went. delete() on the comments would
+        load every row (in batches) to cascade the replies and likes and
+        send signals, costing queries in proportion to the thread.
+
+        Callers invalidate the tree cache and fix the counters themselves
+        (see removal_counts()), and the comments must include all their
+        replies: a whole thread or subtree, passed through
+        with_stray_replies().
+        """
+        ids = self.order_by().values('id')
+        # Nothing cascades from a like, so this is a single DELETE
+        CommentLike.objects.filter(comment_id__in=ids).delete()
+        connection = connections[self.db]
+        sql, params = ids.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {connection.ops.quote_name(Comment._meta.db_table)} WHERE id IN ({sql})', params
+            )
+            return cursor.rowcount
+
 
 class Comment(models.Model):
     """
     Adjacency list model for nested comments.
     parent=None means it's a top-level comment on a post.
     parent=some_comment means it's a reply to that comment.
+
+    Each comment also stores a materialized path: the ids of its ancestors
+    and itself, zero-padded to PATH_SEGMENT_WIDTH digits and concatenated.
+    Sorting by path gives depth-first display order (siblings by id, i.e.
+    creation order), and a subtree is the path range [path, next sibling's
+    path). Digits only, so the range holds under any collation.
+
+    A comment never moves to another parent, so the path stays valid.
+    `descendant_count` (replies at any depth) is kept up to date on the
+    ancestors when a comment is added or a subtree deleted.
     """
-    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments')
+    PATH_SEGMENT_WIDTH = 10
+
+    # post and parent are covered by the composite indexes in Meta
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='comments', db_index=False)
     author = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comments')
     parent = models.ForeignKey(
         'self', 
         null=True, 
         blank=True, 
         on_delete=models.CASCADE, 
-        related_name='replies'
+        related_name='replies',
+        db_index=False
     )
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Also moved forward by like counter updates, see feed/etags.py
+    updated_at = models.DateTimeField(auto_now=True)
+    like_count = models.IntegerField(default=0)
+    # Set by save() right after the insert, once the id is known
+    path = models.TextField(default='', editable=False)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+    descendant_count = models.IntegerField(default=0, editable=False)
+
+    objects = CommentQuerySet.as_manager()
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            # Threads and subtrees as path ranges, already in display order
+            models.Index(fields=['post', 'path'], name='comment_path_idx'),
+            # Post detail and ?post= listing: all comments of a post, oldest first
+            models.Index(fields=['post', 'created_at'], name='comment_thread_idx'),
+            # Replies of one comment in display order (also used by delete cascades)
+            models.Index(fields=['parent', 'created_at'], name='comment_replies_idx'),
+            # Latest change in a post's thread, for post detail ETags
+            models.Index(fields=['post', 'updated_at'], name='comment_changed_idx'),
+        ]
 
     def __str__(self):
         return f"{self.author.username}: {self.content[:30]}"
 
+    @classmethod
+    def path_segment(cls, comment_id):
+        return str(comment_id).zfill(cls.PATH_SEGMENT_WIDTH)
+
+    @classmethod
+    def path_upper_bound(cls, path):
+        """Smallest path that sorts after every path starting with `path`."""
+        head, last = path[:-cls.PATH_SEGMENT_WIDTH], path[-cls.PATH_SEGMENT_WIDTH:]
+        return head + cls.path_segment(int(last) + 1)
+
+    @classmethod
+    def path_ancestor_ids(cls, path):
+        """Ids of the comments above the one at `path`, from the root down."""
+        width = cls.PATH_SEGMENT_WIDTH
+        return [int(path[i:i + width]) for i in range(0, len(path) - width, width)]
+
+    def ancestor_ids(self):
+        """Ids of the comments this one is a reply to, from the root down."""
+        return self.path_ancestor_ids(self.path)
+
+    def save(self, *args, **kwargs):
+        creating = self._state.adding and not self.path
+        if creating:
+            self.depth = self.parent.depth + 1 if self.parent_id else 0
+        super().save(*args, **kwargs)
+        if creating:
+            parent_path = self.parent.path if self.parent_id else ''
+            self.path = parent_path + self.path_segment(self.pk)
+            Comment.objects.filter(pk=self.pk).update(path=self.path)
+            if self.parent_id:
+                Comment.objects.filter(pk__in=self.ancestor_ids()).update(
+                    descendant_count=F('descendant_count') + 1
+                )
+
 
 class PostLike(models.Model):
     """
@@ -48,6 +223,9 @@ class PostLike(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='post_likes')
     post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name='likes')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Set by compact_karma once this like's ledger row is folded into
+    # KarmaDaily, so unliking takes the karma back out of there
+    karma_compacted = models.BooleanField(default=False)
 
     class Meta:
         # Database-level constraint to prevent double likes
@@ -64,13 +242,20 @@ class CommentLike(models.Model):
     Like on a comment. Unique constraint prevents double-liking.
     """
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='comment_likes')
-    comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name='likes')
+    comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name='likes', db_index=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Set by compact_karma once this like's ledger row is folded into
+    # KarmaDaily, so unliking takes the karma back out of there
+    karma_compacted = models.BooleanField(default=False)
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['user', 'comment'], name='unique_comment_like')
         ]
+        indexes = [
+            # The unique constraint leads with user; this serves per-comment lookups
+            models.Index(fields=['comment', 'user'], name='comment_like_lookup_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} likes comment {self.comment.id}"
@@ -92,11 +277,115 @@ class KarmaTransaction(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='karma_transactions')
     karma_type = models.CharField(max_length=20, choices=KARMA_TYPES)
     points = models.IntegerField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # The time of the like, which the outbox worker may apply a little later
+    created_at = models.DateTimeField(default=timezone.now)
     
-    # Optional references to track what earned the karma
-    post_like = models.ForeignKey(PostLike, null=True, blank=True, on_delete=models.CASCADE)
-    comment_like = models.ForeignKey(CommentLike, null=True, blank=True, on_delete=models.CASCADE)
+    # Optional references to track what earned the karma. Unliking deletes
+    # the like straight away but the karma only when the outbox worker gets
+    # to it (see feed/karma.py), so these are plain references that are
+    # allowed to outlive the like for a moment.
+    post_like = models.ForeignKey(
+        PostLike, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False
+    )
+    comment_like = models.ForeignKey(
+        CommentLike, null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False
+    )
+
+    class Meta:
+        indexes = [
+            # Leaderboard window edge and index rebuilds range-scan created_at
+            models.Index(fields=['created_at', 'user'], name='karma_txn_window_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username}: +{self.points} ({self.karma_type})"
+
+
+class KarmaBucket(models.Model):
+    """
+    Karma rolled up per user into fixed 5-minute buckets.
+
+    Written in the same transaction as the KarmaTransaction it summarises
+    (see feed/karma.py), so the 24h leaderboard only has to sum at most
+    288 buckets per active user instead of every ledger row in the window.
+    """
+    BUCKET_MINUTES = 5
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='karma_buckets')
+    bucket_start = models.DateTimeField()
+    points = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'bucket_start'], name='unique_karma_bucket')
+        ]
+        indexes = [
+            models.Index(fields=['bucket_start', 'user'], name='karma_bucket_window_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.points} @ {self.bucket_start:%Y-%m-%d %H:%M}"
+
+
+class KarmaDaily(models.Model):
+    """
+    Karma per user per (UTC) day for ledger rows that have been compacted
+    away (see `manage.py compact_karma`). All-time karma is the sum of these
+    plus whatever is still in the KarmaTransaction ledger.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='karma_days')
+    day = models.DateField()
+    points = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day'], name='unique_karma_day')
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.points} on {self.day}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Work queued by a request, written in the request's own transaction and
+    applied afterwards by the outbox worker (see feed/outbox.py).
+
+    `key` is an idempotency key: enqueueing the same key twice is a no-op,
+    and an event is marked processed in the same transaction that applies
+    it, so its effects happen exactly once.
+    """
+    kind = models.CharField(max_length=50)
+    key = models.CharField(max_length=200, unique=True)
+    payload = models.JSONField(default=dict)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Failed events are retried from this time on, with backoff
+    available_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    # Set once an event has used up its attempts; it is not retried again
+    failed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The worker's queue: only unfinished events are indexed
+            models.Index(
+                fields=['available_at', 'id'],
+                name='outbox_pending_idx',
+                condition=models.Q(processed_at__isnull=True, failed_at__isnull=True),
+            ),
+            models.Index(
+                fields=['processed_at'],
+                name='outbox_processed_idx',
+                condition=models.Q(processed_at__isnull=False),
+            ),
+            models.Index(
+                fields=['failed_at'],
+                name='outbox_failed_idx',
+                condition=models.Q(failed_at__isnull=False),
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.key}"
@@ -0,0 +1,147 @@
+"""
+Transactional outbox.
+
+Requests should not pay for bookkeeping that nobody is waiting on. Instead
+of doing that work inline, a request writes an OutboxEvent in its own
+transaction - so the event exists if and only if the request committed -
+and `manage.py outbox_worker` applies the events afterwards, in batches:
+
+- Every event carries an idempotency key; enqueueing a key that already
+  exists does nothing.
+- An event is marked processed in the same transaction as its effects, and
+  workers claim batches with SELECT ... FOR UPDATE SKIP LOCKED, so each
+  event is applied exactly once even with several workers.
+- A failing event is retried with exponential backoff, up to
+  OUTBOX_MAX_ATTEMPTS times, then parked with `failed_at` set.
+- `lag()` reports how far behind the worker is.
+
+With OUTBOX_SYNC = True (the default) events are applied as soon as they
+are enqueued, inside the request's transaction, which is what the tests
+and a setup without a worker want. Nothing is left for a worker then, so
+the events are not written to the table at all. Deployments that run the
+worker turn it off.
+
+Handlers are registered per event kind with @outbox.handler('kind').
+"""
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+# Retry delays double from 2s up to this cap
+MAX_RETRY_DELAY = timedelta(minutes=5)
+
+
+def handler(kind):
+    """Register the function applying events of `kind` (called with the payload)."""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, key, payload):
+    enqueue_many(kind, [(key, payload)])
+
+
+def enqueue_many(kind, items):
+    """
+    Queue one event per (key, payload) in the current transaction. Keys that
+    are already queued (or were processed) are skipped.
+    """
+    if not items:
+        return
+    if settings.OUTBOX_SYNC:
+        # No row to write, read back, mark processed and purge later; a
+        # failure rolls back the request with it
+        for payload in dict(items).values():
+            HANDLERS[kind](payload)
+        return
+    OutboxEvent.objects.bulk_create(
+        [OutboxEvent(kind=kind, key=key, payload=payload) for key, payload in items],
+        ignore_conflicts=True,
+    )
+
+
+def pending(now=None):
+    now = now or timezone.now()
+    return OutboxEvent.objects.filter(
+        processed_at__isnull=True, failed_at__isnull=True, available_at__lte=now
+    ).order_by('available_at', 'id')
+
+
+def retry_delay(attempts):
+    return min(timedelta(seconds=2 ** attempts), MAX_RETRY_DELAY)
+
+
+def process(events, now=None):
+    """
+    Apply `events` in order, each in its own savepoint, and record the
+    outcome. Call inside a transaction. Returns the number applied.
+    """
+    now = now or timezone.now()
+    applied = 0
+    for event in events:
+        try:
+            with transaction.atomic():
+                HANDLERS[event.kind](event.payload)
+        except Exception as exc:
+            logger.exception('Outbox event %s failed', event.key)
+            event.attempts += 1
+            event.last_error = f'{type(exc).__name__}: {exc}'
+            if event.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                event.failed_at = now
+            else:
+                event.available_at = now + retry_delay(event.attempts)
+        else:
+            event.processed_at = now
+            applied += 1
+    if events:
+        OutboxEvent.objects.bulk_update(
+            events, ['attempts', 'last_error', 'available_at', 'processed_at', 'failed_at']
+        )
+    return applied
+
+
+def drain(batch_size=None, now=None):
+    """
+    Claim and apply one batch of due events. Returns (claimed, applied);
+    claimed == 0 means the queue is empty for now.
+    """
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    now = now or timezone.now()
+    with transaction.atomic():
+        events = list(pending(now).select_for_update(skip_locked=True)[:batch_size])
+        return len(events), process(events, now)
+
+
+def purge(now=None):
+    """Delete processed events older than OUTBOX_RETENTION_HOURS."""
+    now = now or timezone.now()
+    cutoff = now - timedelta(hours=settings.OUTBOX_RETENTION_HOURS)
+    deleted, _ = OutboxEvent.objects.filter(processed_at__lt=cutoff).delete()
+    return deleted
+
+
+def lag(now=None):
+    """
+    Queue health: unfinished and failed event counts, and the age in
+    seconds of the oldest unfinished event (0 when the queue is empty).
+    """
+    now = now or timezone.now()
+    unfinished = OutboxEvent.objects.filter(processed_at__isnull=True, failed_at__isnull=True)
+    oldest = unfinished.aggregate(oldest=Min('created_at'))['oldest']
+    return {
+        'pending': unfinished.count(),
+        'failed': OutboxEvent.objects.filter(failed_at__isnull=False).count(),
+        'lag_seconds': (now - oldest).total_seconds() if oldest else 0,
+    }
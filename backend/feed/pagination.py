@@ -0,0 +1,237 @@
+import base64
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Keyset pagination over a compound (created_at, id) ordering.
+
+    DRF's built-in CursorPagination only keys on the first ordering field and
+    falls back to an OFFSET for ties. Here the cursor holds the full
+    (created_at, id) position of the boundary row, so every page is a single
+    index range scan:
+
+        WHERE created_at < :t OR (created_at = :t AND id < :id)
+        ORDER BY created_at DESC, id DESC
+        LIMIT :page_size + 1
+
+    The extra row tells us whether there is another page without a COUNT.
+    Cursors are opaque base64 tokens; clients should only ever echo back the
+    `next` / `previous` URLs we hand them.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    invalid_cursor_message = 'Invalid cursor'
+
+    # (field, descending) pairs; the last field must be unique.
+    ordering = (('created_at', True), ('id', True))
+
+    def get_page_size(self, request):
+        page_size = getattr(settings, 'FEED_PAGE_SIZE', 20)
+        if self.page_size_query_param in request.query_params:
+            try:
+                requested = int(request.query_params[self.page_size_query_param])
+            except ValueError:
+                requested = 0
+            if requested > 0:
+                page_size = min(requested, self.max_page_size)
+        return page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        window = self._start(queryset, request)
+        return self._finish(list(window[:self.page_size + 1]))
+
+    async def apaginate_queryset(self, queryset, request):
+        """paginate_queryset() for async views, loading the page with the async ORM."""
+        window = self._start(queryset, request)
+        return self._finish([row async for row in window[:self.page_size + 1]])
+
+    def _start(self, queryset, request):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+        self.cursor = self.decode_cursor(request, queryset.model)
+        return self._window(queryset, self.cursor)
+
+    def _finish(self, rows):
+        cursor = self.cursor
+        reverse = bool(cursor and cursor['reverse'])
+
+        self.window_rows = list(rows)
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        if reverse:
+            self.has_next = cursor is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = cursor is not None
+
+        self.page = rows
+        return rows
+
+    def page_stamp(self, queryset, request, fields):
+        """
+        `fields` of the rows the page for `request` would show (plus the
+        look-ahead row), read with the same index range scan but without
+        loading whole rows. Changes whenever the page's contents could.
+        """
+        cursor = self.decode_cursor(request, queryset.model)
+        window = self._window(queryset, cursor)
+        return list(window.values_list(*fields)[:self.get_page_size(request) + 1])
+
+    async def apage_stamp(self, queryset, request, fields):
+        cursor = self.decode_cursor(request, queryset.model)
+        window = self._window(queryset, cursor)
+        return [row async for row in window.values_list(*fields)[:self.get_page_size(request) + 1]]
+
+    def loaded_stamp(self, fields):
+        """page_stamp() of the page paginate_queryset() just loaded, without a query."""
+        return [tuple(getattr(row, field) for field in fields) for row in self.window_rows]
+
+    def _window(self, queryset, cursor):
+        """`queryset` ordered in scan direction, starting after the cursor."""
+        reverse = bool(cursor and cursor['reverse'])
+        queryset = queryset.order_by(*self._order_by(reverse))
+        if cursor is not None:
+            queryset = queryset.filter(self._after(cursor['position'], reverse))
+        return queryset
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_data(self, data):
+        return OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self._link(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            # Paged past the end; the first page is the only sensible target.
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self._link(self.page[0], reverse=True)
+
+    def _order_by(self, reverse):
+        fields = []
+        for field, descending in self.ordering:
+            if descending != reverse:
+                fields.append('-' + field)
+            else:
+                fields.append(field)
+        return fields
+
+    def _after(self, position, reverse):
+        """
+        Build the row-value comparison "strictly after `position`" in the
+        current scan direction, expanded into OR/AND terms so that both
+        SQLite and Postgres can drive it from the composite index.
+        """
+        condition = Q()
+        equal = Q()
+        for (field, descending), value in zip(self.ordering, position):
+            lookup = 'lt' if descending != reverse else 'gt'
+            condition |= equal & Q(**{f'{field}__{lookup}': value})
+            equal &= Q(**{field: value})
+        return condition
+
+    def _position(self, instance):
+        return [getattr(instance, field) for field, _ in self.ordering]
+
+    def _link(self, instance, reverse):
+        position = self._position(instance)
+        payload = {
+            'p': [value.isoformat() if hasattr(value, 'isoformat') else value for value in position],
+            'r': int(reverse),
+        }
+        token = base64.urlsafe_b64encode(
+            json.dumps(payload, separators=(',', ':')).encode()
+        ).decode().rstrip('=')
+        return replace_query_param(self.base_url, self.cursor_query_param, token)
+
+    def decode_cursor(self, request, model):
+        token = request.query_params.get(self.cursor_query_param)
+        if not token:
+            return None
+
+        try:
+            padded = token + '=' * (-len(token) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            raw_position = payload['p']
+            reverse = bool(payload.get('r', 0))
+            if len(raw_position) != len(self.ordering):
+                raise ValueError
+            position = [
+                self.parse_position(model, field, value)
+                for (field, _), value in zip(self.ordering, raw_position)
+            ]
+            if any(value is None for value in position):
+                raise ValueError
+        except (TypeError, ValueError, KeyError, ValidationError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return {'position': position, 'reverse': reverse}
+
+    def parse_position(self, model, field, value):
+        # Let each model field parse its own value back (datetimes, ints, floats).
+        return model._meta.get_field(field).to_python(value)
+
+
+class HotCursorPagination(KeysetCursorPagination):
+    """
+    The hot feed (?sort=hot): keyset pagination over (hot_score, id), the
+    post_hot_order_idx index. See feed/hot.py.
+    """
+    ordering = (('hot_score', True), ('id', True))
+
+
+# The post feed's ?sort= values
+FEED_SORTS = {'new': KeysetCursorPagination, 'hot': HotCursorPagination}
+
+
+class SearchCursorPagination(KeysetCursorPagination):
+    """
+    Keyset pagination over search results, most relevant first: the cursor
+    holds the (search_rank, id) of the boundary row (see feed/search.py).
+    The rank is computed per query rather than stored, so a page boundary
+    only stays exact while the matching rows do not change.
+    """
+    ordering = (('search_rank', False), ('id', False))
+
+    def parse_position(self, model, field, value):
+        if field == 'search_rank':
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError
+            return float(value)
+        return super().parse_position(model, field, value)
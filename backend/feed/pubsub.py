@@ -0,0 +1,239 @@
+"""
+Publish/subscribe for live updates (see live.py).
+
+Publishers put small events on named channels ('post:42', 'leaderboard');
+each open event stream holds a Subscription to one channel. A broker:
+
+- numbers events in publishing order and keeps the last PUBSUB_HISTORY of
+  each channel, so a client that reconnects with the id of the last event it saw
+  gets everything it missed. Ids carry the broker's epoch, so an id from
+  before a restart, or one older than the history, gets a single `reset`
+  event instead, telling the client to refetch;
+- queues at most SSE_MAX_PENDING undelivered events per subscription. A
+  subscriber that falls further behind (a slow or stalled connection) is
+  cut off rather than buffered without bound; its client reconnects and
+  resumes from history.
+
+Subscriptions can be waited on from threads (WSGI) and from the event loop
+(ASGI).
+
+`MemoryBroker` only connects publishers and streams of the same process.
+Several web processes, or karma applied by a separate outbox worker, need a
+shared backend (e.g. Redis pub/sub) implementing the same `publish` /
+`subscribe` / `is_watched` interface, picked with PUBSUB_BACKEND.
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+Event = namedtuple('Event', ['id', 'type', 'data'])
+
+RESET = 'reset'
+
+
+class Overflow(Exception):
+    """The subscriber fell more than SSE_MAX_PENDING events behind."""
+
+
+class Subscription:
+
+    def __init__(self, broker, channel, max_pending):
+        self.broker = broker
+        self.channel = channel
+        self.max_pending = max_pending
+        self.overflowed = False
+        self.closed = False
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._waiters = set()   # (loop, asyncio.Event) of async readers
+
+    def put(self, event):
+        with self._lock:
+            if self.overflowed or self.closed:
+                return
+            if len(self._pending) >= self.max_pending:
+                self.overflowed = True
+                self._pending.clear()
+            else:
+                self._pending.append(event)
+            waiters = list(self._waiters)
+        self._ready.set()
+        for loop, ready in waiters:
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # The reader's loop has shut down
+                pass
+
+    def _take(self):
+        with self._lock:
+            if self.overflowed:
+                raise Overflow(self.channel)
+            events = list(self._pending)
+            self._pending.clear()
+            self._ready.clear()
+            return events
+
+    def get(self, timeout):
+        """Pending events, waiting up to `timeout` seconds for one ([] if none came)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self._take()
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return events
+            self._ready.wait(remaining)
+
+    async def aget(self, timeout):
+        """get() for the event loop."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            events = self._take()
+            remaining = deadline - loop.time()
+            if events or remaining <= 0:
+                return events
+            waiter = (loop, asyncio.Event())
+            with self._lock:
+                self._waiters.add(waiter)
+                ready = bool(self._pending) or self.overflowed
+            try:
+                if not ready:
+                    await asyncio.wait_for(waiter[1].wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    self._waiters.discard(waiter)
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._pending.clear()
+        self.broker.unsubscribe(self)
+
+
+class _Channel:
+
+    def __init__(self, history, dropped):
+        self.history = deque(maxlen=history)    # (seq, Event)
+        # Events up to this sequence number may have been published but are
+        # no longer (or never were) in `history`
+        self.dropped = dropped
+        self.subscribers = set()
+        self.watched = False
+
+
+class MemoryBroker:
+    """In-process broker; see the module docstring."""
+
+    def __init__(self, history=None, max_channels=None):
+        self.history = settings.PUBSUB_HISTORY if history is None else history
+        self.max_channels = settings.PUBSUB_MAX_CHANNELS if max_channels is None else max_channels
+        self.epoch = format(time.time_ns() // 1000, 'x')
+        self._lock = threading.Lock()
+        self._channels = OrderedDict()
+        self._seq = 0   # shared by all channels
+
+    def _channel(self, name):
+        channel = self._channels.get(name)
+        if channel is None:
+            channel = self._channels[name] = _Channel(self.history, self._seq)
+            if len(self._channels) > self.max_channels:
+                # Forget the history of the least recently used idle channel
+                for idle in list(self._channels):
+                    if not self._channels[idle].subscribers:
+                        del self._channels[idle]
+                        break
+        self._channels.move_to_end(name)
+        return channel
+
+    def publish(self, channel, type, data):
+        """Send an event to every subscriber of `channel`. Returns the Event."""
+        with self._lock:
+            state = self._channel(channel)
+            self._seq += 1
+            event = Event(f'{self.epoch}-{self._seq}', type, data)
+            if len(state.history) == state.history.maxlen:
+                state.dropped = state.history[0][0]
+            state.history.append((self._seq, event))
+            # Under the lock, so every subscriber sees the same order
+            for subscription in state.subscribers:
+                subscription.put(event)
+        return event
+
+    def subscribe(self, channel, last_event_id=None, max_pending=None):
+        """
+        Subscribe to `channel`. With `last_event_id`, the events published
+        after it are queued first (or a `reset` event if they are gone).
+        """
+        if max_pending is None:
+            max_pending = settings.SSE_MAX_PENDING
+        subscription = Subscription(self, channel, max_pending)
+        with self._lock:
+            state = self._channel(channel)
+            if last_event_id:
+                for event in self._missed(state, last_event_id):
+                    subscription.put(event)
+            state.subscribers.add(subscription)
+            state.watched = True
+        return subscription
+
+    def _missed(self, state, last_event_id):
+        epoch, _, seq = last_event_id.partition('-')
+        try:
+            seq = int(seq)
+        except ValueError:
+            seq = None
+        if epoch != self.epoch or seq is None or seq < state.dropped:
+            return [Event(None, RESET, {})]
+        return [event for event_seq, event in state.history if event_seq > seq]
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            state = self._channels.get(subscription.channel)
+            if state is not None:
+                state.subscribers.discard(subscription)
+
+    def is_watched(self, channel):
+        """Whether `channel` has subscribers, or had some recently enough to be resumed."""
+        with self._lock:
+            state = self._channels.get(channel)
+            return state is not None and state.watched
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(settings.PUBSUB_BACKEND)()
+    return _broker
+
+
+def publish(channel, type, data):
+    return get_broker().publish(channel, type, data)
+
+
+def subscribe(channel, last_event_id=None):
+    return get_broker().subscribe(channel, last_event_id)
+
+
+def is_watched(channel):
+    return get_broker().is_watched(channel)
+
+
+def reset():
+    """Forget the configured broker and its channels, e.g. between tests."""
+    global _broker
+    with _broker_lock:
+        _broker = None
@@ -0,0 +1,99 @@
+"""
+Read replicas.
+
+With REPLICA_DATABASE_URLS set, safe-method (GET/HEAD/OPTIONS) requests to
+the feed viewsets read from a replica; everything else - writes, unsafe
+requests, management commands, the outbox worker - stays on the primary.
+
+- Each request picks one replica and reads only from it, so values read
+  at different points of the request (an ETag stamp and the body it
+  describes) come from one consistent snapshot.
+- Replicas lag. After a successful write (or login and registration) the
+  client gets a cookie that pins its reads to the primary for
+  REPLICA_PIN_SECONDS, so a user always sees their own like, comment or
+  post on the very next read.
+- Only the feed's models are read from replicas. The session and user
+  behind a request are loaded from the primary, before the replica is
+  picked.
+- Caches shared between users must not be filled from a lagging replica,
+  or a stale entry would outlive the lag; see primary_reads().
+"""
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+PIN_COOKIE = 'read_primary_until'
+
+_read_alias = contextvars.ContextVar('read_alias', default=None)
+
+
+class ReplicaRouter:
+    """
+    Send reads of the feed's own models to the replica chosen for the
+    current request, if any. Sessions and users always come from the
+    primary: a session created by a login a moment ago may not have
+    reached the replica yet.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'feed':
+            return None
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Never write through an instance that was read from a replica
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.REPLICA_DATABASES}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def is_pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+@contextmanager
+def replica_reads(request):
+    """Route this request's reads to one replica, if it may use one."""
+    alias = None
+    if settings.REPLICA_DATABASES and request.method in SAFE_METHODS and not is_pinned(request):
+        alias = random.choice(settings.REPLICA_DATABASES)
+    token = _read_alias.set(alias)
+    try:
+        yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """Read from the primary inside the block, whatever the request uses."""
+    token = _read_alias.set(None)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def pin(response):
+    """Keep the client's reads on the primary until replicas have caught up."""
+    seconds = settings.REPLICA_PIN_SECONDS
+    response.set_cookie(
+        PIN_COOKIE,
+        f'{time.time() + seconds:.3f}',
+        max_age=seconds,
+        secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True,
+        samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
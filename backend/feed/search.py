@@ -0,0 +1,148 @@
+"""
+Full-text search over post and comment contents.
+
+The database keeps the index itself, so every write path keeps it in step,
+including bulk_create (import_feed, the benchmark seed) and the set-based
+deletes of CommentQuerySet.delete_with_likes:
+
+- SQLite: an FTS5 table per model (feed_post_fts, feed_comment_fts) that
+  uses the model's table as external content, maintained by triggers on
+  insert, delete and updates of `content`. Like and comment counter
+  updates do not touch it.
+- Postgres: a stored generated `search_vector` tsvector column with a GIN
+  index. The column is not on the models; only the queries here use it.
+
+Queries are split into words, and a row matches when it has every word
+(after stemming, so "running" finds "run"). Matches are ranked by bm25 on
+SQLite and ts_rank_cd on Postgres, as `search_rank` where lower is more
+relevant, which SearchCursorPagination pages through by (search_rank, id).
+
+SQLite drops a table's triggers when Django rebuilds the table for a schema
+change, so a migration that does that to feed_post or feed_comment has to
+call install() again afterwards.
+
+Other databases fall back to `icontains` on every word, unranked.
+"""
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+from .models import Post, Comment
+
+TABLES = [Post._meta.db_table, Comment._meta.db_table]
+
+# Words of a query that are searched for; the rest are ignored
+MAX_TERMS = 16
+
+
+def terms(text):
+    """The words of `text` that are searched for."""
+    return re.findall(r'\w+', text.lower())[:MAX_TERMS]
+
+
+def install(connection):
+    """Create (or repair) the index on `connection` and fill it from the tables."""
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            for sql in _install_sql(connection.vendor, table):
+                cursor.execute(sql)
+
+
+def uninstall(connection):
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            for sql in _uninstall_sql(connection.vendor, table):
+                cursor.execute(sql)
+
+
+def _install_sql(vendor, table):
+    if vendor == 'sqlite':
+        fts = f'{table}_fts'
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+            f"content, content='{table}', content_rowid='id', tokenize='porter unicode61')",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content); END",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF content ON {table} BEGIN "
+            f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content); "
+            f"INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content); END",
+            f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+        ]
+    if vendor == 'postgresql':
+        return [
+            f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+            f"GENERATED ALWAYS AS (to_tsvector('english', content)) STORED",
+            f"CREATE INDEX IF NOT EXISTS {table}_search_idx ON {table} USING GIN (search_vector)",
+        ]
+    return []
+
+
+def _uninstall_sql(vendor, table):
+    if vendor == 'sqlite':
+        fts = f'{table}_fts'
+        return [
+            f'DROP TRIGGER IF EXISTS {fts}_insert',
+            f'DROP TRIGGER IF EXISTS {fts}_delete',
+            f'DROP TRIGGER IF EXISTS {fts}_update',
+            f'DROP TABLE IF EXISTS {fts}',
+        ]
+    if vendor == 'postgresql':
+        return [
+            f'DROP INDEX IF EXISTS {table}_search_idx',
+            f'ALTER TABLE {table} DROP COLUMN IF EXISTS search_vector',
+        ]
+    return []
+
+
+def match(model, text):
+    """A filter() condition: the rows of `model` whose content has every word of `text`."""
+    words = terms(text)
+    table = connection.ops.quote_name(model._meta.db_table)
+    if connection.vendor == 'sqlite':
+        fts = f'{model._meta.db_table}_fts'
+        return RawSQL(
+            f'{table}."id" IN (SELECT rowid FROM {fts} WHERE {fts} MATCH %s)',
+            [_fts_query(words)], output_field=BooleanField(),
+        )
+    if connection.vendor == 'postgresql':
+        return RawSQL(
+            f"{table}.\"search_vector\" @@ plainto_tsquery('english', %s)",
+            [' '.join(words)], output_field=BooleanField(),
+        )
+    condition = Q()
+    for word in words:
+        condition &= Q(content__icontains=word)
+    return condition
+
+
+def rank(model, text):
+    """An expression for how well each matching row fits `text`; lower is better."""
+    words = terms(text)
+    table = connection.ops.quote_name(model._meta.db_table)
+    if connection.vendor == 'sqlite':
+        fts = f'{model._meta.db_table}_fts'
+        return RawSQL(
+            f'(SELECT rank FROM {fts} WHERE {fts} MATCH %s AND rowid = {table}."id")',
+            [_fts_query(words)], output_field=FloatField(),
+        )
+    if connection.vendor == 'postgresql':
+        # float8 so that the value round-trips exactly through cursors
+        return RawSQL(
+            f"(-ts_rank_cd({table}.\"search_vector\", plainto_tsquery('english', %s)))::float8",
+            [' '.join(words)], output_field=FloatField(),
+        )
+    return Value(0.0, output_field=FloatField())
+
+
+def search(queryset, text):
+    """`queryset` narrowed to the rows matching `text`, annotated with `search_rank`."""
+    return queryset.filter(match(queryset.model, text)).annotate(search_rank=rank(queryset.model, text))
+
+
+def _fts_query(words):
+    # Each word as an FTS5 string, so that nothing in it is query syntax
+    return ' '.join(f'"{word}"' for word in words)
@@ -15,26 +15,34 @@ class CommentSerializer(serializers.ModelSerializer):
     after we fetch all comments in a single query and build the tree in Python.
     """
     author = UserSerializer(read_only=True)
-    like_count = serializers.SerializerMethodField()
     is_liked = serializers.SerializerMethodField()
     replies = serializers.SerializerMethodField()
+    more_replies = serializers.SerializerMethodField()
 
     class Meta:
         model = Comment
-        fields = ['id', 'author', 'content', 'created_at', 'parent', 'like_count', 'is_liked', 'replies']
-        read_only_fields = ['author', 'created_at']
-
-    def get_like_count(self, obj):
-        # Uses prefetched likes if available
-        if hasattr(obj, 'prefetched_likes_count'):
-            return obj.prefetched_likes_count
-        return obj.likes.count()
+        fields = [
+            'id', 'author', 'content', 'created_at', 'parent', 'like_count', 'descendant_count',
+            'is_liked', 'replies', 'more_replies',
+        ]
+        # like_count is a denormalized column maintained by the like/unlike
+        # actions, descendant_count by Comment.save and comment deletes
+        read_only_fields = ['author', 'created_at', 'like_count', 'descendant_count']
+
+    def validate_parent(self, value):
+        # The materialized path is built from the parent on insert, so a
+        # comment cannot be moved under another one afterwards
+        if self.instance is not None and value != self.instance.parent:
+            raise serializers.ValidationError('A comment cannot be moved to another parent.')
+        return value
 
     def get_is_liked(self, obj):
+        # Views put the viewer's liked ids in the context (see feed/likes.py)
+        liked = self.context.get('liked_comment_ids')
+        if liked is not None:
+            return obj.id in liked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            if hasattr(obj, 'user_has_liked'):
-                return obj.user_has_liked
             return obj.likes.filter(user=request.user).exists()
         return False
 
@@ -44,52 +52,120 @@ class CommentSerializer(serializers.ModelSerializer):
             return CommentSerializer(obj.children, many=True, context=self.context).data
         return []
 
+    def get_more_replies(self, obj):
+        # Continuation token set by threads.load_window when replies were cut off
+        return getattr(obj, 'more_replies', None)
+
+
+# Columns load_window fetches with values(); render_comment_tree reads them.
+COMMENT_TREE_COLUMNS = [
+    'id', 'author_id', 'author__username', 'content', 'created_at',
+    'parent_id', 'like_count', 'descendant_count',
+]
+
+
+def render_comment_tree(rows, context=None):
+    """
+    Render flat comment rows (dicts from `.values(*COMMENT_TREE_COLUMNS)`,
+    optionally with `more_replies`) as nested reply lists of plain dicts: no
+    recursion and no DRF field machinery per node. `is_liked` comes from the
+    context's `liked_comment_ids` set, as in CommentSerializer. The output
+    is exactly what CommentSerializer produces for the same comments after
+    build_comment_tree.
+
+    Rows whose parent is not among `rows` become roots; replies keep the
+    order of `rows`.
+    """
+    liked = (context or {}).get('liked_comment_ids') or ()
+    created_at = _created_at_field.to_representation
+
+    nodes = {}
+    ordered = []
+    for row in rows:
+        node = {
+            'id': row['id'],
+            'author': {'id': row['author_id'], 'username': row['author__username']},
+            'content': row['content'],
+            'created_at': created_at(row['created_at']),
+            'parent': row['parent_id'],
+            'like_count': row['like_count'],
+            'descendant_count': row['descendant_count'],
+            'is_liked': row['id'] in liked,
+            'replies': [],
+            'more_replies': row.get('more_replies'),
+        }
+        nodes[row['id']] = node
+        ordered.append(node)
+
+    roots = []
+    for node in ordered:
+        parent = nodes.get(node['parent'])
+        if parent is not None:
+            parent['replies'].append(node)
+        else:
+            roots.append(node)
+    return roots
+
+
+_created_at_field = serializers.DateTimeField()
+
 
 class PostSerializer(serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
-    like_count = serializers.SerializerMethodField()
-    comment_count = serializers.SerializerMethodField()
     is_liked = serializers.SerializerMethodField()
 
     class Meta:
         model = Post
         fields = ['id', 'author', 'content', 'created_at', 'like_count', 'comment_count', 'is_liked']
-        read_only_fields = ['author', 'created_at']
-
-    def get_like_count(self, obj):
-        if hasattr(obj, 'prefetched_likes_count'):
-            return obj.prefetched_likes_count
-        return obj.likes.count()
-
-    def get_comment_count(self, obj):
-        if hasattr(obj, 'prefetched_comments_count'):
-            return obj.prefetched_comments_count
-        return obj.comments.count()
+        # Counters are denormalized columns, never written through the API
+        read_only_fields = ['author', 'created_at', 'like_count', 'comment_count']
 
     def get_is_liked(self, obj):
+        # Views put the viewer's liked ids in the context (see feed/likes.py)
+        liked = self.context.get('liked_post_ids')
+        if liked is not None:
+            return obj.id in liked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            if hasattr(obj, 'user_has_liked'):
-                return obj.user_has_liked
             return obj.likes.filter(user=request.user).exists()
         return False
 
 
 class PostDetailSerializer(PostSerializer):
     """
-    Includes the full comment tree. Comments are built as a tree in the view.
+    Includes a window of the comment tree. Comments are built as a tree in
+    the view; `more_comments` continues the top-level list.
     """
     comments = serializers.SerializerMethodField()
+    more_comments = serializers.SerializerMethodField()
 
     class Meta(PostSerializer.Meta):
-        fields = PostSerializer.Meta.fields + ['comments']
+        fields = PostSerializer.Meta.fields + ['comments', 'more_comments']
 
     def get_comments(self, obj):
-        # The view populates 'comment_tree' on the post object
+        # The view populates either 'rendered_comments' (plain dicts from
+        # render_comment_tree) or 'comment_tree' (Comment instances)
+        if hasattr(obj, 'rendered_comments'):
+            return obj.rendered_comments
         if hasattr(obj, 'comment_tree'):
             return CommentSerializer(obj.comment_tree, many=True, context=self.context).data
         return []
 
+    def get_more_comments(self, obj):
+        return getattr(obj, 'more_comments', None)
+
+
+class CommentSearchSerializer(CommentSerializer):
+    """A comment found by search: with the post it is on, without replies."""
+    replies = None
+    more_replies = None
+
+    class Meta(CommentSerializer.Meta):
+        fields = [
+            'id', 'post', 'author', 'content', 'created_at', 'parent', 'like_count', 'descendant_count',
+            'is_liked',
+        ]
+
 
 class LeaderboardUserSerializer(serializers.Serializer):
     id = serializers.IntegerField()
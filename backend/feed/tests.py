@@ -1,9 +1,58 @@
-from django.test import TestCase
-from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import caches
+from django.test import TestCase, TransactionTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import connection, connections, transaction
+from django.db.models import F, Sum, Value
+from django.core.management import CommandError, call_command
 from django.utils import timezone
+from collections import Counter, defaultdict
 from datetime import timedelta
-from rest_framework.test import APIClient
-from .models import Post, Comment, PostLike, CommentLike, KarmaTransaction
+from io import StringIO
+import gzip
+import json
+import importlib
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from decimal import Decimal
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from django.utils.translation import gettext_lazy
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory
+from config.test_runner import THREADS_TAG
+from . import hot, karma, leaderboard, likes, live, metrics, middleware, outbox, parsers, pubsub, renderers, routers, search, threads, tree_cache
+from .models import Post, Comment, PostLike, CommentLike, KarmaTransaction, KarmaBucket, KarmaDaily, OutboxEvent
+from .serializers import CommentSerializer, render_comment_tree
+from .views import build_comment_tree
+
+
+# The settings leave the comment tree cache off unless a cache shared by the
+# web workers is configured; tests of the cache use a memory cache
+TREE_CACHES = {
+    **settings.CACHES,
+    'comment_trees': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'comment-trees'},
+}
+
+
+def give_karma(user, points, karma_type='post_like', at=None):
+    """
+    Write a ledger row (optionally backdated) plus its rollup bucket, the
+    same way the like actions do.
+    """
+    transaction = KarmaTransaction.objects.create(
+        user=user, karma_type=karma_type, points=points, created_at=at or timezone.now()
+    )
+    karma.credit(user.id, points, transaction.created_at)
+    return transaction
 
 
 class LeaderboardTestCase(TestCase):
@@ -14,6 +63,7 @@ class LeaderboardTestCase(TestCase):
 
     def setUp(self):
         self.client = APIClient()
+        leaderboard.reset()
         
         # Create test users
         self.user1 = User.objects.create_user('alice', password='pass123')
@@ -27,21 +77,10 @@ class LeaderboardTestCase(TestCase):
         """Karma older than 24 hours should not appear in leaderboard."""
         
         # Give user1 karma from 2 days ago (should NOT count)
-        old_karma = KarmaTransaction.objects.create(
-            user=self.user1,
-            karma_type='post_like',
-            points=5
-        )
-        # Manually set created_at to 2 days ago
-        old_karma.created_at = timezone.now() - timedelta(days=2)
-        old_karma.save(update_fields=['created_at'])
+        old_karma = give_karma(self.user1, 5, at=timezone.now() - timedelta(days=2))
         
         # Give user2 karma from 1 hour ago (should count)
-        recent_karma = KarmaTransaction.objects.create(
-            user=self.user2,
-            karma_type='post_like',
-            points=5
-        )
+        recent_karma = give_karma(self.user2, 5)
         
         # Get leaderboard
         response = self.client.get('/api/leaderboard/')
@@ -58,16 +97,16 @@ class LeaderboardTestCase(TestCase):
         """Users should be ranked by karma amount descending."""
         
         # user1 gets 10 karma
-        KarmaTransaction.objects.create(user=self.user1, karma_type='post_like', points=5)
-        KarmaTransaction.objects.create(user=self.user1, karma_type='post_like', points=5)
+        give_karma(self.user1, 5)
+        give_karma(self.user1, 5)
         
         # user2 gets 15 karma
-        KarmaTransaction.objects.create(user=self.user2, karma_type='post_like', points=5)
-        KarmaTransaction.objects.create(user=self.user2, karma_type='post_like', points=5)
-        KarmaTransaction.objects.create(user=self.user2, karma_type='post_like', points=5)
+        give_karma(self.user2, 5)
+        give_karma(self.user2, 5)
+        give_karma(self.user2, 5)
         
         # user3 gets 1 karma
-        KarmaTransaction.objects.create(user=self.user3, karma_type='comment_like', points=1)
+        give_karma(self.user3, 1, karma_type='comment_like')
         
         response = self.client.get('/api/leaderboard/')
         data = response.json()
@@ -91,11 +130,7 @@ class LeaderboardTestCase(TestCase):
         # Create 7 users with karma
         for i in range(7):
             user = User.objects.create_user(f'user{i}', password='pass')
-            KarmaTransaction.objects.create(
-                user=user,
-                karma_type='post_like',
-                points=10 - i  # Decreasing karma
-            )
+            give_karma(user, 10 - i)  # Decreasing karma
         
         response = self.client.get('/api/leaderboard/')
         data = response.json()
@@ -105,6 +140,7 @@ class LeaderboardTestCase(TestCase):
         self.assertEqual(data[4]['username'], 'user4')
 
 
+@override_settings(OUTBOX_SYNC=True)
 class LikeRaceConditionTestCase(TestCase):
     """
     Test that the unique constraint prevents double-liking.
@@ -147,3 +183,2901 @@ class LikeRaceConditionTestCase(TestCase):
         
         # Karma transaction should be deleted
         self.assertEqual(KarmaTransaction.objects.filter(user=self.author).count(), 0)
+
+
+@override_settings(FEED_PAGE_SIZE=3)
+class PostFeedPaginationTestCase(TestCase):
+    """
+    Test keyset pagination on the post feed.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.posts = [
+            Post.objects.create(author=self.author, content=f'Post {i}')
+            for i in range(8)
+        ]
+        # Give several posts the same timestamp so id has to break the tie
+        same_instant = timezone.now() - timedelta(hours=1)
+        Post.objects.filter(id__in=[p.id for p in self.posts[2:6]]).update(created_at=same_instant)
+
+    def expected_order(self):
+        return list(Post.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def walk(self, url):
+        ids = []
+        pages = []
+        while url:
+            data = self.client.get(url).json()
+            pages.append(data)
+            ids.extend(post['id'] for post in data['results'])
+            url = data['next']
+        return ids, pages
+
+    def test_pages_cover_feed_in_order_without_duplicates(self):
+        ids, pages = self.walk('/api/posts/')
+        self.assertEqual(ids, self.expected_order())
+        self.assertEqual([len(p['results']) for p in pages], [3, 3, 2])
+        self.assertIsNone(pages[0]['previous'])
+
+    def test_previous_link_returns_prior_page(self):
+        first = self.client.get('/api/posts/').json()
+        second = self.client.get(first['next']).json()
+        back = self.client.get(second['previous']).json()
+        self.assertEqual(
+            [p['id'] for p in back['results']],
+            [p['id'] for p in first['results']]
+        )
+
+    def test_page_size_query_param(self):
+        data = self.client.get('/api/posts/?page_size=5').json()
+        self.assertEqual(len(data['results']), 5)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get('/api/posts/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, 404)
+
+    def test_page_query_count_is_constant(self):
+        _, pages = self.walk('/api/posts/')
+        last_page_url = pages[-2]['next']
+        with self.assertNumQueries(1):
+            self.client.get(last_page_url)
+
+
+class DenormalizedCounterTestCase(TestCase):
+    """
+    Test that like_count / comment_count columns track the underlying rows.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user('testuser', password='pass123')
+        self.author = User.objects.create_user('author', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_post_like_and_unlike_update_counter(self):
+        self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+
+        # A rejected double like must not bump the counter
+        self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+
+        self.client.post(f'/api/posts/{self.post.id}/unlike/')
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 0)
+
+    def test_comment_like_and_unlike_update_counter(self):
+        comment = Comment.objects.create(post=self.post, author=self.author, content='Hi')
+        self.client.post(f'/api/comments/{comment.id}/like/')
+        comment.refresh_from_db()
+        self.assertEqual(comment.like_count, 1)
+
+        self.client.post(f'/api/comments/{comment.id}/unlike/')
+        comment.refresh_from_db()
+        self.assertEqual(comment.like_count, 0)
+
+    def test_comment_create_and_delete_update_post_counter(self):
+        root = self.client.post('/api/comments/', {'post': self.post.id, 'content': 'Root'}).json()
+        self.client.post('/api/comments/', {'post': self.post.id, 'content': 'Reply', 'parent': root['id']})
+        self.client.post('/api/comments/', {'post': self.post.id, 'content': 'Other'})
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 3)
+
+        # Deleting the root cascades to its reply
+        response = self.client.delete(f'/api/comments/{root["id"]}/')
+        self.assertEqual(response.status_code, 204)
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.comment_count, 1)
+
+    def test_serializers_read_counter_columns(self):
+        self.client.post(f'/api/posts/{self.post.id}/like/')
+        Comment.objects.create(post=self.post, author=self.author, content='Hi')
+        Post.objects.filter(pk=self.post.pk).update(comment_count=1)
+
+        data = self.client.get(f'/api/posts/{self.post.id}/').json()
+        self.assertEqual(data['like_count'], 1)
+        self.assertEqual(data['comment_count'], 1)
+
+    def test_recount_command_repairs_drift(self):
+        comment = Comment.objects.create(post=self.post, author=self.author, content='Hi')
+        PostLike.objects.create(user=self.user, post=self.post)
+        CommentLike.objects.create(user=self.user, comment=comment)
+        Post.objects.filter(pk=self.post.pk).update(like_count=7, comment_count=0)
+
+        out = StringIO()
+        call_command('recount', stdout=out)
+        self.assertIn('Fixed 1 drifted post(s) and 1 drifted comment(s)', out.getvalue())
+
+        self.post.refresh_from_db()
+        comment.refresh_from_db()
+        self.assertEqual((self.post.like_count, self.post.comment_count), (1, 1))
+        self.assertEqual(comment.like_count, 1)
+
+    def test_recount_command_repairs_descendant_counts(self):
+        root = Comment.objects.create(post=self.post, author=self.author, content='root')
+        reply = Comment.objects.create(post=self.post, author=self.author, content='reply', parent=root)
+        Comment.objects.create(post=self.post, author=self.author, content='nested', parent=reply)
+        Comment.objects.update(descendant_count=5)
+
+        call_command('recount', stdout=StringIO())
+        counts = list(Comment.objects.order_by('path').values_list('descendant_count', flat=True))
+        self.assertEqual(counts, [2, 1, 0])
+
+
+@override_settings(OUTBOX_SYNC=True)
+class KarmaRollupTestCase(TestCase):
+    """
+    Test that the bucketed leaderboard matches summing the raw ledger.
+    """
+
+    def setUp(self):
+        self.users = [User.objects.create_user(f'user{i}', password='pass') for i in range(6)]
+        self.now = timezone.now()
+
+    def ledger_totals(self, now):
+        # The original leaderboard query, straight off KarmaTransaction
+        rows = (
+            KarmaTransaction.objects
+            .filter(created_at__gte=now - timedelta(hours=24))
+            .values('user_id')
+            .annotate(total=Sum('points'))
+        )
+        return {row['user_id']: row['total'] for row in rows}
+
+    def seed(self):
+        # Spread karma over 30 hours at uneven offsets so the window cutoff
+        # lands in the middle of a bucket with rows on both sides of it.
+        for i in range(120):
+            user = self.users[i % len(self.users)]
+            at = self.now - timedelta(minutes=i * 15 + (i % 7))
+            give_karma(user, 1 + (i * 7) % 5, at=at)
+
+        for minutes in (-3, -1, 1, 2):
+            at = self.now - timedelta(hours=24) + timedelta(minutes=minutes, seconds=17)
+            give_karma(self.users[0], 3, at=at)
+
+    def test_window_totals_match_ledger(self):
+        self.seed()
+        for offset in (0, 1, 2, 7, 13):
+            now = self.now + timedelta(minutes=offset, seconds=offset * 11)
+            self.assertEqual(karma.window_totals(now), self.ledger_totals(now))
+
+    def test_like_and_unlike_maintain_buckets(self):
+        author = self.users[0]
+        post = Post.objects.create(author=author, content='Test post')
+        client = APIClient()
+        client.force_authenticate(user=self.users[1])
+
+        client.post(f'/api/posts/{post.id}/like/')
+        self.assertEqual(
+            KarmaBucket.objects.filter(user=author).aggregate(total=Sum('points'))['total'],
+            KarmaTransaction.KARMA_POST_LIKE
+        )
+        self.assertEqual(karma.window_totals(), {author.id: KarmaTransaction.KARMA_POST_LIKE})
+
+        client.post(f'/api/posts/{post.id}/unlike/')
+        self.assertEqual(
+            KarmaBucket.objects.filter(user=author).aggregate(total=Sum('points'))['total'],
+            0
+        )
+        self.assertEqual(karma.window_totals(), {})
+
+    def test_deleting_comment_revokes_karma_from_buckets(self):
+        author = self.users[0]
+        post = Post.objects.create(author=author, content='Test post')
+        root = Comment.objects.create(post=post, author=author, content='Root')
+        reply = Comment.objects.create(post=post, author=author, content='Reply', parent=root)
+        client = APIClient()
+        client.force_authenticate(user=self.users[1])
+        client.post(f'/api/comments/{reply.id}/like/')
+        self.assertEqual(karma.window_totals(), {author.id: KarmaTransaction.KARMA_COMMENT_LIKE})
+
+        client.delete(f'/api/comments/{root.id}/')
+        self.assertEqual(karma.window_totals(), {})
+
+    def test_backfill_rebuilds_buckets_from_ledger(self):
+        self.seed()
+        KarmaBucket.objects.all().delete()
+
+        call_command('backfill_karma_buckets', stdout=StringIO())
+
+        now = timezone.now()
+        self.assertEqual(karma.window_totals(now), self.ledger_totals(now))
+        # Buckets older than the window were not rebuilt
+        self.assertFalse(
+            KarmaBucket.objects.filter(bucket_start__lt=now - timedelta(hours=25)).exists()
+        )
+
+
+@override_settings(OUTBOX_SYNC=True)
+class LeaderboardIndexTestCase(TestCase):
+    """
+    Test the in-memory leaderboard index against the karma ledger.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.fan = User.objects.create_user('fan', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.fan)
+
+    def test_warm_index_serves_leaderboard_without_queries(self):
+        give_karma(self.author, 5)
+        self.client.get('/api/leaderboard/')
+
+        with self.assertNumQueries(0):
+            data = self.client.get('/api/leaderboard/').json()
+        self.assertEqual(data, [{'id': self.author.id, 'username': 'author', 'karma_24h': 5, 'rank': 1}])
+
+    def test_like_and_unlike_update_index_after_commit(self):
+        index = leaderboard.get_backend()
+        index.rebuild()
+        self.assertEqual(index.top(5), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.assertEqual(index.top(5)[0]['karma_24h'], KarmaTransaction.KARMA_POST_LIKE)
+        self.assertEqual(index.check(), {})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/posts/{self.post.id}/unlike/')
+        self.assertEqual(index.top(5), [])
+        self.assertEqual(index.check(), {})
+
+    def test_rolled_back_like_is_not_applied(self):
+        index = leaderboard.get_backend()
+        index.rebuild()
+
+        # The second like fails on the unique constraint and rolls back
+        PostLike.objects.create(user=self.fan, post=self.post)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.assertEqual(index.top(5), [])
+
+    def test_entries_expire_out_of_window(self):
+        now = timezone.now()
+        index = leaderboard.MemoryLeaderboard(max_age=3600)
+        index.rebuild(now)
+        index.apply(self.author.id, 'author', 5, now - timedelta(hours=23, minutes=59))
+        index.apply(self.fan.id, 'fan', 1, now - timedelta(hours=1))
+
+        self.assertEqual([row['username'] for row in index.top(5, now)], ['author', 'fan'])
+        later = now + timedelta(minutes=2)
+        self.assertEqual([row['username'] for row in index.top(5, later)], ['fan'])
+
+    def test_rebuild_matches_ledger_and_orders_by_karma(self):
+        others = [User.objects.create_user(f'user{i}', password='pass') for i in range(4)]
+        for i, user in enumerate(others):
+            give_karma(user, i + 1)
+        give_karma(self.author, 50, at=timezone.now() - timedelta(days=2))
+
+        index = leaderboard.MemoryLeaderboard(max_age=3600)
+        self.assertEqual(index.top(5), karma.top_users(limit=5))
+        self.assertEqual(index.check(), {})
+
+    def test_rebuild_reads_rollups_with_exact_edges(self):
+        now = timezone.now()
+        give_karma(self.author, 5, at=now - timedelta(hours=23, minutes=59))
+        give_karma(self.fan, 1, at=now - timedelta(hours=1))
+        # Only in the rollups: the rebuild does not read the ledger there
+        KarmaBucket.objects.create(user=self.fan, bucket_start=karma.bucket_start(now - timedelta(hours=3)), points=7)
+
+        index = leaderboard.MemoryLeaderboard(max_age=3600)
+        self.assertEqual(index.totals(now), {self.author.id: 5, self.fan.id: 8})
+        self.assertEqual(index.totals(now + timedelta(minutes=2)), {self.fan.id: 8})
+
+    def test_stale_index_is_served_while_another_rebuild_runs(self):
+        give_karma(self.author, 5)
+        index = leaderboard.MemoryLeaderboard(max_age=30)
+        index.rebuild()
+        give_karma(self.fan, 3)
+        index.built_at -= 60
+
+        rebuilding, release = threading.Event(), threading.Event()
+
+        def hold_rebuild():
+            with index._rebuild_lock:
+                rebuilding.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold_rebuild)
+        thread.start()
+        try:
+            rebuilding.wait(5)
+            with self.assertNumQueries(0):
+                self.assertEqual([row['karma_24h'] for row in index.top(5)], [5])
+        finally:
+            release.set()
+            thread.join()
+        # The karma written behind its back shows up as drift
+        with self.assertLogs('feed.leaderboard', level='WARNING'):
+            self.assertEqual([row['karma_24h'] for row in index.top(5)], [5, 3])
+
+    def test_changes_during_a_rebuild_reach_the_new_index(self):
+        index = leaderboard.MemoryLeaderboard(max_age=3600)
+        index.rebuild()
+        load = index.load
+
+        def load_then_change(now=None):
+            rows = load(now)
+            # Committed after the rows were read
+            index.apply(self.author.id, 'author', 4, timezone.now())
+            return rows
+
+        index.load = load_then_change
+        index.rebuild()
+        self.assertEqual(index.totals(), {self.author.id: 4})
+
+    def test_check_reports_drift(self):
+        index = leaderboard.MemoryLeaderboard(max_age=3600)
+        index.rebuild()
+        # Written behind the index's back, e.g. by another worker
+        give_karma(self.author, 5)
+        with self.assertLogs('feed.leaderboard', level='WARNING'):
+            self.assertEqual(index.check(), {self.author.id: (0, 5)})
+
+    def test_async_reads_rebuild_off_the_event_loop(self):
+        give_karma(self.author, 5)
+        # Stale again as soon as it is built
+        index = leaderboard.MemoryLeaderboard(max_age=-1)
+        index.rebuild()
+        # Database access from the event loop raises SynchronousOnlyOperation
+        self.assertEqual([row['karma_24h'] for row in async_to_sync(index.atop)(5)], [5])
+        self.assertEqual(async_to_sync(index.astamp)(5), [(self.author.id, 'author', 5, 1)])
+
+    @override_settings(OUTBOX_SYNC=False)
+    def test_resync_expects_karma_from_the_outbox_worker(self):
+        index = leaderboard.MemoryLeaderboard(max_age=3600)
+        index.rebuild()
+        # Applied by the worker process, which this index never hears from
+        give_karma(self.author, 5)
+        with self.assertNoLogs('feed.leaderboard', level='WARNING'):
+            index.rebuild()
+        self.assertEqual(index.totals(), {self.author.id: 5})
+
+
+# Likes measured as deployed with outbox_worker, which applies their karma
+@override_settings(OUTBOX_SYNC=False)
+class QueryPlanTestCase(TestCase):
+    """
+    Run EXPLAIN on every statement the hot endpoints issue and fail if any
+    of them degrades to a full table scan or an unindexed sort.
+
+    On Postgres the planner would happily seq-scan tables this small, so
+    sequential scans are switched off for the test transaction; anything
+    that still comes out as a Seq Scan has no usable index.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+        self.author = User.objects.create_user('author', password='pass123')
+        self.fan = User.objects.create_user('fan', password='pass123')
+        self.posts = [Post.objects.create(author=self.author, content=f'Post {i}') for i in range(5)]
+        self.post = self.posts[0]
+        root = Comment.objects.create(post=self.post, author=self.author, content='Root')
+        self.comment = Comment.objects.create(post=self.post, author=self.author, content='Reply', parent=root)
+        give_karma(self.author, 5)
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.fan)
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                return '\n'.join(row[-1] for row in cursor.fetchall())
+            cursor.execute('EXPLAIN ' + sql)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def plan_problems(self, plan):
+        problems = []
+        # Scanning a subquery's own (already bounded) output is not a table scan
+        intermediates = set(re.findall(r'(?:CO-ROUTINE|MATERIALIZE) (\S+)', plan))
+        for line in plan.splitlines():
+            line = line.strip()
+            if connection.vendor == 'sqlite':
+                # "SCAN t USING INDEX i" walks an index in order; a bare "SCAN t" reads the table
+                scan = re.match(r'SCAN (\S+)$', line)
+                if scan and scan.group(1) not in intermediates and scan.group(1) != 'CONSTANT':
+                    problems.append(line)
+                if 'TEMP B-TREE FOR ORDER BY' in line:
+                    problems.append(line)
+            elif 'Seq Scan on' in line:
+                problems.append(line)
+        return problems
+
+    def assertIndexedPlans(self, method, url, data=None, **kwargs):
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, data, **kwargs)
+        self.assertLess(response.status_code, 400, url)
+        self.assertQueriesIndexed(ctx.captured_queries, f'{method.upper()} {url}')
+        return response
+
+    def assertQueriesIndexed(self, queries, label):
+        for query in queries:
+            sql = query['sql']
+            if not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            plan = self.explain(sql)
+            problems = self.plan_problems(plan)
+            self.assertFalse(problems, f'{label} degraded to a full scan:\n{sql}\n{plan}')
+
+    def test_feed_pages(self):
+        first = self.assertIndexedPlans('get', '/api/posts/?page_size=2').json()
+        self.assertIndexedPlans('get', first['next'])
+
+    def test_hot_feed_pages(self):
+        first = self.assertIndexedPlans('get', '/api/posts/?sort=hot&page_size=2').json()
+        self.assertIndexedPlans('get', first['next'])
+
+    def test_post_detail(self):
+        self.assertIndexedPlans('get', f'/api/posts/{self.post.id}/')
+
+    def test_comment_window_expansion(self):
+        self.assertIndexedPlans('get', f'/api/posts/{self.post.id}/comments/?parent={self.comment.parent_id}')
+
+    def test_comment_list_for_post(self):
+        self.assertIndexedPlans('get', f'/api/comments/?post={self.post.id}')
+
+    def test_leaderboard_index_rebuild(self):
+        self.assertIndexedPlans('get', '/api/leaderboard/')
+
+    @override_settings(LEADERBOARD_BACKEND='feed.leaderboard.DatabaseLeaderboard')
+    def test_leaderboard_from_rollups(self):
+        leaderboard.reset()
+        self.assertIndexedPlans('get', '/api/leaderboard/')
+
+    def test_post_like_and_unlike(self):
+        self.assertIndexedPlans('post', f'/api/posts/{self.post.id}/like/')
+        self.assertIndexedPlans('post', f'/api/posts/{self.post.id}/unlike/')
+
+    def test_comment_like_and_unlike(self):
+        self.assertIndexedPlans('post', f'/api/comments/{self.comment.id}/like/')
+        self.assertIndexedPlans('post', f'/api/comments/{self.comment.id}/unlike/')
+
+    @override_settings(LEADERBOARD_BACKEND='feed.leaderboard.DatabaseLeaderboard')
+    def test_conditional_gets(self):
+        leaderboard.reset()
+        for url in ('/api/posts/?page_size=2', f'/api/posts/{self.post.id}/', '/api/leaderboard/'):
+            etag = self.client.get(url)['ETag']
+            response = self.assertIndexedPlans('get', url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+    def test_like_resource_put_and_delete(self):
+        for kind, target in (('posts', self.post), ('comments', self.comment)):
+            self.assertIndexedPlans('put', f'/api/{kind}/{target.id}/like/')
+            self.assertIndexedPlans('delete', f'/api/{kind}/{target.id}/like/')
+
+    def test_batch_like_and_unlike(self):
+        for kind, targets in (('posts', self.posts), ('comments', [self.comment])):
+            ids = {'ids': [target.id for target in targets]}
+            self.assertIndexedPlans('post', f'/api/{kind}/like-batch/', ids, format='json')
+            self.assertIndexedPlans('post', f'/api/{kind}/unlike-batch/', ids, format='json')
+
+    @override_settings(OUTBOX_SYNC=False)
+    def test_outbox_drain(self):
+        self.client.post(f'/api/posts/{self.post.id}/like/')
+        self.client.post(f'/api/comments/{self.comment.id}/like/')
+        self.client.post(f'/api/comments/{self.comment.id}/unlike/')
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(outbox.drain(), (3, 3))
+            outbox.lag()
+            outbox.purge()
+        self.assertQueriesIndexed(ctx.captured_queries, 'outbox drain')
+
+    def test_comment_create_and_delete(self):
+        response = self.assertIndexedPlans(
+            'post', '/api/comments/', {'post': self.post.id, 'content': 'Hi', 'parent': self.comment.id}
+        )
+        self.assertIndexedPlans('delete', f'/api/comments/{response.json()["id"]}/')
+
+
+class CommentWindowTestCase(TestCase):
+    """
+    Test bounded comment trees on post detail and the expansion endpoint.
+    """
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+        self.client = APIClient()
+
+    def comment(self, content, parent=None):
+        return Comment.objects.create(post=self.post, author=self.author, content=content, parent=parent)
+
+    def build_thread(self, roots=3, replies=3, depth=3):
+        def grow(parent, level):
+            if level == depth:
+                return
+            for i in range(replies):
+                child = self.comment(f'{parent.content}.{i}', parent)
+                grow(child, level + 1)
+
+        for i in range(roots):
+            grow(self.comment(f'r{i}'), 1)
+
+    def collect(self, nodes, expand_url):
+        """Walk a window, following every continuation token, and return all contents."""
+        contents = []
+        for node in nodes:
+            contents.append(node['content'])
+            contents.extend(self.collect(node['replies'], expand_url))
+            token = node['more_replies']
+            while token:
+                page = self.client.get(expand_url, {'cursor': token}).json()
+                contents.extend(self.collect(page['results'], expand_url))
+                token = page['next']
+        return contents
+
+    def test_detail_is_bounded_with_continuation_tokens(self):
+        self.build_thread()
+        data = self.client.get(f'/api/posts/{self.post.id}/?roots=2&depth=2&replies=2').json()
+
+        self.assertEqual([c['content'] for c in data['comments']], ['r0', 'r1'])
+        self.assertIsNotNone(data['more_comments'])
+
+        first = data['comments'][0]
+        self.assertEqual([c['content'] for c in first['replies']], ['r0.0', 'r0.1'])
+        # r0 has a third reply that was cut off
+        self.assertIsNotNone(first['more_replies'])
+        # r0.0 sits on the last level and has replies of its own
+        self.assertEqual(first['replies'][0]['replies'], [])
+        self.assertIsNotNone(first['replies'][0]['more_replies'])
+
+    def test_following_tokens_reaches_every_comment_once(self):
+        self.build_thread()
+        expand_url = f'/api/posts/{self.post.id}/comments/'
+        params = {'roots': 2, 'depth': 2, 'replies': 2}
+
+        data = self.client.get(f'/api/posts/{self.post.id}/', params).json()
+        contents = self.collect(data['comments'], expand_url)
+        token = data['more_comments']
+        while token:
+            page = self.client.get(expand_url, {'cursor': token, **params}).json()
+            contents.extend(self.collect(page['results'], expand_url))
+            token = page['next']
+
+        expected = list(Comment.objects.filter(post=self.post).values_list('content', flat=True))
+        self.assertEqual(sorted(contents), sorted(expected))
+        self.assertEqual(len(contents), len(set(contents)))
+
+    def test_node_budget_caps_the_whole_window(self):
+        self.build_thread()
+        expand_url = f'/api/posts/{self.post.id}/comments/'
+        params = {'nodes': 10}
+
+        def count(nodes):
+            return sum(1 + count(node['replies']) for node in nodes)
+
+        data = self.client.get(f'/api/posts/{self.post.id}/', params).json()
+        # Breadth-first: all 3 roots, then replies until the budget runs out
+        self.assertEqual(count(data['comments']), 10)
+        self.assertEqual([len(c['replies']) for c in data['comments']], [3, 3, 1])
+        self.assertIsNotNone(data['comments'][2]['more_replies'])
+
+        # Every comment is still reachable, in windows within the budget
+        contents = [node['content'] for node in self.walk(data['comments'])]
+        tokens = [node['more_replies'] for node in self.walk(data['comments'])]
+        while tokens:
+            token = tokens.pop()
+            if not token:
+                continue
+            page = self.client.get(expand_url, {'cursor': token, **params}).json()
+            self.assertLessEqual(count(page['results']), 10)
+            contents.extend(node['content'] for node in self.walk(page['results']))
+            tokens.append(page['next'])
+            tokens.extend(node['more_replies'] for node in self.walk(page['results']))
+        expected = list(Comment.objects.filter(post=self.post).values_list('content', flat=True))
+        self.assertEqual(sorted(contents), sorted(expected))
+
+    def walk(self, nodes):
+        for node in nodes:
+            yield node
+            yield from self.walk(node['replies'])
+
+    def test_expand_single_subtree(self):
+        root = self.comment('root')
+        reply = self.comment('reply', root)
+        self.comment('nested', reply)
+        self.comment('other root')
+
+        data = self.client.get(f'/api/posts/{self.post.id}/comments/', {'parent': root.id}).json()
+        self.assertEqual([c['content'] for c in data['results']], ['reply'])
+        self.assertEqual([c['content'] for c in data['results'][0]['replies']], ['nested'])
+        self.assertIsNone(data['next'])
+
+    def test_detail_query_count_does_not_grow_with_thread(self):
+        self.build_thread(roots=2, replies=2, depth=3)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(f'/api/posts/{self.post.id}/?roots=5&depth=3&replies=5')
+
+        self.build_thread(roots=6, replies=6, depth=4)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(f'/api/posts/{self.post.id}/?roots=5&depth=3&replies=5')
+
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(len(response.json()['comments']), 5)
+
+    def test_rejects_bad_or_foreign_tokens(self):
+        other_post = Post.objects.create(author=self.author, content='Other')
+        foreign = Comment.objects.create(post=other_post, author=self.author, content='x')
+
+        url = f'/api/posts/{self.post.id}/comments/'
+        self.assertEqual(self.client.get(url, {'cursor': 'garbage'}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'parent': foreign.id}).status_code, 404)
+
+
+class CommentPathTestCase(TestCase):
+    """
+    Test the materialized path kept on comments.
+    """
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+
+    def comment(self, content, parent=None):
+        return Comment.objects.create(post=self.post, author=self.author, content=content, parent=parent)
+
+    def build(self):
+        a = self.comment('a')
+        b = self.comment('b')
+        a1 = self.comment('a1', a)
+        b1 = self.comment('b1', b)
+        a2 = self.comment('a2', a)
+        a1x = self.comment('a1x', a1)
+        return a, b, a1, b1, a2, a1x
+
+    def client_post_comment(self, content, parent=None):
+        client = APIClient()
+        client.force_authenticate(user=self.author)
+        data = {'post': self.post.id, 'content': content}
+        if parent:
+            data['parent'] = parent
+        return client.post('/api/comments/', data).json()['id']
+
+    def test_path_and_depth_set_on_create(self):
+        root = self.client_post_comment('root')
+        reply = self.client_post_comment('reply', parent=root)
+
+        root = Comment.objects.get(pk=root)
+        reply = Comment.objects.get(pk=reply)
+        self.assertEqual(root.path, Comment.path_segment(root.id))
+        self.assertEqual(reply.path, root.path + Comment.path_segment(reply.id))
+        self.assertEqual((root.depth, reply.depth), (0, 1))
+
+    def test_thread_is_in_display_order(self):
+        self.build()
+        contents = list(Comment.objects.thread(self.post).values_list('content', flat=True))
+        self.assertEqual(contents, ['a', 'a1', 'a1x', 'a2', 'b', 'b1'])
+
+    def test_subtree_is_one_range_and_respects_depth(self):
+        a, b, a1, b1, a2, a1x = self.build()
+
+        contents = list(Comment.objects.subtree(a).values_list('content', flat=True))
+        self.assertEqual(contents, ['a', 'a1', 'a1x', 'a2'])
+        self.assertEqual(Comment.objects.subtree(a).count() - 1, 3)
+
+        shallow = Comment.objects.subtree(a, max_depth=1).values_list('content', flat=True)
+        self.assertEqual(list(shallow), ['a', 'a1', 'a2'])
+
+    def test_subtree_does_not_leak_into_id_prefix_neighbours(self):
+        first = self.comment('first')
+        # Push ids past 10 so "1" is a textual prefix of "1x" ids
+        for i in range(10):
+            self.comment(f'filler {i}')
+        self.assertEqual(Comment.objects.subtree(first).count(), 1)
+
+    def test_build_comment_tree_on_partial_subtree(self):
+        a, *_ = self.build()
+        partial = list(Comment.objects.subtree(a, max_depth=1))[1:]  # drop `a` itself
+
+        roots = build_comment_tree(partial)
+        self.assertEqual([c.content for c in roots], ['a1', 'a2'])
+        self.assertEqual(roots[0].children, [])
+
+    def test_migration_backfills_paths(self):
+        from django.apps import apps
+        migration = importlib.import_module('feed.migrations.0006_comment_materialized_path')
+
+        self.build()
+        expected = list(Comment.objects.order_by('id').values_list('path', 'depth'))
+        Comment.objects.update(path='', depth=0)
+
+        migration.backfill_paths(apps, None)
+        self.assertEqual(list(Comment.objects.order_by('id').values_list('path', 'depth')), expected)
+
+    def descendant_counts(self):
+        return dict(Comment.objects.values_list('content', 'descendant_count'))
+
+    def test_descendant_counts_follow_creates_and_deletes(self):
+        a, b, a1, b1, a2, a1x = self.build()
+        self.assertEqual(self.descendant_counts(), {'a': 3, 'a1': 1, 'a1x': 0, 'a2': 0, 'b': 1, 'b1': 0})
+
+        client = APIClient()
+        client.force_authenticate(user=self.author)
+        client.delete(f'/api/comments/{a1.id}/')
+        self.assertEqual(self.descendant_counts(), {'a': 1, 'a2': 0, 'b': 1, 'b1': 0})
+
+        data = client.get(f'/api/comments/{a.id}/').json()
+        self.assertEqual(data['descendant_count'], 1)
+
+    def test_migration_backfills_descendant_counts(self):
+        from django.apps import apps
+        migration = importlib.import_module('feed.migrations.0012_comment_descendant_count')
+
+        self.build()
+        expected = self.descendant_counts()
+        Comment.objects.update(descendant_count=0)
+
+        migration.backfill_descendant_counts(apps, None)
+        self.assertEqual(self.descendant_counts(), expected)
+
+    def test_parent_cannot_be_changed(self):
+        a, b, a1, *_ = self.build()
+        client = APIClient()
+        client.force_authenticate(user=self.author)
+
+        response = client.patch(f'/api/comments/{a1.id}/', {'parent': b.id}, format='json')
+        self.assertEqual(response.status_code, 400)
+        a1.refresh_from_db()
+        self.assertEqual((a1.parent_id, a1.path), (a.id, a.path + Comment.path_segment(a1.id)))
+
+        response = client.patch(f'/api/comments/{a1.id}/', {'parent': a.id, 'content': 'edited'}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_deletes_reach_replies_outside_their_parents_path(self):
+        a, b, a1, b1, a2, a1x = self.build()
+        other = Post.objects.create(author=self.author, content='Other post')
+        c = Comment.objects.create(post=other, author=self.author, content='c')
+        c1 = Comment.objects.create(post=other, author=self.author, content='c1', parent=c)
+        # Written before paths were kept valid: a1 moved under b, keeping
+        # its old path, c1 moved under b from the other post, and a reply
+        # on the other post under a2
+        Comment.objects.filter(pk__in=[a1.pk, c1.pk]).update(parent=b)
+        stray = Comment.objects.create(post=other, author=self.author, content='stray', parent=a2)
+        for post, comment_count in ((self.post, 6), (other, 3)):
+            Post.objects.filter(pk=post.pk).update(
+                comment_count=comment_count, hot_score=hot.score(post.created_at, 0, comment_count)
+            )
+        CommentLike.objects.create(user=self.author, comment=a1x)
+        client = APIClient()
+        client.force_authenticate(user=self.author)
+
+        def counts():
+            return (
+                dict(Post.objects.values_list('id', 'comment_count')),
+                dict(Comment.objects.values_list('content', 'descendant_count')),
+            )
+
+        self.assertEqual(client.delete(f'/api/comments/{b.id}/').status_code, 204)
+        self.assertEqual(set(Comment.objects.values_list('content', flat=True)), {'a', 'a2', 'c', 'stray'})
+        self.assertFalse(CommentLike.objects.exists())
+        self.assertEqual(counts(), (
+            {self.post.id: 2, other.id: 2},
+            {'a': 2, 'a2': 1, 'c': 0, 'stray': 0},
+        ))
+
+        self.assertEqual(client.delete(f'/api/posts/{self.post.id}/').status_code, 204)
+        self.assertFalse(Comment.objects.filter(pk=stray.pk).exists())
+        self.assertEqual(counts(), ({other.id: 1}, {'c': 0}))
+        other.refresh_from_db()
+        self.assertAlmostEqual(other.hot_score, hot.score(other.created_at, 0, 1))
+
+    def test_reply_to_a_comment_on_another_post_is_rejected(self):
+        other = Post.objects.create(author=self.author, content='Other post')
+        foreign = Comment.objects.create(post=other, author=self.author, content='elsewhere')
+        client = APIClient()
+        client.force_authenticate(user=self.author)
+
+        response = client.post('/api/comments/', {'post': self.post.id, 'parent': foreign.id, 'content': 'Hi'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
+        self.assertFalse(Comment.objects.filter(post=self.post).exists())
+
+
+class CommentTreeRendererTestCase(TestCase):
+    """
+    Test that render_comment_tree matches CommentSerializer byte for byte.
+    """
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pass123')
+        self.viewer = User.objects.create_user('viewer', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+
+        a = Comment.objects.create(post=self.post, author=self.author, content='a')
+        a1 = Comment.objects.create(post=self.post, author=self.viewer, content='a1', parent=a)
+        Comment.objects.create(post=self.post, author=self.author, content='a1x', parent=a1)
+        Comment.objects.create(post=self.post, author=self.author, content='b')
+        CommentLike.objects.create(comment=a1, user=self.viewer)
+        Comment.objects.filter(pk=a1.pk).update(like_count=1)
+
+    def context_for(self, user):
+        request = APIRequestFactory().get('/')
+        request.user = user
+        ids = Comment.objects.filter(post=self.post).values_list('id', flat=True)
+        return {'request': request, 'liked_comment_ids': likes.liked_ids(user, Comment, ids)}
+
+    def serializer_output(self, context):
+        comments = list(
+            Comment.objects.filter(post=self.post).select_related('author').order_by('path')
+        )
+        for comment in comments:
+            comment.more_replies = None
+        comments[-1].more_replies = 'token'
+        return CommentSerializer(build_comment_tree(comments), many=True, context=context).data
+
+    def renderer_output(self, context):
+        rows = list(threads.comment_queryset().filter(post=self.post).order_by('path'))
+        for row in rows:
+            row['more_replies'] = None
+        rows[-1]['more_replies'] = 'token'
+        return render_comment_tree(rows, context)
+
+    def test_output_is_byte_identical(self):
+        for user in (AnonymousUser(), self.viewer):
+            context = self.context_for(user)
+            expected = JSONRenderer().render(self.serializer_output(context))
+            actual = JSONRenderer().render(self.renderer_output(context))
+            self.assertEqual(actual, expected)
+
+    def test_is_liked_follows_viewer(self):
+        rendered = self.renderer_output(self.context_for(self.viewer))
+        a1 = rendered[0]['replies'][0]
+        self.assertTrue(a1['is_liked'])
+        self.assertFalse(rendered[0]['is_liked'])
+
+    def test_benchmark_command_checks_identity(self):
+        out = StringIO()
+        call_command('bench_comment_tree', sizes='50,200', repeat=1, stdout=out)
+        self.assertIn('byte-identical', out.getvalue())
+
+
+@override_settings(CACHES=TREE_CACHES)
+class CommentTreeCacheTestCase(TestCase):
+    """
+    Test the versioned comment tree cache and the per-viewer like overlay.
+    """
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pass123')
+        self.viewer = User.objects.create_user('viewer', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+        self.root = Comment.objects.create(post=self.post, author=self.author, content='root')
+        Comment.objects.create(post=self.post, author=self.author, content='reply', parent=self.root)
+        self.url = f'/api/posts/{self.post.id}/'
+        self.client = APIClient()
+        tree_cache.reset_stats()
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        return client
+
+    def test_second_read_is_served_from_cache(self):
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(self.url)
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(self.url)
+
+        self.assertLess(len(second), len(first))
+        self.assertEqual(response.json()['comments'][0]['replies'][0]['content'], 'reply')
+        self.assertEqual(tree_cache.stats(), {'hits': 1, 'misses': 1})
+
+    def test_new_and_deleted_comments_show_up(self):
+        self.client.get(self.url)
+
+        client = self.client_for(self.author)
+        new_id = client.post('/api/comments/', {'post': self.post.id, 'content': 'late'}).json()['id']
+        contents = [c['content'] for c in self.client.get(self.url).json()['comments']]
+        self.assertEqual(contents, ['root', 'late'])
+
+        client.delete(f'/api/comments/{new_id}/')
+        contents = [c['content'] for c in self.client.get(self.url).json()['comments']]
+        self.assertEqual(contents, ['root'])
+
+    def test_like_updates_count_and_is_liked_is_per_viewer(self):
+        self.client.get(self.url)
+        self.client_for(self.viewer).post(f'/api/comments/{self.root.id}/like/')
+
+        as_viewer = self.client_for(self.viewer).get(self.url).json()['comments'][0]
+        as_author = self.client_for(self.author).get(self.url).json()['comments'][0]
+        anonymous = self.client.get(self.url).json()['comments'][0]
+
+        self.assertEqual(as_viewer['like_count'], 1)
+        self.assertTrue(as_viewer['is_liked'])
+        self.assertFalse(as_viewer['replies'][0]['is_liked'])
+        self.assertFalse(as_author['is_liked'])
+        self.assertFalse(anonymous['is_liked'])
+        # One render after the like, shared by all three viewers
+        self.assertEqual(tree_cache.stats(), {'hits': 2, 'misses': 2})
+
+    def test_overlay_is_one_query(self):
+        client = self.client_for(self.viewer)
+        client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            client.get(self.url)
+        like_lookups = [q for q in queries if 'feed_commentlike' in q['sql']]
+        self.assertEqual(len(like_lookups), 1)
+
+    def test_stats_endpoint_is_admin_only(self):
+        self.client.get(self.url)
+        self.assertEqual(self.client_for(self.viewer).get('/api/cache-stats/').status_code, 403)
+
+        admin = User.objects.create_superuser('admin', password='pass123')
+        data = self.client_for(admin).get('/api/cache-stats/').json()
+        self.assertEqual(data['comment_tree']['misses'], 1)
+
+    @override_settings(CACHES=settings.CACHES)
+    def test_not_cached_without_a_shared_cache(self):
+        # The default: a per-process cache would keep serving trees that
+        # another worker has invalidated
+        self.client.get(self.url)
+        self.client.get(self.url)
+        self.assertEqual(tree_cache.stats(), {'hits': 0, 'misses': 2})
+
+
+class ViewerLikesTestCase(TestCase):
+    """
+    Test that is_liked comes from one set lookup per request rather than a
+    subquery per row.
+    """
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pass123')
+        self.viewer = User.objects.create_user('viewer', password='pass123')
+        self.anonymous = APIClient()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.viewer)
+
+    def make_posts(self, count):
+        posts = [Post.objects.create(author=self.author, content=f'Post {i}') for i in range(count)]
+        PostLike.objects.create(user=self.viewer, post=posts[0])
+        return posts
+
+    def count_queries(self, client, url, data=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def assert_same_cost(self, url, data=None):
+        anonymous, _ = self.count_queries(self.anonymous, url, data)
+        authenticated, response = self.count_queries(self.client, url, data)
+        # The only difference is the single liked-ids lookup
+        self.assertEqual(authenticated, anonymous + 1)
+        return authenticated, response
+
+    def test_feed_costs_the_same_for_any_viewer_and_page_size(self):
+        posts = self.make_posts(30)
+        small, _ = self.assert_same_cost('/api/posts/', {'page_size': 5})
+        large, response = self.assert_same_cost('/api/posts/', {'page_size': 30})
+        self.assertEqual(small, large)
+
+        liked = {post['id'] for post in response.json()['results'] if post['is_liked']}
+        self.assertEqual(liked, {posts[0].id})
+
+    def test_comment_list_costs_the_same_for_any_viewer(self):
+        post = self.make_posts(1)[0]
+        comments = [Comment.objects.create(post=post, author=self.author, content=f'c{i}') for i in range(10)]
+        CommentLike.objects.create(user=self.viewer, comment=comments[3])
+
+        _, response = self.assert_same_cost('/api/comments/', {'post': post.id})
+        liked = [comment['id'] for comment in response.json() if comment['is_liked']]
+        self.assertEqual(liked, [comments[3].id])
+
+    def test_post_detail_is_liked(self):
+        post = self.make_posts(1)[0]
+        self.assertTrue(self.client.get(f'/api/posts/{post.id}/').json()['is_liked'])
+        self.assertFalse(self.anonymous.get(f'/api/posts/{post.id}/').json()['is_liked'])
+
+    def test_no_correlated_like_subqueries(self):
+        self.make_posts(3)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/posts/')
+        for query in queries:
+            self.assertNotIn('EXISTS', query['sql'].upper())
+
+
+@override_settings(OUTBOX_SYNC=True)
+class BatchLikeTestCase(TestCase):
+    """
+    Test the batch like/unlike endpoints.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.other = User.objects.create_user('other', password='pass123')
+        self.fan = User.objects.create_user('fan', password='pass123')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.fan)
+
+    def make_posts(self, count, author=None):
+        return [Post.objects.create(author=author or self.author, content=f'Post {i}') for i in range(count)]
+
+    def batch(self, kind, action, ids):
+        response = self.client.post(f'/api/{kind}/{action}-batch/', {'ids': ids}, format='json')
+        self.assertEqual(response.status_code, 200)
+        return {item['id']: item['status'] for item in response.json()['results']}
+
+    def test_like_batch_reports_each_id(self):
+        posts = self.make_posts(3)
+        self.client.post(f'/api/posts/{posts[0].id}/like/')
+
+        results = self.batch('posts', 'like', [p.id for p in posts] + [999999])
+        self.assertEqual(results, {
+            posts[0].id: 'already_liked',
+            posts[1].id: 'liked',
+            posts[2].id: 'liked',
+            999999: 'not_found',
+        })
+        self.assertEqual(
+            list(Post.objects.filter(id__in=[p.id for p in posts]).order_by('id').values_list('like_count', flat=True)),
+            [1, 1, 1]
+        )
+
+    def test_like_batch_credits_authors(self):
+        mine = self.make_posts(2)
+        theirs = self.make_posts(1, author=self.other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.batch('posts', 'like', [p.id for p in mine + theirs])
+
+        self.assertEqual(karma.window_totals(), {self.author.id: 10, self.other.id: 5})
+        self.assertEqual(
+            KarmaTransaction.objects.filter(post_like__user=self.fan).count(), 3
+        )
+        top = {row['username']: row['karma_24h'] for row in leaderboard.top_users()}
+        self.assertEqual(top, {'author': 10, 'other': 5})
+
+    def test_unlike_batch_takes_karma_back(self):
+        posts = self.make_posts(3)
+        self.batch('posts', 'like', [p.id for p in posts[:2]])
+
+        results = self.batch('posts', 'unlike', [p.id for p in posts])
+        self.assertEqual(results, {posts[0].id: 'unliked', posts[1].id: 'unliked', posts[2].id: 'not_liked'})
+        self.assertFalse(PostLike.objects.exists())
+        self.assertFalse(KarmaTransaction.objects.exists())
+        self.assertEqual(karma.window_totals(), {})
+        self.assertEqual(sum(Post.objects.values_list('like_count', flat=True)), 0)
+
+    @override_settings(OUTBOX_SYNC=False)
+    def test_query_count_does_not_depend_on_batch_size(self):
+        # Karma is applied later by the outbox worker, not in the request
+        small = [p.id for p in self.make_posts(2)]
+        large = [p.id for p in self.make_posts(40, author=self.other)]
+
+        counts = []
+        for ids in (small, large):
+            for action in ('like', 'unlike'):
+                with CaptureQueriesContext(connection) as queries:
+                    self.batch('posts', action, ids)
+                counts.append((action, len(queries)))
+        self.assertEqual(counts[:2], counts[2:])
+
+    def test_comment_batch_updates_the_cached_tree(self):
+        post = self.make_posts(1)[0]
+        comments = [Comment.objects.create(post=post, author=self.author, content=f'c{i}') for i in range(3)]
+        url = f'/api/posts/{post.id}/'
+        self.client.get(url)
+
+        self.batch('comments', 'like', [c.id for c in comments])
+        tree = self.client.get(url).json()['comments']
+        self.assertEqual([(c['like_count'], c['is_liked']) for c in tree], [(1, True)] * 3)
+
+        self.batch('comments', 'unlike', [comments[0].id])
+        tree = self.client.get(url).json()['comments']
+        self.assertEqual([c['like_count'] for c in tree], [0, 1, 1])
+
+    def test_rejects_bad_batches(self):
+        url = '/api/posts/like-batch/'
+        self.assertEqual(self.client.post(url, {'ids': []}, format='json').status_code, 400)
+        self.assertEqual(self.client.post(url, {'ids': ['x']}, format='json').status_code, 400)
+        too_many = list(range(likes.MAX_BATCH + 1))
+        self.assertEqual(self.client.post(url, {'ids': too_many}, format='json').status_code, 400)
+        self.assertEqual(APIClient().post(url, {'ids': [1]}, format='json').status_code, 403)
+
+
+@override_settings(OUTBOX_SYNC=False)
+class OutboxTestCase(TestCase):
+    """
+    Test that likes queue their karma in the outbox and the worker applies it.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.fan = User.objects.create_user('fan', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.fan)
+
+    def like(self):
+        return self.client.post(f'/api/posts/{self.post.id}/like/')
+
+    def unlike(self):
+        return self.client.post(f'/api/posts/{self.post.id}/unlike/')
+
+    def test_like_queues_karma_until_drained(self):
+        self.like()
+        self.assertFalse(KarmaTransaction.objects.exists())
+        self.assertEqual(outbox.lag()['pending'], 1)
+
+        self.assertEqual(outbox.drain(), (1, 1))
+        txn = KarmaTransaction.objects.get()
+        self.assertEqual((txn.user, txn.points), (self.author, KarmaTransaction.KARMA_POST_LIKE))
+        # Karma keeps the time of the like, not of the drain
+        self.assertEqual(txn.created_at, PostLike.objects.get().created_at)
+        self.assertEqual(karma.window_totals(), {self.author.id: KarmaTransaction.KARMA_POST_LIKE})
+        self.assertEqual(outbox.lag()['pending'], 0)
+
+    def test_unlike_revokes_through_the_worker(self):
+        self.like()
+        outbox.drain()
+        self.unlike()
+        self.assertEqual(KarmaTransaction.objects.count(), 1)
+
+        outbox.drain()
+        self.assertFalse(KarmaTransaction.objects.exists())
+        self.assertEqual(karma.window_totals(), {})
+
+    def test_unlike_before_drain_cancels_the_credit(self):
+        self.like()
+        self.unlike()
+        self.assertEqual(outbox.drain(), (2, 2))
+        self.assertFalse(KarmaTransaction.objects.exists())
+        self.assertEqual(karma.window_totals(), {})
+
+    def test_duplicate_keys_are_ignored(self):
+        self.like()
+        like = PostLike.objects.get()
+        karma.credit_like(like, self.author, 'post_like', KarmaTransaction.KARMA_POST_LIKE)
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+        outbox.drain()
+        karma.credit_like(like, self.author, 'post_like', KarmaTransaction.KARMA_POST_LIKE)
+        self.assertEqual(outbox.drain(), (0, 0))
+        self.assertEqual(KarmaTransaction.objects.count(), 1)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_failures_are_retried_with_backoff_then_parked(self):
+        calls = []
+
+        def flaky(payload):
+            calls.append(payload)
+            raise RuntimeError('boom')
+
+        outbox.HANDLERS['test.flaky'] = flaky
+        self.addCleanup(outbox.HANDLERS.pop, 'test.flaky')
+        outbox.enqueue('test.flaky', 'flaky:1', {'n': 1})
+
+        now = timezone.now()
+        with self.assertLogs('feed.outbox', level='ERROR'):
+            self.assertEqual(outbox.drain(now=now), (1, 0))
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.attempts, 1)
+        self.assertIn('boom', event.last_error)
+        self.assertEqual(event.available_at, now + outbox.retry_delay(1))
+
+        # Not due yet
+        self.assertEqual(outbox.drain(now=now), (0, 0))
+        with self.assertLogs('feed.outbox', level='ERROR'):
+            outbox.drain(now=event.available_at)
+        event.refresh_from_db()
+        self.assertIsNotNone(event.failed_at)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(outbox.lag()['failed'], 1)
+
+    def test_sync_mode_applies_in_the_request(self):
+        with self.settings(OUTBOX_SYNC=True):
+            self.like()
+            self.unlike()
+            self.like()
+        self.assertEqual(KarmaTransaction.objects.count(), 1)
+        self.assertEqual(karma.window_totals(), {self.author.id: KarmaTransaction.KARMA_POST_LIKE})
+        # Nothing queued, so nothing for a worker to purge
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_worker_command_drains_and_reports(self):
+        self.like()
+        out = StringIO()
+        call_command('outbox_worker', once=True, stdout=out)
+        self.assertIn('Applied 1 event(s); 0 pending, 0 failed', out.getvalue())
+        self.assertEqual(KarmaTransaction.objects.count(), 1)
+
+    def test_lag_is_age_of_oldest_pending_event(self):
+        self.like()
+        later = timezone.now() + timedelta(seconds=30)
+        self.assertGreaterEqual(outbox.lag(now=later)['lag_seconds'], 30)
+
+
+@override_settings(OUTBOX_SYNC=True, KARMA_LEDGER_RETENTION_DAYS=7)
+class KarmaCompactionTestCase(TestCase):
+    """
+    Test folding old ledger rows into daily totals.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.fans = [User.objects.create_user(f'fan{i}', password='pass123') for i in range(4)]
+        self.post = Post.objects.create(author=self.author, content='Test post')
+        self.comment = Comment.objects.create(post=self.post, author=self.author, content='Hi')
+
+    def old_like(self, fan, days_ago, comment=False):
+        """A like (and its karma) made `days_ago` days ago."""
+        at = timezone.now() - timedelta(days=days_ago)
+        if comment:
+            like = CommentLike.objects.create(user=fan, comment=self.comment)
+            CommentLike.objects.filter(pk=like.pk).update(created_at=at)
+            Comment.objects.filter(pk=self.comment.pk).update(like_count=F('like_count') + 1)
+            karma.record(self.author, 'comment_like', KarmaTransaction.KARMA_COMMENT_LIKE, at=at, comment_like=like)
+        else:
+            like = PostLike.objects.create(user=fan, post=self.post)
+            PostLike.objects.filter(pk=like.pk).update(created_at=at)
+            Post.objects.filter(pk=self.post.pk).update(like_count=F('like_count') + 1)
+            karma.record(self.author, 'post_like', KarmaTransaction.KARMA_POST_LIKE, at=at, post_like=like)
+        return like
+
+    def compact(self, **options):
+        out = StringIO()
+        call_command('compact_karma', stdout=out, **options)
+        return out.getvalue()
+
+    def test_old_rows_fold_into_days_and_totals_stay_exact(self):
+        for i, days_ago in enumerate([30, 30, 10]):
+            self.old_like(self.fans[i], days_ago)
+        self.old_like(self.fans[3], 0)
+        before = karma.all_time_totals()
+
+        output = self.compact(batch_size=2)
+        self.assertIn('Compacted 3 ledger row(s)', output)
+        self.assertEqual(KarmaTransaction.objects.count(), 1)
+        self.assertEqual(KarmaDaily.objects.count(), 2)
+        self.assertEqual(sorted(KarmaDaily.objects.values_list('points', flat=True)), [5, 10])
+        self.assertEqual(karma.all_time_totals(), before)
+        self.assertEqual(karma.all_time_totals([self.author.id]), {self.author.id: 20})
+
+        # Nothing left to do the second time
+        self.assertIn('Compacted 0 ledger row(s)', self.compact())
+
+    def test_leaderboard_window_is_never_compacted(self):
+        self.old_like(self.fans[0], 1.5)
+        self.compact(days=0)
+        self.assertEqual(KarmaTransaction.objects.count(), 1)
+
+    def test_unlike_of_a_compacted_like(self):
+        self.old_like(self.fans[0], 30)
+        self.old_like(self.fans[1], 30, comment=True)
+        self.compact()
+
+        for fan, url in ((self.fans[0], f'/api/posts/{self.post.id}/unlike/'),
+                         (self.fans[1], f'/api/comments/{self.comment.id}/unlike/')):
+            client = APIClient()
+            client.force_authenticate(user=fan)
+            self.assertEqual(client.post(url).status_code, 200)
+
+        self.assertEqual(karma.all_time_totals(), {})
+
+    def test_deleting_a_post_takes_back_compacted_karma(self):
+        self.old_like(self.fans[0], 30)
+        self.old_like(self.fans[1], 30, comment=True)
+        self.old_like(self.fans[2], 0)
+        self.compact()
+
+        client = APIClient()
+        client.force_authenticate(user=self.author)
+        self.assertEqual(client.delete(f'/api/posts/{self.post.id}/').status_code, 204)
+        self.assertEqual(karma.all_time_totals(), {})
+
+    def test_uncredited_likes_take_nothing_back(self):
+        # Old likes whose credit event never got applied, e.g. parked
+        at = timezone.now() - timedelta(days=30)
+        PostLike.objects.filter(pk=PostLike.objects.create(user=self.fans[0], post=self.post).pk).update(created_at=at)
+        CommentLike.objects.filter(
+            pk=CommentLike.objects.create(user=self.fans[1], comment=self.comment).pk
+        ).update(created_at=at)
+        self.old_like(self.fans[2], 30, comment=True)
+        self.compact()
+
+        client = APIClient()
+        client.force_authenticate(user=self.fans[0])
+        self.assertEqual(client.post(f'/api/posts/{self.post.id}/unlike/').status_code, 200)
+        self.assertEqual(karma.all_time_totals(), {self.author.id: 1})
+
+        client.force_authenticate(user=self.author)
+        self.assertEqual(client.delete(f'/api/comments/{self.comment.id}/').status_code, 204)
+        self.assertEqual(karma.all_time_totals(), {})
+        self.assertEqual(list(KarmaDaily.objects.values_list('points', flat=True)), [0])
+
+    @override_settings(OUTBOX_SYNC=False)
+    def test_ledger_rows_of_deleted_likes_are_left_for_their_revoke(self):
+        like = self.old_like(self.fans[0], 30)
+        client = APIClient()
+        client.force_authenticate(user=self.fans[0])
+        self.assertEqual(client.post(f'/api/posts/{self.post.id}/unlike/').status_code, 200)
+
+        self.assertIn('Compacted 0 ledger row(s)', self.compact())
+        outbox.drain()
+        self.assertFalse(KarmaTransaction.objects.filter(post_like_id=like.id).exists())
+        self.assertEqual(karma.all_time_totals(), {})
+        self.assertFalse(KarmaDaily.objects.exists())
+
+    @override_settings(OUTBOX_SYNC=False)
+    def test_migration_marks_compacted_likes(self):
+        from django.apps import apps
+        migration = importlib.import_module('feed.migrations.0013_like_karma_compacted')
+
+        compacted = self.old_like(self.fans[0], 30)
+        self.old_like(self.fans[1], 0)
+        self.compact()
+        uncredited = PostLike.objects.create(user=self.fans[2], post=self.post)
+        PostLike.objects.filter(pk=uncredited.pk).update(created_at=timezone.now() - timedelta(days=30))
+        karma.credit_like(uncredited, self.author, 'post_like', KarmaTransaction.KARMA_POST_LIKE)
+        # Its credit event is parked
+        OutboxEvent.objects.update(failed_at=timezone.now())
+        PostLike.objects.update(karma_compacted=False)
+
+        migration.mark_compacted_likes(apps, None)
+        self.assertEqual(
+            set(PostLike.objects.filter(karma_compacted=True).values_list('id', flat=True)), {compacted.id}
+        )
+
+    def test_old_buckets_are_pruned(self):
+        give_karma(self.author, 5, at=timezone.now() - timedelta(days=3))
+        give_karma(self.author, 5)
+        self.assertIn('pruned 1 old bucket(s)', self.compact())
+        self.assertEqual(KarmaBucket.objects.count(), 1)
+        self.assertEqual(karma.window_totals(), {self.author.id: 5})
+
+
+@override_settings(OUTBOX_SYNC=False)
+class IdempotentLikeTestCase(TestCase):
+    """
+    Test the PUT/DELETE like resource and that likes never fall back on a
+    failing INSERT.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.fan = User.objects.create_user('fan', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+        self.comment = Comment.objects.create(post=self.post, author=self.author, content='Comment')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.fan)
+
+    def statements(self, method, url):
+        """Run one request and return its response and SQL statements."""
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url)
+        # The test case's own transaction turns the view's atomic() into savepoints
+        sql = [q['sql'] for q in ctx.captured_queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE'))]
+        return response, sql
+
+    def test_duplicate_taps_like_once(self):
+        url = f'/api/posts/{self.post.id}/like/'
+        first, first_sql = self.statements('put', url)
+        self.assertEqual(first.json(), {'liked': True, 'changed': True})
+        for _ in range(5):
+            response, sql = self.statements('put', url)
+            self.assertEqual(response.json(), {'liked': True, 'changed': False})
+            # Post lookup and the conflict-free insert; nothing to roll back
+            self.assertEqual(len(sql), 2, sql)
+            self.assertFalse([s for s in sql if 'ROLLBACK' in s.upper()])
+        # Post lookup, insert, counter and one outbox event
+        self.assertEqual(len(first_sql), 4, first_sql)
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.assertEqual(PostLike.objects.count(), 1)
+        self.assertEqual(outbox.drain(), (1, 1))
+        self.assertEqual(KarmaTransaction.objects.get().user, self.author)
+
+    def test_delete_is_idempotent(self):
+        url = f'/api/comments/{self.comment.id}/like/'
+        self.client.put(url)
+        response, sql = self.statements('delete', url)
+        self.assertEqual(response.json(), {'liked': False, 'changed': True})
+        self.assertEqual(len(sql), 4, sql)
+        response, sql = self.statements('delete', url)
+        self.assertEqual(response.json(), {'liked': False, 'changed': False})
+        self.assertEqual(len(sql), 2, sql)
+
+        self.comment.refresh_from_db()
+        self.assertEqual(self.comment.like_count, 0)
+        self.assertEqual(outbox.drain(), (2, 2))
+        self.assertFalse(KarmaTransaction.objects.exists())
+
+    @override_settings(CACHES=TREE_CACHES)
+    def test_like_shows_up_in_cached_comment_tree(self):
+        detail = f'/api/posts/{self.post.id}/'
+        self.client.get(detail)
+        self.client.put(f'/api/comments/{self.comment.id}/like/')
+        comment = self.client.get(detail).json()['comments'][0]
+        self.assertEqual((comment['like_count'], comment['is_liked']), (1, True))
+        self.client.delete(f'/api/comments/{self.comment.id}/like/')
+        comment = self.client.get(detail).json()['comments'][0]
+        self.assertEqual((comment['like_count'], comment['is_liked']), (0, False))
+
+    def test_post_actions_keep_their_responses(self):
+        url = f'/api/posts/{self.post.id}'
+        self.assertEqual(self.client.post(f'{url}/like/').json(), {'liked': True, 'message': 'Post liked'})
+        response = self.client.post(f'{url}/like/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Already liked this post'})
+        self.assertEqual(self.client.post(f'{url}/unlike/').json(), {'liked': False, 'message': 'Post unliked'})
+        response = self.client.post(f'{url}/unlike/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'You have not liked this post'})
+
+    def test_requires_login(self):
+        self.client.force_authenticate(user=None)
+        self.assertEqual(self.client.put(f'/api/posts/{self.post.id}/like/').status_code, 403)
+        self.assertFalse(PostLike.objects.exists())
+
+
+@tag(THREADS_TAG)
+@override_settings(OUTBOX_SYNC=True)
+class ConcurrentLikeTestCase(TransactionTestCase):
+    """
+    Test that simultaneous likes of the same post by the same user, each
+    in its own connection and transaction, add one like and one credit,
+    and how many statements each of those requests runs.
+    """
+    databases = {'default'}
+    TAPS = 4
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # The test runner moves the database to disk for THREADS_TAG
+            raise unittest.SkipTest('needs an SQLite test database on disk')
+
+    def setUp(self):
+        leaderboard.reset()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.fan = User.objects.create_user('fan', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+
+    def tap_concurrently(self, method, url):
+        """
+        Send the request from TAPS threads at once; returns their response
+        bodies with the SQL statements each one ran.
+        """
+        barrier = threading.Barrier(self.TAPS)
+        results, errors = [], []
+
+        def tap():
+            client = APIClient()
+            client.force_authenticate(user=self.fan)
+            try:
+                barrier.wait(5)
+                with CaptureQueriesContext(connection) as ctx:
+                    response = getattr(client, method)(url)
+                # Leave out BEGIN / COMMIT and the savepoints
+                sql = [
+                    q['sql'] for q in ctx.captured_queries
+                    if not q['sql'].startswith(('BEGIN', 'COMMIT', 'SAVEPOINT', 'RELEASE'))
+                ]
+                results.append((response.json(), sql))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=tap) for _ in range(self.TAPS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), self.TAPS)
+        return results
+
+    def test_simultaneous_puts_like_once(self):
+        results = self.tap_concurrently('put', f'/api/posts/{self.post.id}/like/')
+        winners = [sql for body, sql in results if body == {'liked': True, 'changed': True}]
+        losers = [sql for body, sql in results if body == {'liked': True, 'changed': False}]
+        self.assertEqual((len(winners), len(losers)), (1, self.TAPS - 1))
+        # Post lookup, insert, counter and the karma, applied inline: like
+        # check, ledger row and rollup bucket (missing, so an UPDATE then an
+        # INSERT)
+        self.assertEqual(len(winners[0]), 7, winners[0])
+        for sql in losers:
+            # Post lookup and the conflict-free insert, whoever got there first
+            self.assertEqual(len(sql), 2, sql)
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 1)
+        self.assertEqual(PostLike.objects.count(), 1)
+        self.assertEqual(KarmaTransaction.objects.count(), 1)
+        self.assertEqual(karma.window_totals(), {self.author.id: KarmaTransaction.KARMA_POST_LIKE})
+
+    def test_simultaneous_deletes_unlike_once(self):
+        url = f'/api/posts/{self.post.id}/like/'
+        client = APIClient()
+        client.force_authenticate(user=self.fan)
+        client.put(url)
+
+        results = self.tap_concurrently('delete', url)
+        winners = [sql for body, sql in results if body == {'liked': False, 'changed': True}]
+        losers = [sql for body, sql in results if body == {'liked': False, 'changed': False}]
+        self.assertEqual((len(winners), len(losers)), (1, self.TAPS - 1))
+        # Post lookup, delete, counter and the karma, applied inline: ledger
+        # lookup and delete, and the rollup bucket
+        self.assertEqual(len(winners[0]), 6, winners[0])
+        for sql in losers:
+            # Post lookup and a DELETE that finds nothing
+            self.assertEqual(len(sql), 2, sql)
+
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.like_count, 0)
+        self.assertFalse(PostLike.objects.exists())
+        self.assertFalse(KarmaTransaction.objects.exists())
+        self.assertEqual(karma.window_totals(), {})
+
+
+@override_settings(OUTBOX_SYNC=True, FEED_PAGE_SIZE=5)
+class ConditionalGetTestCase(TestCase):
+    """
+    Test that the feed, post detail and leaderboard answer If-None-Match
+    with a 304 from one cheap query, and change their ETag when the data
+    behind them changes.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.viewer = User.objects.create_user('viewer', password='pass123')
+        self.other = User.objects.create_user('other', password='pass123')
+        self.posts = [Post.objects.create(author=self.author, content=f'Post {i}') for i in range(8)]
+        self.post = self.posts[-1]
+        self.comment = Comment.objects.create(post=self.post, author=self.author, content='Comment')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.viewer)
+        self.other_client = APIClient()
+        self.other_client.force_authenticate(user=self.other)
+
+    def assert_not_modified(self, url, etag, client=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = (client or self.client).get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+        self.assertLessEqual(len(queries), 1, [q['sql'] for q in queries])
+        for query in queries:
+            self.assertNotIn('JOIN', query['sql'].upper())
+        return len(queries)
+
+    def assert_modified(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_feed_page(self):
+        response = self.client.get('/api/posts/')
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.assert_not_modified('/api/posts/', etag), 1)
+
+        # Someone else's like changes the counter on the page
+        self.other_client.put(f'/api/posts/{self.post.id}/like/')
+        etag = self.assert_modified('/api/posts/', etag)
+        # A new post shifts the page
+        Post.objects.create(author=self.author, content='New')
+        etag = self.assert_modified('/api/posts/', etag)
+        # So does deleting one of its posts
+        self.client.force_authenticate(user=self.author)
+        self.client.delete(f'/api/posts/{self.post.id}/')
+        self.client.force_authenticate(user=self.viewer)
+        self.assert_modified('/api/posts/', etag)
+
+    def test_feed_pages_and_viewers_have_their_own_etags(self):
+        first = self.client.get('/api/posts/').json()
+        etag = self.client.get('/api/posts/')['ETag']
+        self.assertNotEqual(self.client.get(first['next'])['ETag'], etag)
+        self.assertNotEqual(self.other_client.get('/api/posts/')['ETag'], etag)
+        self.assertEqual(self.other_client.get('/api/posts/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        # Liking from page 2 only invalidates page 2
+        second = self.client.get(first['next'])
+        self.client.put(f'/api/posts/{self.posts[0].id}/like/')
+        self.assert_not_modified('/api/posts/', etag)
+        self.assert_modified(first['next'], second['ETag'])
+
+    def test_post_detail(self):
+        url = f'/api/posts/{self.post.id}/'
+        etag = self.client.get(url)['ETag']
+        self.assert_not_modified(url, etag)
+
+        self.other_client.put(f'/api/comments/{self.comment.id}/like/')
+        etag = self.assert_modified(url, etag)
+        # The viewer's own like changes is_liked
+        self.client.put(f'/api/comments/{self.comment.id}/like/')
+        etag = self.assert_modified(url, etag)
+        response = self.client.post('/api/comments/', {'post': self.post.id, 'content': 'Reply'})
+        etag = self.assert_modified(url, etag)
+        self.client.delete(f'/api/comments/{response.json()["id"]}/')
+        etag = self.assert_modified(url, etag)
+        self.client.patch(f'/api/comments/{self.comment.id}/', {'content': 'Edited'})
+        self.assert_modified(url, etag)
+
+        self.assertEqual(self.client.get('/api/posts/999999/', HTTP_IF_NONE_MATCH=etag).status_code, 404)
+
+    def test_leaderboard(self):
+        etag = self.client.get('/api/leaderboard/')['ETag']
+        # Served from the warm in-memory index: no query at all
+        self.assertEqual(self.assert_not_modified('/api/leaderboard/', etag), 0)
+        # Everyone sees the same board
+        self.assert_not_modified('/api/leaderboard/', etag, client=APIClient())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/api/posts/{self.post.id}/like/')
+        self.assert_modified('/api/leaderboard/', etag)
+
+    @override_settings(LEADERBOARD_BACKEND='feed.leaderboard.DatabaseLeaderboard')
+    def test_leaderboard_from_database(self):
+        etag = self.client.get('/api/leaderboard/')['ETag']
+        self.assert_not_modified('/api/leaderboard/', etag)
+
+        self.client.put(f'/api/posts/{self.post.id}/like/')
+        etag = self.assert_modified('/api/leaderboard/', etag)
+        self.client.delete(f'/api/posts/{self.post.id}/like/')
+        etag = self.assert_modified('/api/leaderboard/', etag)
+
+        # Karma leaving the window changes the board without any write
+        give_karma(self.author, 5, at=timezone.now() - timedelta(hours=23, minutes=59, seconds=59))
+        etag = self.client.get('/api/leaderboard/')['ETag']
+        KarmaTransaction.objects.update(created_at=timezone.now() - timedelta(hours=25))
+        self.assert_modified('/api/leaderboard/', etag)
+
+
+class FastJSONTestCase(TestCase):
+    """
+    Test that the orjson-backed renderer and parser behave exactly like
+    DRF's, and that responses are compressed with reusable gzip bytes.
+    """
+
+    def setUp(self):
+        caches[settings.COMPRESSION_CACHE].clear()
+        middleware.reset_stats()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Post \u2028 with \u00e9 and \U0001f600')
+        for i in range(60):
+            Comment.objects.create(post=self.post, author=self.author, content=f'Comment {i} ' * 10)
+        self.client = APIClient()
+
+    def assert_renders_like_drf(self, data, accepted_media_type=None):
+        expected = JSONRenderer().render(data, accepted_media_type)
+        self.assertEqual(renderers.FastJSONRenderer().render(data, accepted_media_type), expected)
+        with mock.patch.object(renderers, 'orjson', None):
+            self.assertEqual(renderers.FastJSONRenderer().render(data, accepted_media_type), expected)
+
+    def test_renderer_output_is_identical(self):
+        detail = self.client.get(f'/api/posts/{self.post.id}/').data
+        self.assert_renders_like_drf(detail)
+        self.assert_renders_like_drf(detail, 'application/json; indent=4')
+        self.assert_renders_like_drf({
+            'when': timezone.now(),
+            'day': timezone.now().date(),
+            'amount': Decimal('1.50'),
+            'lazy': gettext_lazy('Not found.'),
+            1: ['\u2028\u2029', None, True, 2 ** 70],
+        })
+        self.assertEqual(renderers.FastJSONRenderer().render(None), b'')
+
+    def test_parser_matches_drf(self):
+        body = '{"ids": [1, 2], "text": "caf\u00e9 \u2028", "n": 1.5}'.encode()
+        expected = JSONParser().parse(io.BytesIO(body))
+        self.assertEqual(parsers.FastJSONParser().parse(io.BytesIO(body)), expected)
+        latin = '{"text": "caf\u00e9"}'.encode('latin-1')
+        self.assertEqual(
+            parsers.FastJSONParser().parse(io.BytesIO(latin), parser_context={'encoding': 'latin-1'}),
+            {'text': 'caf\u00e9'},
+        )
+        for bad in (b'{"ids": [1, 2}', b'{"n": NaN}'):
+            with self.assertRaises(ParseError):
+                parsers.FastJSONParser().parse(io.BytesIO(bad))
+
+    def test_api_uses_fast_parser(self):
+        user = User.objects.create_user('fan', password='pass123')
+        self.client.force_authenticate(user=user)
+        response = self.client.post('/api/posts/like-batch/', {'ids': [self.post.id]}, format='json')
+        self.assertEqual(response.json()['results'], [{'id': self.post.id, 'status': 'liked'}])
+        response = self.client.post(
+            '/api/posts/like-batch/', b'{"ids": [', content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_large_responses_are_gzipped_and_reused(self):
+        url = f'/api/posts/{self.post.id}/'
+        plain = self.client.get(url)
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+
+        first = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        second = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(first['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(first.content), plain.content)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(int(first['Content-Length']), len(first.content))
+        self.assertEqual(middleware.stats(), {'hits': 1, 'misses': 1})
+
+        # The compressed body is a different representation with a weak tag,
+        # which still validates
+        self.assertEqual(first['ETag'], 'W/' + plain['ETag'])
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_small_and_uncacheable_responses(self):
+        response = self.client.get('/api/leaderboard/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+        # No ETag: compressed every time, never cached
+        response = self.client.get(f'/api/comments/?post={self.post.id}', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(middleware.stats(), {'hits': 0, 'misses': 0})
+        # Only JSON is compressed
+        response = self.client.get('/api/posts/', HTTP_ACCEPT='text/html', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_benchmark_command_checks_identity(self):
+        out = StringIO()
+        call_command('bench_json', sizes='50,200', repeat=1, stdout=out)
+        self.assertIn('byte-identical', out.getvalue())
+
+
+@override_settings(REPLICA_DATABASES=['lagging_replica'], REPLICA_PIN_SECONDS=5, OUTBOX_SYNC=True)
+class ReplicaRoutingTestCase(TestCase):
+    """
+    Test replica routing against a second SQLite database that never
+    receives writes, i.e. a replica that is lagging behind for good.
+    """
+    databases = {'default', 'lagging_replica'}
+
+    def setUp(self):
+        self.author = User.objects.create_user('author', password='pass123')
+        self.fan = User.objects.create_user('fan', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Test post')
+        # The replica starts out in step with the primary
+        for obj in (self.author, self.fan, self.post):
+            obj.save(using='lagging_replica', force_insert=True)
+
+        self.fan_client = APIClient()
+        self.fan_client.force_authenticate(user=self.fan)
+        self.other_client = APIClient()
+
+    def queries_on(self, method, client, url, **kwargs):
+        """Run one request; return it and the number of queries per database."""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['lagging_replica']) as replica:
+            response = getattr(client, method)(url, **kwargs)
+        return response, len(primary), len(replica)
+
+    def test_safe_reads_go_to_the_replica(self):
+        response, primary, replica = self.queries_on('get', self.other_client, '/api/posts/')
+        self.assertEqual(response.json()['results'][0]['id'], self.post.id)
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_writes_go_to_the_primary_and_pin_the_writer(self):
+        response, primary, replica = self.queries_on('put', self.fan_client, f'/api/posts/{self.post.id}/like/')
+        self.assertTrue(response.json()['changed'])
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], 5)
+
+        # Failed writes change nothing, so they do not pin
+        response = self.other_client.put(f'/api/posts/{self.post.id}/like/')
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn(routers.PIN_COOKIE, response.cookies)
+
+    def test_like_is_visible_in_the_likers_next_read(self):
+        self.fan_client.put(f'/api/posts/{self.post.id}/like/')
+
+        response, primary, replica = self.queries_on('get', self.fan_client, f'/api/posts/{self.post.id}/')
+        self.assertEqual((response.json()['like_count'], response.json()['is_liked']), (1, True))
+        self.assertEqual(replica, 0)
+        # Everyone else still reads the lagging replica
+        post = self.other_client.get(f'/api/posts/{self.post.id}/').json()
+        self.assertEqual(post['like_count'], 0)
+
+        # Once the pin runs out the liker is back on the replica
+        with mock.patch.object(routers.time, 'time', return_value=time.time() + 6):
+            post = self.fan_client.get(f'/api/posts/{self.post.id}/').json()
+        self.assertEqual(post['like_count'], 0)
+
+    def test_login_and_registration_pin_the_client(self):
+        client = APIClient()
+        response = client.post('/api/auth/register/', {'username': 'newbie', 'password': 'pass123'})
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], 5)
+        response = APIClient().post('/api/auth/login/', {'username': 'fan', 'password': 'pass123'})
+        self.assertEqual(response.cookies[routers.PIN_COOKIE]['max-age'], 5)
+
+    def test_sessions_and_users_come_from_the_primary(self):
+        client = APIClient()
+        client.post('/api/auth/register/', {'username': 'newbie', 'password': 'pass123'})
+        # Neither the new user nor their session has reached the replica
+        with mock.patch.object(routers.time, 'time', return_value=time.time() + 6), \
+                CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['lagging_replica']) as replica:
+            response = client.get(f'/api/posts/{self.post.id}/')
+        self.assertEqual(response.status_code, 200)
+
+        def tables(queries):
+            return {match for query in queries for match in re.findall(r'FROM "(\w+)"', query['sql'])}
+        self.assertEqual(tables(primary) & {'django_session', 'auth_user'}, {'django_session', 'auth_user'})
+        self.assertTrue(tables(replica))
+        self.assertFalse(tables(replica) & {'django_session', 'auth_user'})
+
+    @override_settings(CACHES=TREE_CACHES)
+    def test_comment_tree_cache_is_filled_from_the_primary(self):
+        self.fan_client.post('/api/comments/', {'post': self.post.id, 'content': 'Hello'})
+        # Not pinned, so the post comes from the replica, but the shared
+        # comment tree must not miss the new comment
+        comments = self.other_client.get(f'/api/posts/{self.post.id}/').json()['comments']
+        self.assertEqual([comment['content'] for comment in comments], ['Hello'])
+
+
+class AsyncReadViewsTestCase(TestCase):
+    """
+    Test that the async views served under ASGI (feed/async_views.py) answer
+    exactly like the sync ones, and hand writes to the sync viewsets.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        tree_cache.get_cache().clear()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.viewer = User.objects.create_user('viewer', password='pass123')
+        self.posts = [Post.objects.create(author=self.author, content=f'Post {i}') for i in range(3)]
+        self.post = self.posts[-1]
+        root = Comment.objects.create(post=self.post, author=self.author, content='Root')
+        self.reply = Comment.objects.create(post=self.post, author=self.author, parent=root, content='Reply')
+        likes.like(self.viewer, self.post)
+        likes.like(self.viewer, self.reply)
+        self.client.force_login(self.viewer)
+        self.async_client.force_login(self.viewer)
+
+    def sync_get(self, url):
+        with self.settings(ROOT_URLCONF='config.urls'):
+            return self.client.get(url)
+
+    async def test_reads_match_the_sync_views(self):
+        urls = [
+            '/api/posts/',
+            '/api/posts/?page_size=2',
+            '/api/posts/?sort=hot&page_size=2',
+            f'/api/posts/{self.post.id}/',
+            f'/api/posts/{self.post.id}/?depth=1',
+            '/api/leaderboard/',
+        ]
+        expected = [await sync_to_async(self.sync_get)(url) for url in urls]
+        with self.settings(ROOT_URLCONF='config.asgi_urls'):
+            for url, sync_response in zip(urls, expected):
+                response = await self.async_client.get(url)
+                self.assertEqual(response.status_code, 200, url)
+                self.assertEqual(response.json(), sync_response.json(), url)
+                self.assertEqual(response['ETag'], sync_response['ETag'], url)
+
+                response = await self.async_client.get(url, headers={'If-None-Match': sync_response['ETag']})
+                self.assertEqual(response.status_code, 304, url)
+
+        detail = expected[3].json()
+        self.assertTrue(detail['is_liked'])
+        self.assertTrue(detail['comments'][0]['replies'][0]['is_liked'])
+
+    async def test_anonymous_reads_and_missing_post(self):
+        await sync_to_async(self.async_client.logout)()
+        with self.settings(ROOT_URLCONF='config.asgi_urls'):
+            response = await self.async_client.get(f'/api/posts/{self.post.id}/')
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.json()['is_liked'])
+
+            response = await self.async_client.get('/api/posts/999999/')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.json(), {'detail': 'Not found.'})
+
+            response = await self.async_client.post('/api/leaderboard/')
+            self.assertEqual(response.status_code, 405)
+
+            response = await self.async_client.get('/api/posts/?sort=top')
+            self.assertEqual(response.status_code, 400)
+
+    async def test_writes_go_to_the_viewsets(self):
+        with self.settings(ROOT_URLCONF='config.asgi_urls'):
+            response = await self.async_client.post(
+                '/api/posts/', {'content': 'Created'}, content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 201)
+            post_id = response.json()['id']
+
+            response = await self.async_client.patch(
+                f'/api/posts/{post_id}/', {'content': 'Edited'}, content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+            response = await self.async_client.get(f'/api/posts/{post_id}/')
+            self.assertEqual(response.json()['content'], 'Edited')
+
+            response = await self.async_client.put(f'/api/posts/{post_id}/like/')
+            self.assertEqual(response.json(), {'liked': True, 'changed': True})
+
+            response = await self.async_client.delete(f'/api/posts/{post_id}/')
+            self.assertEqual(response.status_code, 204)
+        self.assertFalse(await Post.objects.filter(pk=post_id).aexists())
+
+    @override_settings(COMPRESSION_MIN_SIZE=1)
+    async def test_compression_under_asgi(self):
+        with self.settings(ROOT_URLCONF='config.asgi_urls'):
+            response = await self.async_client.get('/api/posts/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        body = json.loads(gzip.decompress(response.content))
+        self.assertEqual([post['content'] for post in body['results']], ['Post 2', 'Post 1', 'Post 0'])
+
+    def test_loadtest_helpers(self):
+        from .management.commands import loadtest
+
+        self.assertEqual(loadtest.shares(10, 3), [4, 3, 3])
+        self.assertEqual(loadtest.shares(2, 5), [1, 1])
+        rate, p50, p95 = loadtest.summarize([0.01] * 90 + [0.1] * 10, 2.0)
+        self.assertEqual(rate, 50)
+        self.assertAlmostEqual(p50, 0.01)
+        self.assertAlmostEqual(p95, 0.1)
+        with self.assertRaises(CommandError):
+            call_command('loadtest', concurrency='0', stdout=StringIO())
+
+
+class LiveUpdatesTestCase(TestCase):
+    """
+    Test the pub/sub broker and the server-sent event streams of posts and
+    the leaderboard: deltas, resuming, heartbeats and the backlog limit.
+    """
+
+    def setUp(self):
+        pubsub.reset()
+        live.reset()
+        leaderboard.reset()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.viewer = User.objects.create_user('viewer', password='pass123')
+        self.post = Post.objects.create(author=self.author, content='Post')
+        self.comment = Comment.objects.create(post=self.post, author=self.author, content='Comment')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.viewer)
+        self.channel = live.post_channel(self.post.id)
+
+    def read(self, response):
+        return b''.join(response.streaming_content).decode()
+
+    def parse(self, body):
+        events = []
+        for block in body.split('\n\n'):
+            fields = dict(
+                line.split(': ', 1) for line in block.split('\n') if line and not line.startswith(':')
+            )
+            if 'event' in fields:
+                events.append((fields.get('id'), fields['event'], json.loads(fields['data'])))
+        return events
+
+    def test_resume_from_last_event_id(self):
+        broker = pubsub.MemoryBroker(history=3)
+        first = broker.publish('c', 'x', {'n': 1})
+        broker.publish('other', 'x', {'n': 0})
+        broker.publish('c', 'x', {'n': 2})
+        broker.publish('c', 'x', {'n': 3})
+
+        subscription = broker.subscribe('c', first.id)
+        self.assertEqual([event.data['n'] for event in subscription.get(0)], [2, 3])
+        self.assertEqual(subscription.get(0.01), [])
+
+        # Two more events push the first one out of the history
+        broker.publish('c', 'x', {'n': 4})
+        broker.publish('c', 'x', {'n': 5})
+        self.assertEqual([event.type for event in broker.subscribe('c', first.id).get(0)], ['reset'])
+        # Ids from a previous broker (process) cannot be resumed either
+        self.assertEqual([event.type for event in broker.subscribe('c', 'abc-2').get(0)], ['reset'])
+        self.assertEqual([event.type for event in broker.subscribe('c', 'garbage').get(0)], ['reset'])
+
+    def test_slow_subscriber_is_cut_off(self):
+        broker = pubsub.MemoryBroker()
+        slow = broker.subscribe('c', max_pending=2)
+        fast = broker.subscribe('c', max_pending=2)
+        for n in range(3):
+            broker.publish('c', 'x', {'n': n})
+            if n < 2:
+                fast.get(0)
+        with self.assertRaises(pubsub.Overflow):
+            slow.get(0)
+        self.assertEqual([event.data['n'] for event in fast.get(0)], [2])
+
+        slow.close()
+        fast.close()
+        self.assertTrue(broker.is_watched('c'))
+        self.assertFalse(broker.is_watched('never-subscribed'))
+
+    async def test_async_subscriber_wakes_on_publish_from_another_thread(self):
+        broker = pubsub.MemoryBroker()
+        subscription = broker.subscribe('c')
+        timer = threading.Timer(0.05, broker.publish, args=('c', 'x', {'n': 1}))
+        timer.start()
+        started = time.monotonic()
+        events = await subscription.aget(5)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual([event.data for event in events], [{'n': 1}])
+        self.assertEqual(await subscription.aget(0.01), [])
+
+    def test_like_and_comment_deltas(self):
+        subscription = pubsub.subscribe(self.channel)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/api/posts/{self.post.id}/like/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/api/comments/{self.comment.id}/like/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/posts/{self.post.id}/like/')
+        with self.captureOnCommitCallbacks(execute=True):
+            reply = self.client.post('/api/comments/', {
+                'post': self.post.id, 'parent': self.comment.id, 'content': 'Reply',
+            }, format='json').json()
+
+        events = subscription.get(0)
+        self.assertEqual([(event.type, event.data) for event in events[:3]], [
+            ('like', {'post': self.post.id, 'like_count': 1}),
+            ('like', {'comment': self.comment.id, 'like_count': 1}),
+            ('like', {'post': self.post.id, 'like_count': 0}),
+        ])
+        self.assertEqual(events[3].type, 'comment')
+        node = events[3].data
+        self.assertEqual(node['id'], reply['id'])
+        self.assertEqual(node['parent'], self.comment.id)
+        self.assertEqual(node['author'], {'id': self.viewer.id, 'username': 'viewer'})
+        self.assertEqual(node['replies'], [])
+
+        # Batch likes are announced too (the first comment was already liked)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/comments/like-batch/', {'ids': [self.comment.id, reply['id']]}, format='json')
+        self.assertEqual(
+            sorted((event.data['comment'], event.data['like_count']) for event in subscription.get(0)),
+            [(reply['id'], 1)],
+        )
+
+    def test_unwatched_posts_publish_nothing(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/api/posts/{self.post.id}/like/')
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.delete(f'/api/posts/{self.post.id}/like/')
+        self.assertFalse(pubsub.is_watched(self.channel))
+        # No read-back of the counter
+        self.assertFalse(any(
+            q['sql'].startswith('SELECT "feed_post"."id", "feed_post"."like_count" FROM') for q in queries
+        ))
+
+    @override_settings(OUTBOX_SYNC=True, LEADERBOARD_BACKEND='feed.leaderboard.MemoryLeaderboard')
+    def test_rank_changes(self):
+        subscription = pubsub.subscribe(live.LEADERBOARD)
+        live.refresh_leaderboard()
+        self.assertEqual([event.data for event in subscription.get(0)], [{'top': []}])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(f'/api/posts/{self.post.id}/like/')
+        events = subscription.get(0)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].type, 'rank')
+        self.assertEqual(events[0].data['top'][0]['username'], 'author')
+        self.assertEqual(events[0].data['top'][0]['karma_24h'], 5)
+
+        # Nothing new to say
+        live.refresh_leaderboard()
+        self.assertEqual(subscription.get(0), [])
+
+    @override_settings(SSE_HEARTBEAT_SECONDS=0.05, SSE_MAX_AGE_SECONDS=0.2)
+    def test_post_stream(self):
+        response = self.client.get(f'/api/posts/{self.post.id}/stream/', HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        # Nothing happened: the stream opens, pings and ends at SSE_MAX_AGE_SECONDS
+        body = self.read(response)
+        self.assertTrue(body.startswith(': open\n\n'))
+        self.assertIn(': ping\n\n', body)
+
+        first = pubsub.publish(self.channel, 'like', {'post': self.post.id, 'like_count': 1})
+        pubsub.publish(self.channel, 'like', {'post': self.post.id, 'like_count': 2})
+        response = self.client.get(f'/api/posts/{self.post.id}/stream/', HTTP_LAST_EVENT_ID=first.id)
+        events = self.parse(self.read(response))
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][1:], ('like', {'post': self.post.id, 'like_count': 2}))
+
+        self.assertEqual(self.client.get('/api/posts/999999/stream/').status_code, 404)
+        self.assertEqual(self.client.post(f'/api/posts/{self.post.id}/stream/').status_code, 405)
+
+    @override_settings(SSE_HEARTBEAT_SECONDS=0.05, SSE_MAX_AGE_SECONDS=0.2, ROOT_URLCONF='config.asgi_urls')
+    async def test_async_streams(self):
+        first = pubsub.publish(self.channel, 'comment', {'id': 1})
+        pubsub.publish(self.channel, 'comment', {'id': 2})
+        response = await self.async_client.get(
+            f'/api/posts/{self.post.id}/stream/', headers={'Last-Event-ID': first.id}
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = b''.join([part async for part in response.streaming_content]).decode()
+        self.assertEqual([event[1:] for event in self.parse(body)], [('comment', {'id': 2})])
+        self.assertIn(': ping\n\n', body)
+
+        response = await self.async_client.get('/api/leaderboard/stream/')
+        body = b''.join([part async for part in response.streaming_content]).decode()
+        self.assertEqual([event[1:] for event in self.parse(body)], [('rank', {'top': []})])
+
+        response = await self.async_client.get('/api/posts/999999/stream/')
+        self.assertEqual(response.status_code, 404)
+
+
+class BenchmarkDatasetTestCase(TestCase):
+    """
+    Test that `manage.py benchmark` seeds data the API serves as if it had
+    been created through it, and measures every endpoint.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        tree_cache.get_cache().clear()
+
+    def test_seeded_data_is_consistent(self):
+        from .management.commands.benchmark import seed_dataset
+
+        dataset = seed_dataset(users=8, posts=6, comments=5, thread_size=60, thread_depth=5, likes=40, karma_days=2)
+        counts = dataset['counts']
+        self.assertEqual(Post.objects.count(), 6)
+        self.assertEqual(Comment.objects.count(), counts['comments'])
+        self.assertEqual(PostLike.objects.filter(post_id=dataset['viral_post_id']).count(), 8)
+
+        # The counters match the rows, as `recount` would set them
+        before = list(Post.objects.order_by('id').values_list('like_count', 'comment_count'))
+        comments_before = list(Comment.objects.order_by('id').values_list('like_count', flat=True))
+        call_command('recount', stdout=StringIO())
+        self.assertEqual(list(Post.objects.order_by('id').values_list('like_count', 'comment_count')), before)
+        self.assertEqual(list(Comment.objects.order_by('id').values_list('like_count', flat=True)), comments_before)
+
+        # Paths and depths follow the parents, at most thread_depth levels
+        by_id = {comment.id: comment for comment in Comment.objects.all()}
+        for comment in by_id.values():
+            parent = by_id.get(comment.parent_id)
+            expected = (parent.path if parent else '') + Comment.path_segment(comment.id)
+            self.assertEqual(comment.path, expected)
+            self.assertEqual(comment.depth, parent.depth + 1 if parent else 0)
+            self.assertLess(comment.depth, 5)
+
+        # Buckets hold exactly the ledger's karma inside the window
+        self.assertEqual(dict(karma.window_totals()), {
+            row['user_id']: row['total']
+            for row in KarmaTransaction.objects
+            .filter(created_at__gte=timezone.now() - karma.LEADERBOARD_WINDOW)
+            .values('user_id').annotate(total=Sum('points'))
+        })
+
+        # New rows after the explicit ids get fresh ones
+        user = User.objects.create_user('after-seed')
+        self.assertGreater(user.id, max(dataset['user_ids']))
+
+    def test_endpoints_are_measured(self):
+        from .management.commands.benchmark import Command, seed_dataset
+
+        dataset = seed_dataset(users=5, posts=25, comments=3, thread_size=20, likes=10, karma_days=1)
+        results = Command().run_endpoints(dataset, iterations=3, warmup=1)
+        self.assertEqual(
+            set(results),
+            {'feed', 'feed_deep_page', 'detail', 'detail_viral', 'like', 'unlike', 'leaderboard'},
+        )
+        for name, result in results.items():
+            self.assertEqual(result['status'], {'200': 3}, name)
+            self.assertGreater(result['queries']['min'], 0, name)
+            self.assertGreater(result['bytes']['mean'], 0, name)
+            self.assertLessEqual(result['latency_ms']['p50'], result['latency_ms']['max'])
+        self.assertGreater(results['detail_viral']['bytes']['mean'], results['detail']['bytes']['mean'])
+
+
+@override_settings(CACHES=TREE_CACHES)
+class MetricsTestCase(TestCase):
+    """
+    Test that every request is recorded per route with its SQL statements,
+    and that /metrics serves the totals of all processes to authorized
+    scrapers only.
+    """
+
+    def setUp(self):
+        metrics.registry.reset()
+        tree_cache.reset_stats()
+        tree_cache.get_cache().clear()
+        leaderboard.reset()
+        self.staff = User.objects.create_user('staff', password='pass123', is_staff=True)
+        self.user = User.objects.create_user('user', password='pass123')
+        self.post = Post.objects.create(author=self.user, content='Hello')
+        Comment.objects.create(post=self.post, author=self.user, content='Hi')
+
+    def scrape(self, **kwargs):
+        response = self.client.get('/metrics', **kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def value(self, text, sample):
+        match = re.search(r'^' + re.escape(sample) + r' (\S+)$', text, re.M)
+        self.assertIsNotNone(match, sample)
+        return float(match.group(1))
+
+    def test_requests_are_recorded_per_route(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(f'/api/posts/{self.post.id}/')
+        self.client.get(f'/api/posts/{self.post.id}/')
+        self.client.get('/api/posts/999999/')
+        self.client.get('/no/such/page/')
+
+        self.client.force_login(self.staff)
+        text = self.scrape()
+        detail = 'route="post-detail",method="GET"'
+        self.assertEqual(self.value(text, 'playto_http_requests_total{%s,status="200"}' % detail), 2)
+        self.assertEqual(self.value(text, 'playto_http_requests_total{%s,status="404"}' % detail), 1)
+        self.assertEqual(self.value(text, 'playto_http_requests_total{route="unmatched",method="GET",status="404"}'), 1)
+
+        # Every statement of the request is counted, and only those
+        self.assertEqual(self.value(text, 'playto_http_db_queries_count{%s}' % detail), 3)
+        self.assertGreaterEqual(self.value(text, 'playto_http_db_queries_sum{%s}' % detail), 2 * len(ctx.captured_queries))
+        self.assertGreater(self.value(text, 'playto_http_db_seconds_total{%s}' % detail), 0)
+        self.assertGreater(self.value(text, 'playto_http_render_seconds_total{%s}' % detail), 0)
+        self.assertGreater(self.value(text, 'playto_http_response_bytes_total{%s}' % detail), 0)
+
+        # Histogram buckets are cumulative and end with the count
+        buckets = [
+            self.value(text, 'playto_http_request_duration_seconds_bucket{%s,le="%s"}' % (detail, bound))
+            for bound in (*metrics.LATENCY_BUCKETS, '+Inf')
+        ]
+        self.assertEqual(buckets, sorted(buckets))
+        self.assertEqual(buckets[-1], 3)
+
+        # Cache counters and the outbox backlog come along
+        self.assertEqual(self.value(text, 'playto_cache_lookups_total{cache="comment_tree",outcome="hits"}'), 1)
+        self.assertEqual(self.value(text, 'playto_cache_lookups_total{cache="comment_tree",outcome="misses"}'), 1)
+        self.assertIn('playto_outbox_pending ', text)
+        self.assertIn('playto_outbox_lag_seconds ', text)
+
+    def test_queries_outside_requests_are_not_counted(self):
+        sample = metrics.Sample()
+        token = metrics._current.set(sample)
+        try:
+            list(Post.objects.all())
+        finally:
+            metrics._current.reset(token)
+        list(Post.objects.all())
+        self.assertEqual(sample.queries, 1)
+
+    def test_only_staff_can_read(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(self.staff)
+        self.scrape()
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_token_is_required_when_set(self):
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.client.logout()
+        self.scrape(HTTP_AUTHORIZATION='Bearer s3cret')
+
+    def test_label_values_are_escaped(self):
+        self.assertEqual(metrics._labels(route='a"b\\c\nd'), '{route="a\\"b\\\\c\\nd"}')
+
+    def test_snapshots_of_other_processes_are_added_up(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(METRICS_DIR=directory):
+            self.client.get('/api/leaderboard/')
+            metrics.flush()
+            self.assertTrue(os.path.exists(metrics.snapshot_path()))
+
+            # Another worker's snapshot, as flush() would have written it
+            other = json.loads(open(metrics.snapshot_path()).read())
+            with open(metrics.snapshot_path(pid=os.getpid() + 1), 'w') as fh:
+                json.dump(other, fh)
+            # Files being written, or of other tools, are skipped
+            with open(os.path.join(directory, '.metrics-partial'), 'w') as fh:
+                fh.write('{')
+            with open(os.path.join(directory, 'metrics-broken.json'), 'w') as fh:
+                fh.write('{')
+
+            self.client.force_login(self.staff)
+            text = self.scrape()
+        board = 'route="leaderboard",method="GET"'
+        self.assertEqual(self.value(text, 'playto_http_requests_total{%s,status="200"}' % board), 2)
+        self.assertEqual(self.value(text, 'playto_http_request_duration_seconds_count{%s}' % board), 2)
+
+    def test_recording_is_cheap(self):
+        sample = metrics.Sample()
+        started = time.perf_counter()
+        for _ in range(10000):
+            metrics.registry.observe('post-list', 'GET', 200, 0.01, sample, 100)
+        per_request = (time.perf_counter() - started) / 10000
+        self.assertLess(per_request, 50e-6)
+
+
+# Likes measured as deployed with outbox_worker, which applies their karma
+@override_settings(OUTBOX_SYNC=False)
+class QueryBudgetTestCase(TestCase):
+    """
+    Run every endpoint against seeded datasets of increasing size and fail
+    if the number of SQL statements it issues grows with the data or goes
+    over the endpoint's declared budget. The failure message lists the
+    statements of the offending run, so an N+1 shows up as the repeated
+    query.
+
+    Each endpoint is measured once per dataset, cold: caches are emptied and
+    the leaderboard index is rebuilt, so the budgets cover the worst case.
+    """
+
+    SIZES = (10, 100, 1000)
+
+    # Statements per request, including the session and user lookups of the
+    # logged-in viewer (two). Post detail and the comment window load one
+    # level of the thread per statement, up to COMMENT_TREE_DEPTH; writes
+    # include the savepoint around them.
+    BUDGETS = {
+        'feed': 4,
+        'feed_next_page': 4,
+        'feed_anonymous': 1,
+        'feed_hot': 4,
+        'post_detail': 13,
+        'comment_window': 12,
+        'comment_list': 4,
+        'comment_detail': 4,
+        'leaderboard': 4,
+        'leaderboard_rollups': 6,
+        'current_user': 2,
+        'post_like': 8,
+        'post_unlike': 8,
+        'post_like_legacy': 8,
+        'post_unlike_legacy': 8,
+        'comment_like': 8,
+        'comment_unlike': 8,
+        'post_like_batch': 10,
+        'post_unlike_batch': 9,
+        'comment_like_batch': 10,
+        'comment_unlike_batch': 10,
+        'comment_create': 11,
+        'post_create': 4,
+        'comment_delete': 15,
+        'post_delete': 18,
+    }
+
+    def seed(self, size):
+        from .management.commands.benchmark import seed_dataset
+
+        dataset = seed_dataset(
+            users=max(10, size // 10), posts=size, comments=5, thread_size=size, thread_depth=8,
+            # Enough likes that even the smallest dataset has liked comments
+            # by several authors in every thread
+            likes=max(200, 2 * size), karma_days=1,
+        )
+        viewer = User.objects.get(pk=dataset['user_ids'][0])
+        viral = dataset['viral_post_id']
+        # A reply chain deeper than the comment window, so that windows
+        # load the same number of levels at every size
+        chain = [None]
+        for _ in range(settings.COMMENT_TREE_DEPTH + 1):
+            chain.append(Comment.objects.create(post_id=viral, author=viewer, parent=chain[-1], content='Deeper'))
+        thread = Comment.objects.filter(post_id=viral)
+        parents = Comment.objects.filter(parent__isnull=False).values('parent_id')
+        liked_posts = PostLike.objects.filter(user=viewer).values('post_id')
+        liked_comments = CommentLike.objects.filter(user=viewer).values('comment_id')
+        # The top-level comment with the biggest subtree, to delete
+        threads_by_root = Counter(
+            path[:Comment.PATH_SEGMENT_WIDTH] for path in thread.values_list('path', flat=True)
+        )
+        biggest = int(threads_by_root.most_common(1)[0][0])
+        return {
+            'viewer': viewer,
+            'viral': viral,
+            'biggest': biggest,
+            'root': chain[1].id,
+            'leaf': thread.exclude(pk__in=parents).order_by('-depth', 'id').first().id,
+            'post': Post.objects.exclude(pk__in=liked_posts).exclude(pk=viral).order_by('id').first().id,
+            'comment': thread.exclude(pk__in=liked_comments).order_by('-depth', 'id').first().id,
+            'posts': list(Post.objects.exclude(pk__in=liked_posts).order_by('id').values_list('id', flat=True)[:5]),
+            'comments': list(thread.exclude(pk__in=liked_comments).order_by('id').values_list('id', flat=True)[:5]),
+        }
+
+    def endpoints(self, data):
+        """(name, method, url, body) of every endpoint, in the order they are run."""
+        viral = data['viral']
+        return [
+            ('feed', 'get', '/api/posts/?page_size=5', None),
+            ('feed_next_page', 'get', data['next_page'], None),
+            ('feed_anonymous', 'get', '/api/posts/?page_size=5', None),
+            ('feed_hot', 'get', '/api/posts/?sort=hot&page_size=5', None),
+            ('post_detail', 'get', f'/api/posts/{viral}/', None),
+            ('comment_window', 'get', f'/api/posts/{viral}/comments/?parent={data["root"]}', None),
+            ('comment_list', 'get', f'/api/comments/?post={viral}', None),
+            ('comment_detail', 'get', f'/api/comments/{data["leaf"]}/', None),
+            ('leaderboard', 'get', '/api/leaderboard/', None),
+            ('leaderboard_rollups', 'get', '/api/leaderboard/', None),
+            ('current_user', 'get', '/api/auth/me/', None),
+            ('post_like', 'put', f'/api/posts/{data["post"]}/like/', None),
+            ('post_unlike', 'delete', f'/api/posts/{data["post"]}/like/', None),
+            ('post_like_legacy', 'post', f'/api/posts/{data["post"]}/like/', None),
+            ('post_unlike_legacy', 'post', f'/api/posts/{data["post"]}/unlike/', None),
+            ('comment_like', 'put', f'/api/comments/{data["comment"]}/like/', None),
+            ('comment_unlike', 'delete', f'/api/comments/{data["comment"]}/like/', None),
+            ('post_like_batch', 'post', '/api/posts/like-batch/', {'ids': data['posts']}),
+            ('post_unlike_batch', 'post', '/api/posts/unlike-batch/', {'ids': data['posts']}),
+            ('comment_like_batch', 'post', '/api/comments/like-batch/', {'ids': data['comments']}),
+            ('comment_unlike_batch', 'post', '/api/comments/unlike-batch/', {'ids': data['comments']}),
+            ('comment_create', 'post', '/api/comments/', {'post': viral, 'parent': data['leaf'], 'content': 'Hi'}),
+            ('post_create', 'post', '/api/posts/', {'content': 'Hello'}),
+            ('comment_delete', 'delete', f'/api/comments/{data["biggest"]}/', None),
+            # Last, as it takes the whole thread with it
+            ('post_delete', 'delete', f'/api/posts/{viral}/', None),
+        ]
+
+    def run_endpoints(self, data):
+        """{name: captured queries} of one request to every endpoint."""
+        client = APIClient()
+        client.force_login(data['viewer'])
+        anonymous = APIClient()
+        first_page = client.get('/api/posts/?page_size=5').json()
+        data['next_page'] = first_page['next']
+
+        captured = {}
+        for name, method, url, body in self.endpoints(data):
+            tree_cache.get_cache().clear()
+            leaderboard.reset()
+            backend = 'feed.leaderboard.DatabaseLeaderboard' if name == 'leaderboard_rollups' else settings.LEADERBOARD_BACKEND
+            with self.settings(LEADERBOARD_BACKEND=backend), CaptureQueriesContext(connection) as ctx:
+                sender = anonymous if name == 'feed_anonymous' else client
+                response = getattr(sender, method)(url, body, format='json')
+            self.assertLess(response.status_code, 400, f'{name}: {method.upper()} {url} -> {response.status_code}')
+            captured[name] = ctx.captured_queries
+        return captured
+
+    def measure(self):
+        """{name: {size: captured queries}}, each size on a fresh dataset."""
+        runs = defaultdict(dict)
+        for size in self.SIZES:
+            with transaction.atomic():
+                data = self.seed(size)
+                for name, queries in self.run_endpoints(data).items():
+                    runs[name][size] = queries
+                transaction.set_rollback(True)
+        return runs
+
+    def assertWithinBudget(self, name, runs, budget):
+        counts = {size: len(queries) for size, queries in runs.items()}
+        worst = max(runs, key=lambda size: len(runs[size]))
+        problem = None
+        sizes = sorted(counts)
+        # Fewer statements on more data is fine: a window budget can run
+        # out before the last level of a bigger thread
+        if any(counts[larger] > counts[smaller] for smaller, larger in zip(sizes, sizes[1:])):
+            problem = 'grows with the data'
+        elif counts[worst] > budget:
+            problem = f'is over its budget of {budget}'
+        if problem:
+            statements = '\n'.join(
+                f'{i:>4}. {query["sql"]}' for i, query in enumerate(runs[worst], 1)
+            )
+            self.fail(
+                f'{name} {problem}: queries per dataset size {counts}.\n'
+                f'Statements with {worst} rows:\n{statements}'
+            )
+
+    def test_query_counts_are_constant_and_within_budget(self):
+        runs = self.measure()
+        self.assertEqual(set(runs), set(self.BUDGETS))
+        for name, budget in self.BUDGETS.items():
+            with self.subTest(endpoint=name):
+                self.assertWithinBudget(name, runs[name], budget)
+
+    def test_growing_query_counts_are_reported_with_their_sql(self):
+        # Without the viewer's liked ids every comment asks whether it is liked
+        with mock.patch.object(likes, 'context_key', return_value='not-looked-up'):
+            runs = self.measure()
+        with self.assertRaises(AssertionError) as failure:
+            self.assertWithinBudget('comment_list', runs['comment_list'], self.BUDGETS['comment_list'])
+        message = str(failure.exception)
+        self.assertIn('comment_list grows with the data', message)
+        self.assertGreater(message.count('FROM "feed_commentlike"'), 100)
+
+
+class FeedExportImportTestCase(TestCase):
+    """
+    Test that `manage.py export_feed` and `import_feed` round-trip users,
+    posts, comment trees, likes and karma under new ids, streaming rather
+    than loading whole tables.
+    """
+
+    def setUp(self):
+        leaderboard.reset()
+        tree_cache.get_cache().clear()
+        self.alice = User.objects.create_user('alice', password='pass123')
+        self.bob = User.objects.create_user('bob', password='pass123')
+        self.post = Post.objects.create(author=self.alice, content='Hello')
+        Post.objects.create(author=self.bob, content='Second')
+        root = Comment.objects.create(post=self.post, author=self.bob, content='Root')
+        reply = Comment.objects.create(post=self.post, author=self.alice, parent=root, content='Reply')
+        Comment.objects.create(post=self.post, author=self.bob, parent=reply, content='Deep')
+        Comment.objects.create(post=self.post, author=self.alice, content='Other root')
+        likes.like(self.bob, self.post)
+        likes.like(self.bob, reply)
+        give_karma(self.alice, 3, at=timezone.now() - timedelta(days=3))
+        KarmaDaily.objects.create(user=self.bob, day=(timezone.now() - timedelta(days=30)).date(), points=7)
+        Post.objects.filter(pk=self.post.pk).update(created_at=timezone.now() - timedelta(days=2))
+
+    def export(self, **options):
+        out = StringIO()
+        call_command('export_feed', stdout=out, **options)
+        return out.getvalue()
+
+    def import_(self, data, **options):
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as fh:
+            fh.write(data)
+        try:
+            call_command('import_feed', fh.name, stdout=StringIO(), **options)
+        finally:
+            os.unlink(fh.name)
+
+    def snapshot(self):
+        """Everything exported, keyed by usernames and contents instead of ids."""
+        def tree(post):
+            return sorted(
+                (c.content, c.parent.content if c.parent else None, c.depth, c.author.username,
+                 c.like_count, c.created_at, len(c.path))
+                for c in Comment.objects.filter(post=post)
+            )
+        return {
+            'users': sorted(User.objects.values_list('username', 'password', 'date_joined')),
+            'posts': sorted(
+                (p.content, p.author.username, p.created_at, p.like_count, p.comment_count, tuple(tree(p)))
+                for p in Post.objects.all()
+            ),
+            'post_likes': sorted(PostLike.objects.values_list('user__username', 'post__content')),
+            'comment_likes': sorted(CommentLike.objects.values_list('user__username', 'comment__content')),
+            'karma': sorted(KarmaTransaction.objects.values_list('user__username', 'points', 'created_at')),
+            'karma_daily': sorted(KarmaDaily.objects.values_list('user__username', 'day', 'points')),
+            'totals': sorted((User.objects.get(pk=user_id).username, points) for user_id, points in karma.window_totals().items()),
+        }
+
+    def test_round_trip_under_new_ids(self):
+        data = self.export()
+        before = self.snapshot()
+        old_ids = set(Comment.objects.values_list('id', flat=True))
+        User.objects.all().delete()
+        KarmaBucket.objects.all().delete()
+        # Rows that are already there keep their ids
+        zoe = User.objects.create_user('zoe')
+        existing = Comment.objects.create(post=Post.objects.create(author=zoe, content='Zoe'), author=zoe, content='Hi')
+
+        self.import_(data, batch_size=2)
+        self.assertTrue(Comment.objects.filter(pk=existing.pk, content='Hi').exists())
+        self.assertFalse(old_ids & set(Comment.objects.exclude(pk=existing.pk).values_list('id', flat=True)))
+        zoe.delete()
+        self.assertEqual(self.snapshot(), before)
+
+        # Paths point at the new ids, so the thread renders as before
+        post = Post.objects.get(content='Hello')
+        for comment in Comment.objects.filter(post=post).select_related('parent'):
+            expected = (comment.parent.path if comment.parent else '') + Comment.path_segment(comment.id)
+            self.assertEqual(comment.path, expected)
+        client = APIClient()
+        client.force_login(User.objects.get(username='bob'))
+        detail = client.get(f'/api/posts/{post.id}/').json()
+        self.assertEqual([c['content'] for c in detail['comments']], ['Root', 'Other root'])
+        self.assertEqual(detail['comments'][0]['replies'][0]['replies'][0]['content'], 'Deep')
+        self.assertTrue(detail['comments'][0]['replies'][0]['is_liked'])
+
+        # New rows continue after the imported ids
+        self.assertGreater(User.objects.create_user('carol').id, User.objects.get(username='bob').id)
+
+    def test_gzip_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'feed.ndjson.gz')
+            call_command('export_feed', output=path, stdout=StringIO())
+            with gzip.open(path, 'rt') as fh:
+                lines = fh.read().splitlines()
+            self.assertEqual(json.loads(lines[0])['type'], 'meta')
+            User.objects.all().delete()
+            call_command('import_feed', path, stdout=StringIO())
+        self.assertEqual(Comment.objects.count(), 4)
+
+    def test_export_streams_each_table_once(self):
+        for i in range(30):
+            Post.objects.create(author=self.bob, content=f'More {i}')
+        with CaptureQueriesContext(connection) as ctx:
+            self.export(chunk_size=5)
+        selects = [q['sql'] for q in ctx.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 7)
+
+    def test_import_inserts_in_batches(self):
+        for i in range(30):
+            Post.objects.create(author=self.bob, content=f'More {i}')
+        data = self.export()
+        User.objects.all().delete()
+        with CaptureQueriesContext(connection) as ctx:
+            self.import_(data, batch_size=10)
+        post_inserts = [q for q in ctx.captured_queries if q['sql'].startswith('INSERT INTO "feed_post"')]
+        self.assertEqual(len(post_inserts), 4)
+        self.assertEqual(Post.objects.count(), 32)
+
+    def test_bad_input_imports_nothing(self):
+        data = self.export()
+        lines = data.splitlines()
+        users = Counter(User.objects.values_list('username', flat=True))
+
+        # Usernames that exist already
+        with self.assertRaisesMessage(CommandError, 'Usernames already taken: alice, bob'):
+            self.import_(data)
+
+        User.objects.all().delete()
+        # Children before their parents
+        swapped = [lines[0]] + [line for line in lines[1:] if '"type":"post"' in line] + \
+            [line for line in lines[1:] if '"type":"user"' in line]
+        with self.assertRaisesMessage(CommandError, 'user records have to come before post records'):
+            self.import_('\n'.join(swapped))
+        # A reference to a row that is not in the file
+        orphan = [line for line in lines if '"type":"post_like"' not in line and '"type":"karma"' not in line]
+        orphan = [line for line in orphan if '"type":"user"' not in line or '"bob"' not in line]
+        with self.assertRaisesMessage(CommandError, 'does not fit together'):
+            self.import_('\n'.join(orphan))
+        # Not an export at all
+        with self.assertRaisesMessage(CommandError, 'not an export_feed file'):
+            self.import_('{"type": "user"}\n')
+        self.assertEqual(User.objects.count(), 0)
+        self.assertEqual(Post.objects.count(), 0)
+
+        self.import_(data)
+        self.assertEqual(Counter(User.objects.values_list('username', flat=True)), users)
+
+
+class SearchTestCase(TestCase):
+    """
+    Test full-text search over posts and comments: the index follows every
+    write path, matches are ranked, and results page with a cursor.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.alice = User.objects.create_user('alice', password='pass123')
+        self.bob = User.objects.create_user('bob', password='pass123')
+        self.running = Post.objects.create(author=self.alice, content='Running shoes for trail running')
+        self.shoes = Post.objects.create(author=self.bob, content='New shoes, old running habit')
+        self.other = Post.objects.create(author=self.bob, content='Baking bread at home')
+        self.comment = Comment.objects.create(post=self.other, author=self.alice, content='Bread needs time to run')
+
+    def ids(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [row['id'] for row in response.json()['results']]
+
+    def test_matches_every_word_most_relevant_first(self):
+        self.assertEqual(self.ids('/api/search/?q=running'), [self.running.id, self.shoes.id])
+        self.assertEqual(self.ids('/api/search/?q=running+bread'), [])
+        self.assertEqual(self.ids('/api/search/?q=BREAD+home'), [self.other.id])
+
+    def test_words_are_stemmed(self):
+        self.assertEqual(self.ids('/api/search/?q=runs'), [self.running.id, self.shoes.id])
+        self.assertEqual(self.ids('/api/search/?q=run&type=comments'), [self.comment.id])
+
+    def test_index_follows_writes(self):
+        self.other.content = 'Running late'
+        self.other.save()
+        self.assertIn(self.other.id, self.ids('/api/search/?q=running'))
+        self.assertEqual(self.ids('/api/search/?q=baking'), [])
+
+        # Counter updates do not touch the index
+        likes.like(self.alice, self.other)
+        self.assertIn(self.other.id, self.ids('/api/search/?q=late'))
+
+        Post.objects.bulk_create([Post(author=self.bob, content='Bulk loaded marathon')])
+        self.assertEqual(len(self.ids('/api/search/?q=marathon')), 1)
+
+        Comment.objects.filter(pk=self.comment.pk).delete_with_likes()
+        self.assertEqual(self.ids('/api/search/?q=bread&type=comments'), [])
+        self.running.delete()
+        self.assertEqual(self.ids('/api/search/?q=trail'), [])
+
+    def test_comments(self):
+        Comment.objects.create(post=self.running, author=self.bob, parent=self.comment, content='Bread again')
+        data = self.client.get('/api/search/?q=bread&type=comments').json()
+        self.assertEqual(len(data['results']), 2)
+        first = data['results'][0]
+        self.assertEqual(
+            set(first),
+            {'id', 'post', 'author', 'content', 'created_at', 'parent', 'like_count', 'descendant_count',
+             'is_liked'}
+        )
+
+    def test_cursor_pages(self):
+        for i in range(5):
+            Post.objects.create(author=self.alice, content=f'Running note {i} ' + 'running ' * i)
+        expected = self.ids('/api/search/?q=running&page_size=100')
+        self.assertEqual(len(expected), 7)
+        ids, url = [], '/api/search/?q=running&page_size=2'
+        with self.assertNumQueries(1):
+            first = self.client.get(url).json()
+        while url:
+            data = self.client.get(url).json()
+            ids.extend(row['id'] for row in data['results'])
+            url = data['next']
+        self.assertEqual(ids, expected)
+        second = self.client.get(first['next']).json()
+        back = self.client.get(second['previous']).json()
+        self.assertEqual(back['results'], first['results'])
+
+    def test_bad_requests(self):
+        for url in ('/api/search/', '/api/search/?q=', '/api/search/?q=%21%21', '/api/search/?q=x&type=users'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 400, url)
+            self.assertIn('error', response.json())
+        self.assertEqual(self.client.get('/api/search/?q=x&cursor=nope').status_code, 404)
+
+    def test_query_syntax_is_taken_literally(self):
+        for q in ('"running', 'running OR bread', 'running*', 'NEAR(running shoes)', 'content:running', "run' --"):
+            response = self.client.get('/api/search/', {'q': q})
+            self.assertEqual(response.status_code, 200, q)
+        self.assertEqual(self.ids('/api/search/?q=running+OR+bread'), [])
+
+    def test_admin_search_uses_index(self):
+        admin = User.objects.create_superuser('admin', password='pass123')
+        self.client.force_login(admin)
+        response = self.client.get('/admin/feed/post/', {'q': 'running'})
+        self.assertEqual(
+            {post.id for post in response.context['cl'].result_list},
+            {self.running.id, self.shoes.id}
+        )
+        response = self.client.get('/admin/feed/post/', {'q': 'bob'})
+        self.assertEqual(
+            {post.id for post in response.context['cl'].result_list},
+            {self.shoes.id, self.other.id}
+        )
+
+    def test_install_is_repeatable(self):
+        search.install(connection)
+        self.assertEqual(self.ids('/api/search/?q=shoes'), [self.running.id, self.shoes.id])
+
+
+class HotFeedTestCase(TestCase):
+    """
+    Test the hot feed (?sort=hot): the stored hot_score follows likes and
+    comments, orders by decayed popularity, and pages by keyset.
+    """
+
+    def setUp(self):
+        self.client = APIClient()
+        self.author = User.objects.create_user('author', password='pass123')
+        self.fans = [User.objects.create_user(f'fan{i}', password='pass123') for i in range(4)]
+        self.old = self.post_at('Old', timedelta(days=3))
+        self.popular = self.post_at('Popular', timedelta(hours=20))
+        self.new = self.post_at('New', timedelta(0))
+        for fan in self.fans:
+            likes.like(fan, self.popular)
+            likes.like(fan, self.old)
+
+    def post_at(self, content, age):
+        post = Post.objects.create(author=self.author, content=content)
+        created_at = timezone.now() - age
+        Post.objects.filter(pk=post.pk).update(created_at=created_at, hot_score=hot.score(created_at, 0, 0))
+        return post
+
+    def ids(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return [post['id'] for post in response.json()['results']]
+
+    def assertScoreMatchesCounters(self, post):
+        post.refresh_from_db()
+        self.assertAlmostEqual(
+            post.hot_score, hot.score(post.created_at, post.like_count, post.comment_count), places=9
+        )
+
+    def test_popular_posts_outrank_newer_ones_until_they_decay(self):
+        # 5 points 20 hours ago beat 1 point now; 5 points three days ago do not
+        self.assertEqual(self.ids('/api/posts/?sort=hot'), [self.popular.id, self.new.id, self.old.id])
+        self.assertEqual(self.ids('/api/posts/'), [self.new.id, self.popular.id, self.old.id])
+        with self.settings(HOT_HALF_LIFE_HOURS=4):
+            call_command('refresh_hot_scores', stdout=StringIO())
+            self.assertEqual(self.ids('/api/posts/?sort=hot'), [self.new.id, self.popular.id, self.old.id])
+
+    def test_score_follows_every_write(self):
+        client = APIClient()
+        client.force_authenticate(user=self.fans[0])
+        for post in (self.old, self.popular, self.new):
+            self.assertScoreMatchesCounters(post)
+
+        client.put(f'/api/posts/{self.new.id}/like/')
+        self.assertScoreMatchesCounters(self.new)
+        response = client.post('/api/comments/', {'post': self.new.id, 'content': 'First'})
+        client.post('/api/comments/', {'post': self.new.id, 'content': 'Reply', 'parent': response.json()['id']})
+        self.assertScoreMatchesCounters(self.new)
+        client.delete(f'/api/comments/{response.json()["id"]}/')
+        self.assertScoreMatchesCounters(self.new)
+        client.delete(f'/api/posts/{self.new.id}/like/')
+        self.assertScoreMatchesCounters(self.new)
+
+        ids = {'ids': [self.old.id, self.new.id]}
+        client.post('/api/posts/unlike-batch/', ids, format='json')
+        client.post('/api/posts/like-batch/', {'ids': [self.new.id]}, format='json')
+        for post in (self.old, self.new):
+            self.assertScoreMatchesCounters(post)
+
+    def test_recount_and_refresh_repair_scores(self):
+        Post.objects.filter(pk=self.popular.pk).update(
+            like_count=40, hot_score=hot.rescored(like_count=Value(40))
+        )
+        call_command('recount', stdout=StringIO())
+        self.assertEqual(Post.objects.get(pk=self.popular.pk).like_count, 4)
+        self.assertScoreMatchesCounters(self.popular)
+
+        Post.objects.update(hot_score=0)
+        out = StringIO()
+        call_command('refresh_hot_scores', '--batch-size', '2', stdout=out)
+        self.assertIn('Checked 3 post(s), updated 3 hot score(s)', out.getvalue())
+        for post in (self.old, self.popular, self.new):
+            self.assertScoreMatchesCounters(post)
+
+        out = StringIO()
+        call_command('refresh_hot_scores', stdout=out)
+        self.assertIn('updated 0 hot score(s)', out.getvalue())
+
+    def test_pages_cover_hot_feed_in_order(self):
+        for i in range(5):
+            Post.objects.create(author=self.author, content=f'Post {i}')
+        expected = list(Post.objects.order_by('-hot_score', '-id').values_list('id', flat=True))
+        ids, url = [], '/api/posts/?sort=hot&page_size=3'
+        while url:
+            with self.assertNumQueries(1):
+                data = self.client.get(url).json()
+            ids.extend(post['id'] for post in data['results'])
+            url = data['next']
+        self.assertEqual(ids, expected)
+
+    def test_etag_changes_with_hot_order(self):
+        url = '/api/posts/?sort=hot'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        with self.settings(HOT_HALF_LIFE_HOURS=4):
+            call_command('refresh_hot_scores', stdout=StringIO())
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_unknown_sort_is_rejected(self):
+        response = self.client.get('/api/posts/?sort=top')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', response.json())
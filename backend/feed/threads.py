@@ -0,0 +1,180 @@
+"""
+Windowed comment trees.
+
+Post detail used to load and nest every comment of a post, so one viral
+thread meant one enormous response. Instead we load a bounded window:
+
+- at most `roots` top-level comments,
+- at most `replies` replies under each comment,
+- at most `depth` levels in total,
+- at most `nodes` comments in all.
+
+The per-level bounds multiply, so `nodes` is what keeps a window of a wide
+thread small: levels are filled breadth-first, and once the budget is
+spent the remaining replies are cut off like any others. Every node whose
+replies were cut off carries a `more_replies` continuation token, and the
+list of top-level comments carries one too if there are more. Feeding a
+token to GET /posts/{id}/comments/ returns the next window under that
+node, with the same bounds. Loading a window costs one query per level
+(replies are capped per parent with ROW_NUMBER() OVER (PARTITION BY parent))
+plus one probe for replies below the last level, whatever the thread size.
+
+Comments are loaded as flat `values()` rows rather than model instances and
+rendered straight to nested dicts by serializers.render_comment_tree.
+"""
+import base64
+import json
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import F, Q, Window
+from django.db.models.functions import RowNumber
+from django.utils.dateparse import parse_datetime
+
+from .models import Comment
+from .serializers import COMMENT_TREE_COLUMNS
+
+MAX_ROOTS = 100
+MAX_DEPTH = 20
+MAX_REPLIES = 100
+MAX_NODES = 500
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def encode_token(parent_id, after=None):
+    """Token for the replies of `parent_id` (None for top level) following row `after`."""
+    payload = {'p': parent_id}
+    if after is not None:
+        payload['t'] = after['created_at'].isoformat()
+        payload['i'] = after['id']
+    return base64.urlsafe_b64encode(
+        json.dumps(payload, separators=(',', ':')).encode()
+    ).decode().rstrip('=')
+
+
+def decode_token(token):
+    """Return (parent_id, (created_at, id) or None)."""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        parent_id = payload['p']
+        if parent_id is not None:
+            parent_id = int(parent_id)
+        after = None
+        if 't' in payload:
+            created_at = parse_datetime(payload['t'])
+            if created_at is None:
+                raise ValueError
+            after = (created_at, int(payload['i']))
+    except (TypeError, ValueError, KeyError, UnicodeDecodeError):
+        raise InvalidToken(token)
+    return parent_id, after
+
+
+def window_params(query_params):
+    """Window bounds from settings, optionally narrowed/widened per request."""
+    bounds = {
+        'roots': (settings.COMMENT_TREE_ROOTS, MAX_ROOTS),
+        'depth': (settings.COMMENT_TREE_DEPTH, MAX_DEPTH),
+        'replies': (settings.COMMENT_TREE_REPLIES, MAX_REPLIES),
+        'nodes': (settings.COMMENT_TREE_NODES, MAX_NODES),
+    }
+    params = {}
+    for name, (default, cap) in bounds.items():
+        try:
+            value = int(query_params.get(name, default))
+        except (TypeError, ValueError):
+            value = default
+        params[name] = max(1, min(value, cap))
+    return params
+
+
+def comment_queryset():
+    """Comment rows with the columns render_comment_tree needs."""
+    return Comment.objects.values(*COMMENT_TREE_COLUMNS)
+
+
+def load_window(post, parent_id=None, after=None,
+                roots=None, depth=None, replies=None, nodes=None):
+    """
+    Load one window of a post's comment tree. Bounds left as None come from
+    settings.
+
+    Returns (rows, more): a flat list of the loaded comment rows, each with a
+    `more_replies` token or None, ready for render_comment_tree(rows); and the
+    token for the next page of the top-level siblings.
+    """
+    defaults = window_params({})
+    roots = roots or defaults['roots']
+    depth = depth or defaults['depth']
+    replies = replies or defaults['replies']
+    nodes = nodes or defaults['nodes']
+    roots = min(roots, nodes)
+
+    base = comment_queryset().filter(post=post)
+
+    level = base.filter(parent_id=parent_id) if parent_id else base.filter(parent__isnull=True)
+    if after is not None:
+        created_at, comment_id = after
+        level = level.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=comment_id)
+        )
+    top = list(level.order_by('created_at', 'id')[:roots + 1])
+    more = None
+    if len(top) > roots:
+        top = top[:roots]
+        more = encode_token(parent_id, top[-1])
+
+    for row in top:
+        row['more_replies'] = None
+    comments = list(top)
+    frontier = top
+
+    for _ in range(depth - 1):
+        if not frontier or len(comments) >= nodes:
+            break
+        children = (
+            base.filter(parent_id__in=[row['id'] for row in frontier])
+            .annotate(sibling_rank=Window(
+                RowNumber(),
+                partition_by=[F('parent_id')],
+                order_by=[F('created_at').asc(), F('id').asc()],
+            ))
+            .filter(sibling_rank__lte=replies + 1)
+            .order_by()
+        )
+        # At most len(frontier) * (replies + 1) rows: sort here rather than
+        # make the database sort the window function's output again.
+        by_parent = defaultdict(list)
+        for child in sorted(children, key=lambda row: (row['created_at'], row['id'])):
+            child['more_replies'] = None
+            by_parent[child['parent_id']].append(child)
+
+        next_frontier = []
+        budget = nodes - len(comments)
+        for parent in frontier:
+            kids = by_parent.get(parent['id'], [])
+            shown = kids[:min(replies, budget - len(next_frontier))]
+            if len(shown) < len(kids):
+                parent['more_replies'] = encode_token(parent['id'], shown[-1] if shown else None)
+            next_frontier.extend(shown)
+        comments.extend(next_frontier)
+        frontier = next_frontier
+
+    if frontier:
+        # Depth limit reached: flag the nodes that have replies we did not load
+        with_replies = set(
+            Comment.objects
+            .filter(parent_id__in=[row['id'] for row in frontier])
+            .order_by()
+            .values_list('parent_id', flat=True)
+            .distinct()
+        )
+        for row in frontier:
+            if row['id'] in with_replies:
+                row['more_replies'] = encode_token(row['id'])
+
+    return comments, more
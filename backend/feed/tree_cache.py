@@ -0,0 +1,184 @@
+"""
+Cache of rendered comment tree windows.
+
+Comment trees are read far more often than they change, so the rendered
+window (see threads.py) is cached per post, without any viewer-specific
+data. Every key embeds the post's current version number, and any change to
+the post's comments or comment likes bumps the version, so stale entries are
+never read again and simply age out of the cache.
+
+`is_liked` is the only per-viewer field. It is stored as False and overlaid
+on each request from one lookup of which of the rendered comments the
+viewer has liked.
+
+The version is bumped right away and again once the transaction commits:
+the first bump stops this transaction from reading its own stale entries,
+the second throws away anything another request cached from the old rows
+while the transaction was still open.
+
+Windows are always loaded from the primary database, even on requests
+that otherwise read from a replica.
+
+The cache is picked with the COMMENT_TREE_CACHE setting (a CACHES alias).
+It has to be shared by every web worker, or the others keep serving trees
+one worker has invalidated; the default settings disable it until one is
+configured.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import likes, routers, threads
+from .models import Post, Comment, CommentLike
+from .serializers import render_comment_tree
+
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[settings.COMMENT_TREE_CACHE]
+
+
+def _count(outcome):
+    with _stats_lock:
+        _stats[outcome] += 1
+
+
+def stats():
+    """Hit/miss counters of this process since it started (or since reset_stats)."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        for outcome in _stats:
+            _stats[outcome] = 0
+
+
+def _version_key(post_id):
+    return f'comment-tree:{post_id}:version'
+
+
+def get_version(post_id):
+    """The post's current tree version, or None if the cache cannot hold one."""
+    cache = get_cache()
+    key = _version_key(post_id)
+    version = cache.get(key)
+    if version is None:
+        # Start from the clock rather than 1 so that a version evicted from
+        # the cache is never handed out again for different contents.
+        cache.add(key, time.time_ns(), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def _bump(post_id):
+    cache = get_cache()
+    key = _version_key(post_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), timeout=None)
+
+
+def invalidate(post_id):
+    """Make every cached window of the post stale."""
+    _bump(post_id)
+    transaction.on_commit(lambda: _bump(post_id))
+
+
+def _window_key(post, version, parent_id, after, roots, depth, replies, nodes):
+    # created_at guards against a recycled post id picking up old entries
+    start = f'{after[0].isoformat()}/{after[1]}' if after else '-'
+    return (
+        f'comment-tree:{post.id}:{post.created_at.timestamp()}:{version}:'
+        f'{parent_id or "-"}:{start}:{roots}:{depth}:{replies}:{nodes}'
+    )
+
+
+def load_window(post, user, parent_id=None, after=None, roots=None, depth=None, replies=None, nodes=None):
+    """
+    Cached equivalent of rendering threads.load_window(...) for `user`.
+    Returns (tree, more) with the tree already rendered to dicts.
+    """
+    defaults = threads.window_params({})
+    roots = roots or defaults['roots']
+    depth = depth or defaults['depth']
+    replies = replies or defaults['replies']
+    nodes = nodes or defaults['nodes']
+
+    cache = get_cache()
+    version = get_version(post.id)
+    key = None
+    cached = None
+    if version is not None:
+        key = _window_key(post, version, parent_id, after, roots, depth, replies, nodes)
+        cached = cache.get(key)
+
+    if cached is not None:
+        _count('hits')
+        tree, more = cached
+    else:
+        _count('misses')
+        # Everyone reads this entry until the next version, so never fill it
+        # from a replica that may not have the latest change yet
+        with routers.primary_reads():
+            rows, more = threads.load_window(
+                post, parent_id=parent_id, after=after,
+                roots=roots, depth=depth, replies=replies, nodes=nodes,
+            )
+        tree = render_comment_tree(rows)
+        if key is not None:
+            cache.set(key, (tree, more), settings.COMMENT_TREE_CACHE_TIMEOUT)
+
+    overlay_likes(tree, user)
+    return tree, more
+
+
+def overlay_likes(tree, user):
+    """Set `is_liked` on every rendered comment for `user`, with one query."""
+    if user is None or not user.is_authenticated:
+        return
+    nodes = []
+    stack = list(tree)
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node['replies'])
+    liked = likes.liked_ids(user, Comment, [node['id'] for node in nodes])
+    for node in nodes:
+        node['is_liked'] = node['id'] in liked
+
+
+@receiver([post_save, post_delete], sender=Comment)
+def comment_changed(sender, instance, origin=None, **kwargs):
+    if isinstance(origin, Post) or (isinstance(origin, Comment) and origin is not instance):
+        # Cascade: the deleted post needs no tree, the deleted ancestor
+        # comment invalidates the post itself
+        return
+    invalidate(instance.post_id)
+
+
+# Saves only: with no delete receiver, queryset deletes of likes stay a
+# single statement (see CommentQuerySet.delete_with_likes). Every path that
+# deletes likes (likes.unlike / unlike_many, comment and post deletes)
+# invalidates the affected posts itself.
+@receiver(post_save, sender=CommentLike)
+def comment_like_changed(sender, instance, **kwargs):
+    if CommentLike.comment.is_cached(instance):
+        post_id = instance.comment.post_id
+    else:
+        post_id = (
+            Comment.objects.filter(pk=instance.comment_id)
+            .values_list('post_id', flat=True)
+            .first()
+        )
+    if post_id is not None:
+        invalidate(post_id)
@@ -12,5 +12,10 @@ urlpatterns = [
     path('auth/login/', views.LoginView.as_view(), name='login'),
     path('auth/logout/', views.LogoutView.as_view(), name='logout'),
     path('auth/me/', views.CurrentUserView.as_view(), name='current-user'),
+    path('search/', views.SearchView.as_view(), name='search'),
     path('leaderboard/', views.leaderboard, name='leaderboard'),
+    path('leaderboard/stream/', views.leaderboard_stream, name='leaderboard-stream'),
+    path('posts/<int:pk>/stream/', views.post_stream, name='post-stream'),
+    path('cache-stats/', views.cache_stats, name='cache-stats'),
+    path('outbox-stats/', views.outbox_stats, name='outbox-stats'),
 ]
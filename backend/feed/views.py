@@ -1,20 +1,26 @@
-from rest_framework import viewsets, status, permissions
+from rest_framework import generics, viewsets, status, permissions
 from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.db import IntegrityError, transaction
-from django.db.models import Count, Sum, Prefetch, Exists, OuterRef
+from django.db.models import F, Q, Prefetch
+from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from datetime import timedelta
+from django.views.decorators.http import require_GET
+import hmac
 from collections import defaultdict
 
+from . import etags, hot, karma, likes, live, metrics, middleware, outbox, pubsub, routers, search, threads, tree_cache, leaderboard as leaderboard_index
 from .models import Post, Comment, PostLike, CommentLike, KarmaTransaction
+from .pagination import FEED_SORTS, KeysetCursorPagination, SearchCursorPagination
 from .serializers import (
-    PostSerializer, PostDetailSerializer, CommentSerializer,
+    PostSerializer, PostDetailSerializer, CommentSerializer, CommentSearchSerializer,
     LeaderboardUserSerializer, RegisterSerializer, UserSerializer
 )
 
@@ -29,10 +35,13 @@ class RegisterView(APIView):
             try:
                 user = serializer.save()
                 login(request, user)
-                return Response({
+                response = Response({
                     'user': UserSerializer(user).data,
                     'message': 'Registration successful'
                 }, status=status.HTTP_201_CREATED)
+                # The new session and user are only on the primary so far
+                routers.pin(response)
+                return response
             except IntegrityError:
                 return Response(
                     {'error': 'Username already exists'},
@@ -52,10 +61,12 @@ class LoginView(APIView):
         user = authenticate(request, username=username, password=password)
         if user:
             login(request, user)
-            return Response({
+            response = Response({
                 'user': UserSerializer(user).data,
                 'message': 'Login successful'
             })
+            routers.pin(response)
+            return response
         return Response(
             {'error': 'Invalid credentials'},
             status=status.HTTP_401_UNAUTHORIZED
@@ -85,6 +96,10 @@ def build_comment_tree(comments):
     """
     Build a tree structure from a flat list of comments.
     This runs in O(n) time after fetching all comments in one query.
+    
+    The list may be partial (a subtree range, a depth-limited slice or a
+    window): any comment whose parent was not loaded becomes a root.
+    Children keep the order they have in `comments`.
     """
     comment_map = {c.id: c for c in comments}
     roots = []
@@ -93,125 +108,301 @@ def build_comment_tree(comments):
         comment.children = []
     
     for comment in comments:
-        if comment.parent_id is None:
-            roots.append(comment)
+        parent = comment_map.get(comment.parent_id)
+        if parent is not None:
+            parent.children.append(comment)
         else:
-            parent = comment_map.get(comment.parent_id)
-            if parent:
-                parent.children.append(comment)
+            roots.append(comment)
     
     return roots
 
 
+class ReplicaReadsMixin:
+    """
+    Read from a replica on safe-method requests, and pin the client to the
+    primary for a moment after a successful write (see feed/routers.py).
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        # Load the session and user (lazy until now) from the primary
+        request.user.is_authenticated
+        with routers.replica_reads(request):
+            response = super().dispatch(request, *args, **kwargs)
+        if request.method not in permissions.SAFE_METHODS and response.status_code < 400:
+            routers.pin(response)
+        return response
+
+
+class ViewerLikesMixin:
+    """
+    Serialize with the viewer's liked ids among the objects being
+    serialized, fetched with one query (see feed/likes.py) instead of a
+    correlated Exists(...) subquery per row.
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        if args and args[0] is not None:
+            instance = args[0]
+            if kwargs.get('many'):
+                # Evaluate once here; the serializer reuses the list
+                instance = list(instance)
+                objects = instance
+            else:
+                objects = [instance]
+            model = self.get_queryset().model
+            context = kwargs.setdefault('context', self.get_serializer_context())
+            context[likes.context_key(model)] = likes.liked_ids(
+                self.request.user, model, [obj.pk for obj in objects]
+            )
+            args = (instance, *args[1:])
+        return super().get_serializer(*args, **kwargs)
+
+
+def batch_ids(request):
+    """The `ids` list of a batch like/unlike request, or an error Response."""
+    ids = request.data.get('ids')
+    if not isinstance(ids, list) or not ids:
+        return None, Response(
+            {'error': 'ids must be a non-empty list'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if len(ids) > likes.MAX_BATCH:
+        return None, Response(
+            {'error': f'At most {likes.MAX_BATCH} ids per request'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+        return [int(value) for value in ids], None
+    except (TypeError, ValueError):
+        return None, Response(
+            {'error': 'ids must be integers'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+
+def batch_response(request, model, operation):
+    """
+    Run likes.like_many / likes.unlike_many for the request's ids in one
+    transaction and report a status per id, in request order.
+    """
+    ids, error = batch_ids(request)
+    if error:
+        return error
+    with transaction.atomic():
+        outcome = operation(request.user, model, ids)
+    return Response({
+        'results': [{'id': target_id, 'status': result} for target_id, result in outcome.items()]
+    })
+
+
+def uncount_comments(per_post, per_ancestor):
+    """
+    Take deleted comments off their posts' comment counts and hot scores
+    and off the descendant counts of the comments above them, as returned
+    by CommentQuerySet.removal_counts(): one UPDATE per post and one per
+    distinct number of descendants removed.
+    """
+    ancestors = defaultdict(list)
+    for comment_id, removed in per_ancestor.items():
+        ancestors[removed].append(comment_id)
+    for removed, comment_ids in ancestors.items():
+        Comment.objects.filter(pk__in=comment_ids).update(descendant_count=F('descendant_count') - removed)
+    for post_id, removed in per_post.items():
+        tree_cache.invalidate(post_id)
+        Post.objects.filter(pk=post_id).update(
+            comment_count=F('comment_count') - removed,
+            hot_score=hot.rescored(comment_count=F('comment_count') - removed),
+            updated_at=timezone.now()
+        )
+
+
+class LikeActionsMixin:
+    """
+    Like endpoints shared by posts and comments, all on likes.like /
+    likes.unlike (one conflict-free statement each, see feed/likes.py):
+
+    - PUT /{id}/like/ and DELETE /{id}/like/ set the viewer's like on the
+      resource idempotently; repeating either returns 200 with
+      `changed: false`.
+    - POST /{id}/like/ and POST /{id}/unlike/ keep their old behaviour of
+      answering 400 when there is nothing to do.
+    - POST like-batch/ and unlike-batch/ take {"ids": [...]}.
+    """
+
+    @action(detail=True, methods=['post', 'put', 'delete'],
+            permission_classes=[permissions.IsAuthenticated])
+    def like(self, request, pk=None):
+        target = self.get_object()
+        noun = target._meta.verbose_name
+
+        with transaction.atomic():
+            if request.method == 'DELETE':
+                changed = likes.unlike(request.user, target)
+            else:
+                changed = likes.like(request.user, target)
+
+        if request.method == 'POST':
+            if not changed:
+                return Response(
+                    {'error': f'Already liked this {noun}'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            return Response({'liked': True, 'message': f'{noun.capitalize()} liked'})
+        return Response({'liked': request.method == 'PUT', 'changed': changed})
+
+    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
+    def unlike(self, request, pk=None):
+        target = self.get_object()
+        noun = target._meta.verbose_name
+
+        with transaction.atomic():
+            changed = likes.unlike(request.user, target)
+
+        if not changed:
+            return Response(
+                {'error': f'You have not liked this {noun}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({'liked': False, 'message': f'{noun.capitalize()} unliked'})
+
+    @action(detail=False, methods=['post'], url_path='like-batch',
+            permission_classes=[permissions.IsAuthenticated])
+    def like_batch(self, request):
+        """Like many objects at once: {"ids": [...]}."""
+        return batch_response(request, self.get_queryset().model, likes.like_many)
+
+    @action(detail=False, methods=['post'], url_path='unlike-batch',
+            permission_classes=[permissions.IsAuthenticated])
+    def unlike_batch(self, request):
+        """Unlike many objects at once: {"ids": [...]}."""
+        return batch_response(request, self.get_queryset().model, likes.unlike_many)
+
+
 @method_decorator(csrf_exempt, name='dispatch')
-class PostViewSet(viewsets.ModelViewSet):
+class PostViewSet(ReplicaReadsMixin, LikeActionsMixin, ViewerLikesMixin, viewsets.ModelViewSet):
     serializer_class = PostSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
+    pagination_class = KeysetCursorPagination
 
     def get_queryset(self):
-        user = self.request.user
-        queryset = Post.objects.select_related('author')
-        
-        # Annotate with counts
-        queryset = queryset.annotate(
-            prefetched_likes_count=Count('likes', distinct=True),
-            prefetched_comments_count=Count('comments', distinct=True)
-        )
-        
-        # Check if current user has liked each post
-        if user.is_authenticated:
-            queryset = queryset.annotate(
-                user_has_liked=Exists(
-                    PostLike.objects.filter(post=OuterRef('pk'), user=user)
-                )
-            )
-        
-        return queryset
+        # like_count / comment_count are stored on the row, so no joins here;
+        # is_liked comes from ViewerLikesMixin
+        return Post.objects.select_related('author')
 
     def get_serializer_class(self):
         if self.action == 'retrieve':
             return PostDetailSerializer
         return PostSerializer
 
+    def list(self, request, *args, **kwargs):
+        # ?sort=new (default) is newest first, ?sort=hot by hot_score
+        sort = request.query_params.get('sort', 'new')
+        if sort not in FEED_SORTS:
+            return Response(
+                {'error': f'sort must be one of: {", ".join(FEED_SORTS)}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        self.pagination_class = FEED_SORTS[sort]
+        # hot_score moves with updated_at except under refresh_hot_scores
+        stamp_fields = ('id', 'updated_at', 'hot_score') if sort == 'hot' else ('id', 'updated_at')
+        if etags.is_conditional(request):
+            # Polling clients usually already have the page: answer them
+            # from (id, updated_at) of the page's rows alone
+            etag = etags.make_etag(request, self.paginator.page_stamp(
+                self.get_queryset(), request, stamp_fields
+            ))
+            response = etags.not_modified(request, etag)
+            if response is not None:
+                return response
+
+        response = super().list(request, *args, **kwargs)
+        # The full page has the same stamp, so a plain GET costs no extra query
+        etag = etags.make_etag(request, self.paginator.loaded_stamp(stamp_fields))
+        return etags.tag(response, etag)
+
     def retrieve(self, request, *args, **kwargs):
+        stamp = etags.post_stamp(kwargs['pk'])
+        etag = etags.make_etag(request, stamp) if stamp is not None else None
+        if etag is not None:
+            response = etags.not_modified(request, etag)
+            if response is not None:
+                return response
+
         post = self.get_object()
-        user = request.user
-        
-        # Fetch ALL comments for this post in ONE query
-        comments = Comment.objects.filter(post=post).select_related('author')
         
-        # Annotate like counts
-        comments = comments.annotate(
-            prefetched_likes_count=Count('likes', distinct=True)
+        # A bounded window of the thread: one query per level, however many
+        # comments the post has, and usually none at all since the rendered
+        # window is cached per post. Truncated nodes get continuation tokens.
+        post.rendered_comments, post.more_comments = tree_cache.load_window(
+            post, request.user, **threads.window_params(request.query_params)
         )
         
-        # Check if user liked each comment
-        if user.is_authenticated:
-            comments = comments.annotate(
-                user_has_liked=Exists(
-                    CommentLike.objects.filter(comment=OuterRef('pk'), user=user)
-                )
-            )
+        serializer = self.get_serializer(post, context={'request': request})
+        response = Response(serializer.data)
+        return etags.tag(response, etag) if etag is not None else response
+
+    @action(detail=True, methods=['get'], url_path='comments')
+    def comment_window(self, request, pk=None):
+        """
+        Expand part of the comment tree: ?cursor=<token> continues from a
+        `more_replies` / `more_comments` token, ?parent=<id> starts at the
+        first replies of a comment.
+        """
+        post = self.get_object()
         
-        comments = list(comments)
+        parent_id, after = None, None
+        try:
+            if request.query_params.get('cursor'):
+                parent_id, after = threads.decode_token(request.query_params['cursor'])
+            elif request.query_params.get('parent'):
+                parent_id = int(request.query_params['parent'])
+        except (threads.InvalidToken, ValueError):
+            raise NotFound('Invalid cursor')
         
-        # Build tree in Python (no extra queries)
-        post.comment_tree = build_comment_tree(comments)
+        if parent_id is not None and not Comment.objects.filter(pk=parent_id, post=post).exists():
+            raise NotFound('Comment not found on this post')
         
-        serializer = self.get_serializer(post, context={'request': request})
-        return Response(serializer.data)
+        tree, more = tree_cache.load_window(
+            post, request.user, parent_id=parent_id, after=after,
+            **threads.window_params(request.query_params)
+        )
+        return Response({
+            'results': tree,
+            'next': more,
+        })
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
-    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
-    def like(self, request, pk=None):
-        post = self.get_object()
-        user = request.user
-        
-        # Use atomic transaction to handle race conditions
+    def perform_destroy(self, instance):
         with transaction.atomic():
-            try:
-                # select_for_update would be overkill here since we have unique constraint
-                post_like = PostLike.objects.create(user=user, post=post)
-                
-                # Create karma transaction for post author
-                KarmaTransaction.objects.create(
-                    user=post.author,
-                    karma_type='post_like',
-                    points=KarmaTransaction.KARMA_POST_LIKE,
-                    post_like=post_like
-                )
-                
-                return Response({'liked': True, 'message': 'Post liked'})
-            except IntegrityError:
-                # Already liked - the unique constraint caught it
-                return Response(
-                    {'error': 'Already liked this post'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
-    def unlike(self, request, pk=None):
-        post = self.get_object()
-        user = request.user
-        
-        with transaction.atomic():
-            try:
-                post_like = PostLike.objects.get(user=user, post=post)
-                # Delete related karma transaction
-                KarmaTransaction.objects.filter(post_like=post_like).delete()
-                post_like.delete()
-                return Response({'liked': False, 'message': 'Post unliked'})
-            except PostLike.DoesNotExist:
-                return Response(
-                    {'error': 'You have not liked this post'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+            thread = Comment.objects.filter(post=instance).with_stray_replies()
+            comments = thread.values('id')
+            # The cascade would drop the karma rows anyway; revoke them first
+            # so the leaderboard buckets lose the points too.
+            karma.revoke(KarmaTransaction.objects.filter(
+                Q(post_like__post=instance) | Q(comment_like__comment_id__in=comments)
+            ))
+            karma.revoke_compacted_likes(
+                PostLike.objects.filter(post=instance), 'post__author_id', KarmaTransaction.KARMA_POST_LIKE
+            )
+            karma.revoke_compacted_likes(
+                CommentLike.objects.filter(comment_id__in=comments),
+                'comment__author_id',
+                KarmaTransaction.KARMA_COMMENT_LIKE
+            )
+            # The thread goes in a fixed number of statements however big it
+            # is; the post's own delete() then finds nothing left to cascade
+            per_post, per_ancestor = thread.removal_counts()
+            thread.delete_with_likes()
+            # Stray replies may have sat on other posts
+            per_post.pop(instance.id, None)
+            uncount_comments(per_post, per_ancestor)
+            instance.delete()
 
 
 @method_decorator(csrf_exempt, name='dispatch')
-class CommentViewSet(viewsets.ModelViewSet):
+class CommentViewSet(ReplicaReadsMixin, LikeActionsMixin, ViewerLikesMixin, viewsets.ModelViewSet):
     serializer_class = CommentSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
@@ -222,70 +413,75 @@ class CommentViewSet(viewsets.ModelViewSet):
         if post_id:
             queryset = queryset.filter(post_id=post_id)
         
-        queryset = queryset.annotate(
-            prefetched_likes_count=Count('likes', distinct=True)
-        )
-        
-        if self.request.user.is_authenticated:
-            queryset = queryset.annotate(
-                user_has_liked=Exists(
-                    CommentLike.objects.filter(comment=OuterRef('pk'), user=self.request.user)
-                )
-            )
-        
         return queryset
 
     def perform_create(self, serializer):
         post_id = self.request.data.get('post')
-        parent_id = self.request.data.get('parent')
+        # Already looked up by the serializer's parent field
+        parent = serializer.validated_data.get('parent')
         
         post = Post.objects.get(id=post_id)
-        parent = None
-        if parent_id:
-            parent = Comment.objects.get(id=parent_id)
-        
-        serializer.save(author=self.request.user, post=post, parent=parent)
-
-    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
-    def like(self, request, pk=None):
-        comment = self.get_object()
-        user = request.user
+        if parent is not None and parent.post_id != post.id:
+            # The reply's path is built under its parent's, on that post
+            raise ValidationError({'error': 'The parent comment is on a different post'})
         
         with transaction.atomic():
-            try:
-                comment_like = CommentLike.objects.create(user=user, comment=comment)
-                
-                # Create karma transaction for comment author
-                KarmaTransaction.objects.create(
-                    user=comment.author,
-                    karma_type='comment_like',
-                    points=KarmaTransaction.KARMA_COMMENT_LIKE,
-                    comment_like=comment_like
-                )
-                
-                return Response({'liked': True, 'message': 'Comment liked'})
-            except IntegrityError:
-                return Response(
-                    {'error': 'Already liked this comment'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+            serializer.save(author=self.request.user, post=post, parent=parent)
+            Post.objects.filter(pk=post.pk).update(
+                comment_count=F('comment_count') + 1,
+                hot_score=hot.rescored(comment_count=F('comment_count') + 1),
+                updated_at=timezone.now()
+            )
 
-    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
-    def unlike(self, request, pk=None):
-        comment = self.get_object()
-        user = request.user
-        
+    def perform_destroy(self, instance):
         with transaction.atomic():
-            try:
-                comment_like = CommentLike.objects.get(user=user, comment=comment)
-                KarmaTransaction.objects.filter(comment_like=comment_like).delete()
-                comment_like.delete()
-                return Response({'liked': False, 'message': 'Comment unliked'})
-            except CommentLike.DoesNotExist:
-                return Response(
-                    {'error': 'You have not liked this comment'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+            subtree = Comment.objects.subtree(instance).with_stray_replies()
+            ids = subtree.values('id')
+            karma.revoke(KarmaTransaction.objects.filter(comment_like__comment_id__in=ids))
+            karma.revoke_compacted_likes(
+                CommentLike.objects.filter(comment_id__in=ids),
+                'comment__author_id',
+                KarmaTransaction.KARMA_COMMENT_LIKE
+            )
+            # Deleting a comment removes its whole reply subtree, in a fixed
+            # number of statements however big it is
+            per_post, per_ancestor = subtree.removal_counts()
+            subtree.delete_with_likes()
+            uncount_comments(per_post, per_ancestor)
+
+
+class SearchView(ReplicaReadsMixin, ViewerLikesMixin, generics.ListAPIView):
+    """
+    Full-text search: ?q=<words>, with ?type=posts (default) or comments.
+    Every word has to match; results come most relevant first, paged with
+    ?cursor= like the feed. Served from the database's full-text index,
+    see feed/search.py.
+    """
+    permission_classes = [permissions.AllowAny]
+    pagination_class = SearchCursorPagination
+    models = {'posts': Post, 'comments': Comment}
+
+    def list(self, request, *args, **kwargs):
+        if not search.terms(request.query_params.get('q', '')):
+            return Response(
+                {'error': 'q must contain at least one word'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if request.query_params.get('type', 'posts') not in self.models:
+            return Response(
+                {'error': 'type must be posts or comments'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return super().list(request, *args, **kwargs)
+
+    def get_queryset(self):
+        model = self.models[self.request.query_params.get('type', 'posts')]
+        return search.search(model.objects.select_related('author'), self.request.query_params['q'])
+
+    def get_serializer_class(self):
+        if self.request.query_params.get('type', 'posts') == 'comments':
+            return CommentSearchSerializer
+        return PostSerializer
 
 
 @api_view(['GET'])
@@ -294,39 +490,89 @@ def leaderboard(request):
     """
     Get top 5 users by karma earned in the last 24 hours.
     
-    This query:
-    1. Filters KarmaTransaction to last 24 hours
-    2. Groups by user
-    3. Sums the points
-    4. Orders by total descending
-    5. Takes top 5
+    Rather than grouping every KarmaTransaction in the window, this sums the
+    5-minute KarmaBucket rollups (at most 288 per user) and takes the exact
+    ledger rows only for the partial bucket at the window edge:
     
-    The SQL generated is roughly:
-    SELECT user_id, SUM(points) as karma_24h
-    FROM feed_karmatransaction
-    WHERE created_at >= NOW() - INTERVAL '24 hours'
+    SELECT user_id, SUM(points) FROM feed_karmabucket
+    WHERE bucket_start >= :first_whole_bucket
     GROUP BY user_id
-    ORDER BY karma_24h DESC
-    LIMIT 5
-    """
-    cutoff = timezone.now() - timedelta(hours=24)
     
-    top_users = (
-        KarmaTransaction.objects
-        .filter(created_at__gte=cutoff)
-        .values('user_id', 'user__username')
-        .annotate(karma_24h=Sum('points'))
-        .order_by('-karma_24h')[:5]
-    )
+    SELECT user_id, SUM(points) FROM feed_karmatransaction
+    WHERE created_at >= NOW() - INTERVAL '24 hours'
+      AND created_at < :first_whole_bucket
+    GROUP BY user_id
     
-    result = [
-        {
-            'id': entry['user_id'],
-            'username': entry['user__username'],
-            'karma_24h': entry['karma_24h'],
-            'rank': idx + 1
+    See feed/karma.py. By default the result is served from an in-process
+    index that follows karma changes and never touches the database on the
+    hot path (see feed/leaderboard.py). Pollers that already have the current
+    board get a 304 (see feed/etags.py).
+    """
+    etag = etags.make_etag(request, leaderboard_index.stamp(limit=5), viewer=False)
+    response = etags.not_modified(request, etag)
+    if response is not None:
+        return response
+    return etags.tag(Response(leaderboard_index.top_users(limit=5)), etag)
+
+
+@require_GET
+def post_stream(request, pk):
+    """
+    Server-sent events for one post: new comments and like count changes
+    (see feed/live.py). Each open stream holds a worker thread here; the
+    ASGI app serves streams from the event loop instead.
+    """
+    if not Post.objects.filter(pk=pk).exists():
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    subscription = pubsub.subscribe(live.post_channel(pk), live.last_event_id(request))
+    return live.stream_response(live.events(subscription))
+
+
+@require_GET
+def leaderboard_stream(request):
+    """Server-sent events with the new top 5 whenever the leaderboard changes."""
+    subscription = pubsub.subscribe(live.LEADERBOARD, live.last_event_id(request))
+    live.refresh_leaderboard()
+    return live.stream_response(live.events(
+        subscription,
+        on_idle=lambda: live.refresh_leaderboard(min_interval=settings.SSE_HEARTBEAT_SECONDS),
+    ))
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def cache_stats(request):
+    """
+    Hit/miss counters of the comment tree cache and the compressed-response
+    cache in this worker process.
+    """
+    stats = {}
+    for name, counters in (('comment_tree', tree_cache.stats()), ('compression', middleware.stats())):
+        lookups = counters['hits'] + counters['misses']
+        stats[name] = {
+            **counters,
+            'hit_rate': counters['hits'] / lookups if lookups else None,
         }
-        for idx, entry in enumerate(top_users)
-    ]
-    
-    return Response(result)
+    return Response(stats)
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def outbox_stats(request):
+    """How far the outbox worker is behind: pending/failed events and lag in seconds."""
+    return Response(outbox.lag())
+
+
+@require_GET
+def metrics_view(request):
+    """Request, cache and outbox metrics in Prometheus text format (see feed/metrics.py)."""
+    if settings.METRICS_TOKEN:
+        expected = f'Bearer {settings.METRICS_TOKEN}'
+        if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), expected):
+            return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+    elif not (request.user.is_active and request.user.is_staff):
+        return HttpResponse(status=403)
+    return HttpResponse(
+        metrics.render(lag=outbox.lag()),
+        content_type='text/plain; version=0.0.4; charset=utf-8',
+    )
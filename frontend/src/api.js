@@ -24,8 +24,8 @@ export const getCurrentUser = () =>
   api.get('/auth/me/');
 
 // Posts
-export const getPosts = () => 
-  api.get('/posts/');
+export const getPosts = (cursor = null) => 
+  api.get('/posts/', { params: cursor ? { cursor } : {} });
 
 export const getPost = (id) => 
   api.get(`/posts/${id}/`);
@@ -34,23 +34,55 @@ export const createPost = (content) =>
   api.post('/posts/', { content });
 
 export const likePost = (id) => 
-  api.post(`/posts/${id}/like/`);
+  api.put(`/posts/${id}/like/`);
 
 export const unlikePost = (id) => 
-  api.post(`/posts/${id}/unlike/`);
+  api.delete(`/posts/${id}/like/`);
+
+export const likePosts = (ids) => 
+  api.post('/posts/like-batch/', { ids });
+
+export const unlikePosts = (ids) => 
+  api.post('/posts/unlike-batch/', { ids });
 
 // Comments
+export const getCommentWindow = (postId, cursor) => 
+  api.get(`/posts/${postId}/comments/`, { params: { cursor } });
+
 export const createComment = (postId, content, parentId = null) => 
   api.post('/comments/', { post: postId, content, parent: parentId });
 
 export const likeComment = (id) => 
-  api.post(`/comments/${id}/like/`);
+  api.put(`/comments/${id}/like/`);
 
 export const unlikeComment = (id) => 
-  api.post(`/comments/${id}/unlike/`);
+  api.delete(`/comments/${id}/like/`);
+
+export const likeComments = (ids) => 
+  api.post('/comments/like-batch/', { ids });
+
+export const unlikeComments = (ids) => 
+  api.post('/comments/unlike-batch/', { ids });
 
 // Leaderboard
 export const getLeaderboard = () => 
   api.get('/leaderboard/');
 
+// Live updates over server-sent events. `handlers` maps event types to
+// callbacks taking the parsed data; the browser reconnects (and the server
+// resumes where it left off) by itself. Returns a function closing the stream.
+const openStream = (path, handlers) => {
+  const source = new EventSource(`${API_BASE}/api${path}`, { withCredentials: true });
+  Object.entries(handlers).forEach(([type, handler]) => {
+    source.addEventListener(type, (e) => handler(JSON.parse(e.data)));
+  });
+  return () => source.close();
+};
+
+export const streamPost = (id, handlers) =>
+  openStream(`/posts/${id}/stream/`, handlers);
+
+export const streamLeaderboard = (handlers) =>
+  openStream('/leaderboard/stream/', handlers);
+
 export default api;
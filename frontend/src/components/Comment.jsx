@@ -1,9 +1,34 @@
-import { useState } from 'react';
+import { useState, useEffect } from 'react';
+import * as api from '../api';
 
-function Comment({ comment, onReply, onLike, user, depth = 0 }) {
+function Comment({ comment, postId, onReply, onLike, user, depth = 0 }) {
   const [showReplyForm, setShowReplyForm] = useState(false);
   const [replyContent, setReplyContent] = useState('');
   const [submitting, setSubmitting] = useState(false);
+  // Replies fetched on demand when the server cut this node's replies off
+  const [extraReplies, setExtraReplies] = useState([]);
+  const [moreToken, setMoreToken] = useState(comment.more_replies);
+  const [loadingMore, setLoadingMore] = useState(false);
+
+  useEffect(() => {
+    setExtraReplies([]);
+    setMoreToken(comment.more_replies);
+  }, [comment]);
+
+  const handleLoadMore = async () => {
+    setLoadingMore(true);
+    try {
+      const res = await api.getCommentWindow(postId, moreToken);
+      setExtraReplies((prev) => [...prev, ...res.data.results]);
+      setMoreToken(res.data.next);
+    } catch (err) {
+      console.error('Failed to load replies:', err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  const replies = [...(comment.replies || []), ...extraReplies];
 
   const handleSubmitReply = async (e) => {
     e.preventDefault();
@@ -87,12 +112,13 @@ function Comment({ comment, onReply, onLike, user, depth = 0 }) {
       </div>
       
       {/* Render nested replies */}
-      {comment.replies && comment.replies.length > 0 && (
+      {replies.length > 0 && (
         <div className="mt-2 space-y-2">
-          {comment.replies.map((reply) => (
+          {replies.map((reply) => (
             <Comment
               key={reply.id}
               comment={reply}
+              postId={postId}
               onReply={onReply}
               onLike={onLike}
               user={user}
@@ -101,6 +127,17 @@ function Comment({ comment, onReply, onLike, user, depth = 0 }) {
           ))}
         </div>
       )}
+
+      {moreToken && (
+        <button
+          onClick={handleLoadMore}
+          disabled={loadingMore}
+          className="mt-2 text-xs text-sand-500 hover:text-sand-700 disabled:opacity-50"
+          style={{ marginLeft: '20px' }}
+        >
+          {loadingMore ? 'Loading...' : 'More replies'}
+        </button>
+      )}
     </div>
   );
 }
@@ -5,7 +5,9 @@ import * as api from '../api';
 
 function Feed() {
   const [posts, setPosts] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [newPost, setNewPost] = useState('');
   const [submitting, setSubmitting] = useState(false);
   const { user } = useAuth();
@@ -17,7 +19,8 @@ function Feed() {
   const loadPosts = async () => {
     try {
       const res = await api.getPosts();
-      setPosts(res.data);
+      setPosts(res.data.results);
+      setNextCursor(cursorFrom(res.data.next));
     } catch (err) {
       console.error('Failed to load posts:', err);
     } finally {
@@ -25,6 +28,20 @@ function Feed() {
     }
   };
 
+  const loadMore = async () => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    try {
+      const res = await api.getPosts(nextCursor);
+      setPosts((prev) => [...prev, ...res.data.results]);
+      setNextCursor(cursorFrom(res.data.next));
+    } catch (err) {
+      console.error('Failed to load more posts:', err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleSubmitPost = async (e) => {
     e.preventDefault();
     if (!newPost.trim()) return;
@@ -119,10 +136,27 @@ function Feed() {
               </div>
             </article>
           ))}
+          {nextCursor && (
+            <div className="flex justify-center">
+              <button
+                onClick={loadMore}
+                disabled={loadingMore}
+                className="px-4 py-2 text-sm text-sand-600 hover:text-sand-800 disabled:opacity-50"
+              >
+                {loadingMore ? 'Loading...' : 'Load more'}
+              </button>
+            </div>
+          )}
         </div>
       )}
     </div>
   );
 }
 
+// The API hands back full next/previous URLs; we only need the opaque cursor.
+function cursorFrom(url) {
+  if (!url) return null;
+  return new URL(url).searchParams.get('cursor');
+}
+
 export default Feed;
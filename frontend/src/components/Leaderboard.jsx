@@ -7,9 +7,11 @@ function Leaderboard() {
 
   useEffect(() => {
     loadLeaderboard();
-    // Refresh every 30 seconds
-    const interval = setInterval(loadLeaderboard, 30000);
-    return () => clearInterval(interval);
+    // The server pushes the new top 5 whenever it changes
+    return api.streamLeaderboard({
+      rank: (data) => setLeaders(data.top),
+      reset: loadLeaderboard,
+    });
   }, []);
 
   const loadLeaderboard = async () => {
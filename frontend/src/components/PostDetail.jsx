@@ -4,18 +4,67 @@ import { useAuth } from '../App';
 import * as api from '../api';
 import Comment from './Comment';
 
+// Apply `update` to the comment with `id`, wherever it is in the loaded tree
+const updateComment = (comments, id, update) =>
+  comments.map((comment) =>
+    comment.id === id
+      ? update(comment)
+      : { ...comment, replies: updateComment(comment.replies || [], id, update) }
+  );
+
+const containsComment = (comments, id) =>
+  comments.some((comment) => comment.id === id || containsComment(comment.replies || [], id));
+
 function PostDetail() {
   const { id } = useParams();
   const [post, setPost] = useState(null);
   const [loading, setLoading] = useState(true);
   const [newComment, setNewComment] = useState('');
   const [submitting, setSubmitting] = useState(false);
+  const [loadingMore, setLoadingMore] = useState(false);
   const { user } = useAuth();
 
   useEffect(() => {
     loadPost();
   }, [id]);
 
+  // Live comments and like counts from the post's event stream
+  useEffect(() => {
+    return api.streamPost(id, {
+      like: (data) =>
+        setPost((prev) => {
+          if (!prev) return prev;
+          if (data.post) return { ...prev, like_count: data.like_count };
+          return {
+            ...prev,
+            comments: updateComment(prev.comments || [], data.comment, (comment) => ({
+              ...comment,
+              like_count: data.like_count,
+            })),
+          };
+        }),
+      comment: (comment) =>
+        setPost((prev) => {
+          if (!prev || containsComment(prev.comments || [], comment.id)) return prev;
+          if (comment.parent === null) {
+            // Otherwise it belongs to a page of comments not loaded yet
+            if (prev.more_comments) return prev;
+            return { ...prev, comments: [...(prev.comments || []), comment] };
+          }
+          return {
+            ...prev,
+            comments: updateComment(prev.comments || [], comment.parent, (parent) =>
+              // Truncated replies: it will come with the next window
+              parent.more_replies
+                ? parent
+                : { ...parent, replies: [...(parent.replies || []), comment] }
+            ),
+          };
+        }),
+      reset: loadPost,
+    });
+  }, [id]);
+
   const loadPost = async () => {
     try {
       const res = await api.getPost(id);
@@ -27,6 +76,22 @@ function PostDetail() {
     }
   };
 
+  const handleLoadMoreComments = async () => {
+    setLoadingMore(true);
+    try {
+      const res = await api.getCommentWindow(id, post.more_comments);
+      setPost((prev) => ({
+        ...prev,
+        comments: [...prev.comments, ...res.data.results],
+        more_comments: res.data.next,
+      }));
+    } catch (err) {
+      console.error('Failed to load comments:', err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleLikePost = async () => {
     if (!user) return;
     try {
@@ -147,11 +212,21 @@ function PostDetail() {
               <Comment
                 key={comment.id}
                 comment={comment}
+                postId={id}
                 onReply={handleReply}
                 onLike={handleLikeComment}
                 user={user}
               />
             ))}
+            {post.more_comments && (
+              <button
+                onClick={handleLoadMoreComments}
+                disabled={loadingMore}
+                className="text-sm text-sand-500 hover:text-sand-700 disabled:opacity-50"
+              >
+                {loadingMore ? 'Loading...' : 'More comments'}
+              </button>
+            )}
           </div>
         ) : (
           <p className="text-sand-500 text-sm">No comments yet.</p>